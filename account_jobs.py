@@ -0,0 +1,528 @@
+# account_jobs.py
+
+import os
+import queue
+import socket
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+
+from chat_history import HISTORY_BUFFER
+
+ACCOUNT_JOB_CHUNK_SIZE = int(os.getenv("ACCOUNT_JOB_CHUNK_SIZE", "100"))
+ACCOUNT_JOB_PENDING_WAIT_SECONDS = float(os.getenv("ACCOUNT_JOB_PENDING_WAIT_SECONDS", "10"))
+
+# A running job belongs to the worker in claimed_by until lease_until; every
+# progress update renews the lease. Expired leases are claimed by the next
+# worker that sweeps the table, at most this often.
+ACCOUNT_JOB_LEASE_SECONDS = float(os.getenv("ACCOUNT_JOB_LEASE_SECONDS", "300"))
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Cascade order; every step is safe to run again after a crash
+DELETION_STEPS = [
+    "chats",
+    "user_clicks",
+    "password_resets",
+    "email_verifications",
+    "user_profiles",
+    "auth_user",
+]
+
+# step -> (table, email column, by id in chunks). The tables keyed by email
+# hold at most one row per user and are handled in one statement.
+EMAIL_TABLES = {
+    "user_clicks": ("user_clicks", "user_email", True),
+    "password_resets": ("password_resets", "email", False),
+    "email_verifications": ("email_verifications", "email", False),
+    "user_profiles": ("user_profiles", "email", False),
+}
+
+# Email migration: the RPC renames everything in one transaction; the
+# chunked steps after it are the fallback and find nothing once it ran.
+# user_chats goes last so chats move only after their messages.
+MIGRATION_STEPS = [
+    "rpc",
+    "chat_messages",
+    "user_clicks",
+    "password_resets",
+    "email_verifications",
+    "user_chats",
+]
+
+MIGRATION_TABLES = {
+    "chat_messages": ("chat_messages", "user_email", True),
+    "user_clicks": ("user_clicks", "user_email", True),
+    "password_resets": ("password_resets", "email", False),
+    "email_verifications": ("email_verifications", "email", False),
+    "user_chats": ("user_chats", "user_email", True),
+}
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _lease_until() -> str:
+    return (datetime.now(timezone.utc) + timedelta(seconds=ACCOUNT_JOB_LEASE_SECONDS)).isoformat()
+
+
+class LeaseLost(Exception):
+    """
+    Another worker claimed the job after this worker's lease expired.
+    """
+
+
+class AccountJobs(ABC):
+    """
+    Base for per-account background jobs backed by a Supabase table.
+
+    submit() records a job row and returns it at once; a worker thread runs
+    the subclass's steps in order, saving the current step and per-table
+    row counts as it goes. A worker only runs a job it has claimed (see
+    _claim()), so with several workers each job runs on one of them. Steps
+    must be safe to run again, so a job whose worker died is simply claimed
+    again once its lease expires. Submitting an email that already has an
+    active job returns that job.
+    """
+
+    name = "account job"
+    table = None
+    steps = []
+
+    def __init__(self, supabase, message_log=None, click_log=None, on_done=None):
+        self.supabase = supabase
+        # Queued chat_messages / user_clicks rows must be written (or
+        # dropped) before the job touches those tables
+        self.message_log = message_log
+        self.click_log = click_log
+        # Called with each finished (done or failed) job
+        self.on_done = on_done
+        self.queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    # ---------------------------
+    # JOB ROWS
+    # ---------------------------
+    def _active_job(self, email: str):
+        resp = self.supabase.table(self.table) \
+            .select("*") \
+            .eq("email", email) \
+            .in_("status", ["queued", "running"]) \
+            .limit(1) \
+            .execute()
+
+        return resp.data[0] if resp.data else None
+
+    def _update(self, job: dict, **fields):
+        """
+        Saves fields on a job this worker has claimed, renewing the lease
+        while it runs. Raises LeaseLost if another worker took it over.
+        """
+        job.update(fields)
+        job["updated_at"] = _now()
+        changed = list(fields) + ["updated_at"]
+
+        if job.get("status") == "running":
+            job["lease_until"] = _lease_until()
+            changed.append("lease_until")
+
+        resp = self.supabase.table(self.table) \
+            .update({k: job[k] for k in changed}) \
+            .eq("id", job["id"]) \
+            .eq("claimed_by", WORKER_ID) \
+            .execute()
+
+        if not resp.data:
+            raise LeaseLost(job["id"])
+
+    def _claim(self, job: dict) -> bool:
+        """
+        Marks job running for this worker if it is still queued, or running
+        on an expired lease. Each attempt is a single conditional UPDATE, so
+        of several workers only the one that gets the row back runs it.
+        """
+        claim = {
+            "status": "running",
+            "claimed_by": WORKER_ID,
+            "lease_until": _lease_until(),
+            "updated_at": _now()
+        }
+
+        resp = self.supabase.table(self.table) \
+            .update(claim) \
+            .eq("id", job["id"]) \
+            .eq("status", "queued") \
+            .execute()
+
+        if not resp.data:
+            resp = self.supabase.table(self.table) \
+                .update(claim) \
+                .eq("id", job["id"]) \
+                .eq("status", "running") \
+                .lt("lease_until", _now()) \
+                .execute()
+
+        if not resp.data:
+            return False
+
+        job.update(resp.data[0])
+        return True
+
+    def _count(self, job: dict, table: str, rows: int):
+        counts = dict(job.get("counts") or {})
+        counts[table] = counts.get(table, 0) + rows
+        self._update(job, counts=counts)
+
+    def get(self, job_id: str):
+        resp = self.supabase.table(self.table) \
+            .select("*") \
+            .eq("id", job_id) \
+            .limit(1) \
+            .execute()
+
+        if not resp.data:
+            return None
+
+        return self.progress(resp.data[0])
+
+    def progress(self, job: dict) -> dict:
+        step = job.get("step")
+        done = self.steps.index(step) if step in self.steps else 0
+
+        if job.get("status") == "done":
+            done = len(self.steps)
+
+        return {
+            **job,
+            "steps_done": done,
+            "steps_total": len(self.steps)
+        }
+
+    def submit(self, email: str, **fields) -> dict:
+        email = email.lower().strip()
+
+        with self._lock:
+            job = self._active_job(email)
+
+            if job is None:
+                job = self.supabase.table(self.table) \
+                    .insert({
+                        "email": email,
+                        "status": "queued",
+                        "step": self.steps[0],
+                        "counts": {},
+                        **fields
+                    }) \
+                    .execute() \
+                    .data[0]
+
+                self.enqueue(job)
+
+        return self.progress(job)
+
+    def enqueue(self, job: dict):
+        self.start()
+        self.queue.put(job)
+
+    # ---------------------------
+    # SHARED STEPS
+    # ---------------------------
+    def _wait_for_pending(self, log, predicate):
+        if log is None:
+            return
+
+        if not log.wait(predicate, ACCOUNT_JOB_PENDING_WAIT_SECONDS):
+            print(f"{self.name.upper()}: {log.table} rows still pending")
+
+    def _drop_pending(self, log, predicate):
+        """
+        For rows about to be deleted: drops the queued ones and waits for
+        any already being written.
+        """
+        if log is None:
+            return
+
+        log.discard(predicate)
+        self._wait_for_pending(log, predicate)
+
+    def _chunked(self, job: dict, table: str, column: str, apply):
+        """
+        Selects up to ACCOUNT_JOB_CHUNK_SIZE ids whose column is the job's
+        email and hands them to apply(ids) until none are left. apply must
+        make the rows stop matching (delete / rename), which is also what
+        lets a rerun continue where the last one stopped.
+        """
+        while True:
+            rows = self.supabase.table(table) \
+                .select("id") \
+                .eq(column, job["email"]) \
+                .order("id") \
+                .limit(ACCOUNT_JOB_CHUNK_SIZE) \
+                .execute()
+
+            ids = [row["id"] for row in rows.data or []]
+
+            if not ids:
+                return
+
+            apply(ids)
+            self._count(job, table, len(ids))
+
+    # ---------------------------
+    # WORKER
+    # ---------------------------
+    @abstractmethod
+    def run_step(self, job: dict, step: str):
+        """
+        Runs one of self.steps for job; must be safe to run again.
+        """
+
+    def run(self, job: dict):
+        # Done, or running on another worker
+        if not self._claim(job):
+            return
+
+        start = self.steps.index(job["step"]) if job.get("step") in self.steps else 0
+
+        try:
+            for step in self.steps[start:]:
+                self._update(job, step=step)
+                self.run_step(job, step)
+
+            self._update(job, status="done", error=None)
+
+        except LeaseLost:
+            print(f"{self.name.upper()} LEASE LOST:", job["id"])
+            return
+
+        except Exception as e:
+            print(f"{self.name.upper()} ERROR:", job["id"], repr(e))
+            self._update(job, status="failed", error=str(e))
+
+        if self.on_done is not None:
+            self.on_done(job)
+
+    def _run(self):
+        while True:
+            try:
+                job = self.queue.get(timeout=ACCOUNT_JOB_LEASE_SECONDS)
+            except queue.Empty:
+                # Idle: pick up jobs whose worker went away
+                self.resume()
+                continue
+
+            try:
+                self.run(job)
+            except Exception as e:
+                print(f"{self.name.upper()} WORKER ERROR:", e)
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(
+            target=self._run,
+            name=self.name.replace(" ", "-"),
+            daemon=True
+        )
+        self._thread.start()
+
+    def resume(self):
+        """
+        Queues jobs that are claimable: still queued, or running on an
+        expired lease (a worker that died or was restarted). Run at startup
+        and whenever the worker is idle; run() claims before running.
+        """
+        self.start()
+
+        try:
+            queued = self.supabase.table(self.table) \
+                .select("*") \
+                .eq("status", "queued") \
+                .order("created_at") \
+                .execute()
+
+            expired = self.supabase.table(self.table) \
+                .select("*") \
+                .eq("status", "running") \
+                .lt("lease_until", _now()) \
+                .order("created_at") \
+                .execute()
+        except Exception as e:
+            print(f"{self.name.upper()} RESUME ERROR:", e)
+            return
+
+        jobs = (queued.data or []) + (expired.data or [])
+
+        if jobs:
+            print(f"{self.name.upper()} RESUMED:", len(jobs), "jobs")
+
+        for job in jobs:
+            self.enqueue(job)
+
+
+# ---------------------------
+# ACCOUNT DELETION
+# ---------------------------
+class AccountDeletionJobs(AccountJobs):
+    """
+    Account deletion off the request path. Chats go in chunks, messages
+    first; the auth user is deleted last by the id stored at submit time.
+    """
+
+    name = "account deletion"
+    table = "account_deletion_jobs"
+    steps = DELETION_STEPS
+
+    def _delete_chats(self, job: dict):
+        def delete(chat_ids: list):
+            ids = set(chat_ids)
+            self._drop_pending(self.message_log, lambda row: row.get("chat_id") in ids)
+
+            self.supabase.table("chat_messages") \
+                .delete() \
+                .in_("chat_id", chat_ids) \
+                .execute()
+
+            self.supabase.table("user_chats") \
+                .delete() \
+                .in_("id", chat_ids) \
+                .execute()
+
+            for chat_id in chat_ids:
+                HISTORY_BUFFER.invalidate(chat_id)
+
+        self._chunked(job, "user_chats", "user_email", delete)
+
+    def _delete_by_email(self, job: dict, table: str, column: str, chunked: bool):
+        if not chunked:
+            self.supabase.table(table) \
+                .delete() \
+                .eq(column, job["email"]) \
+                .execute()
+            return
+
+        def delete(ids: list):
+            self.supabase.table(table) \
+                .delete() \
+                .in_("id", ids) \
+                .execute()
+
+        self._chunked(job, table, column, delete)
+
+    def _delete_auth_user(self, job: dict):
+        if not job.get("user_id"):
+            return
+
+        try:
+            self.supabase.auth.admin.delete_user(job["user_id"])
+        except Exception as e:
+            # Already gone on a rerun
+            if "not found" not in str(e).lower():
+                raise
+
+    def run_step(self, job: dict, step: str):
+        if step == "chats":
+            self._delete_chats(job)
+        elif step == "user_clicks":
+            email = job["email"]
+            self._drop_pending(self.click_log, lambda row: row.get("user_email") == email)
+            self._delete_by_email(job, *EMAIL_TABLES[step])
+        elif step == "auth_user":
+            self._delete_auth_user(job)
+        else:
+            self._delete_by_email(job, *EMAIL_TABLES[step])
+
+
+# ---------------------------
+# EMAIL MIGRATION
+# ---------------------------
+class EmailMigrationJobs(AccountJobs):
+    """
+    Moves a user's rows from email (the old address) to new_email once
+    update_profile has switched the auth user and the profile.
+
+    The migrate_user_email RPC renames every table in one transaction, so
+    all rows switch at once; if it is not deployed the chunked steps do the
+    same table by table. Until the job is done previous_emails() gives
+    readers the old address as well.
+    """
+
+    name = "email migration"
+    table = "email_migration_jobs"
+    steps = MIGRATION_STEPS
+
+    def previous_emails(self, email: str) -> list:
+        """
+        Old addresses with a queued or running migration to email, on any
+        worker. Their rows may not have moved yet.
+        """
+        try:
+            resp = self.supabase.table(self.table) \
+                .select("email") \
+                .eq("new_email", email.lower().strip()) \
+                .in_("status", ["queued", "running"]) \
+                .execute()
+        except Exception as e:
+            print("EMAIL MIGRATION LOOKUP ERROR:", e)
+            return []
+
+        return sorted({row["email"] for row in resp.data or []})
+
+    def active_for(self, email: str):
+        """
+        A queued or running migration from or to email, or None.
+        """
+        email = email.lower().strip()
+
+        for column in ("email", "new_email"):
+            resp = self.supabase.table(self.table) \
+                .select("*") \
+                .eq(column, email) \
+                .in_("status", ["queued", "running"]) \
+                .limit(1) \
+                .execute()
+
+            if resp.data:
+                return resp.data[0]
+
+        return None
+
+    def _rpc(self, job: dict):
+        try:
+            resp = self.supabase.rpc("migrate_user_email", {
+                "old_email": job["email"],
+                "new_email": job["new_email"]
+            }).execute()
+        except Exception as e:
+            print("EMAIL MIGRATION RPC ERROR, CHUNKING:", e)
+            return
+
+        self._update(job, counts=resp.data or {})
+
+    def _rename(self, job: dict, table: str, column: str, chunked: bool):
+        if not chunked:
+            self.supabase.table(table) \
+                .update({column: job["new_email"]}) \
+                .eq(column, job["email"]) \
+                .execute()
+            return
+
+        def rename(ids: list):
+            self.supabase.table(table) \
+                .update({column: job["new_email"]}) \
+                .in_("id", ids) \
+                .execute()
+
+        self._chunked(job, table, column, rename)
+
+    def run_step(self, job: dict, step: str):
+        if step == "rpc":
+            old_email = job["email"]
+            self._wait_for_pending(self.message_log, lambda row: row.get("user_email") == old_email)
+            self._wait_for_pending(self.click_log, lambda row: row.get("user_email") == old_email)
+            self._rpc(job)
+        else:
+            self._rename(job, *MIGRATION_TABLES[step])
@@ -0,0 +1,92 @@
+# analytics.py
+
+import os
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+from write_behind import WriteBehindLog
+
+# Depth (fraction of capacity) above which a table is reported as backed up
+ANALYTICS_BACKPRESSURE_RATIO = float(os.getenv("ANALYTICS_BACKPRESSURE_RATIO", "0.8"))
+
+
+def user_type(user_role: str) -> str:
+    return "user" if user_role != "guest" else "guest"
+
+
+# ---------------------------
+# EVENTS (one per analytics table)
+# ---------------------------
+@dataclass
+class ClickEvent:
+    chat_id: Optional[int]
+    button: str
+    question: str
+    user_email: Optional[str] = None
+    user_type: str = "guest"
+
+    table = "user_clicks"
+
+
+@dataclass
+class AnswerActionEvent:
+    chat_id: Optional[int]
+    action: str
+    answer_text: Optional[str] = None
+    source: Optional[str] = None
+    user_email: Optional[str] = None
+    user_type: str = "guest"
+
+    table = "answer_actions"
+
+
+@dataclass
+class SigninEvent:
+    user_email: str
+
+    table = "user_signins"
+
+
+EVENT_TYPES = (ClickEvent, AnswerActionEvent, SigninEvent)
+
+
+class AnalyticsPipeline:
+    """
+    Fire-and-forget analytics. track() turns a typed event into its row and
+    hands it to that table's write-behind log, so endpoints never wait on
+    the insert. The logs are journaled: events queued when the process
+    stops are spooled and written on the next start.
+    """
+
+    def __init__(self, supabase, **log_options):
+        self.logs = {
+            event_type.table: WriteBehindLog(event_type.table, supabase, journal=True, **log_options)
+            for event_type in EVENT_TYPES
+        }
+
+    def track(self, event):
+        try:
+            self.logs[event.table].append(asdict(event))
+        except Exception as e:
+            print(f"{event.table.upper()} TRACK ERROR:", e)
+
+    def start(self):
+        for log in self.logs.values():
+            log.start()
+
+    def close(self):
+        for log in self.logs.values():
+            log.close()
+
+    def stats(self) -> dict:
+        """
+        Per-table queue stats plus whether each queue is backed up.
+        """
+        tables = {}
+
+        for table, log in self.logs.items():
+            stats = log.stats()
+            stats["backpressure"] = stats["depth"] >= stats["capacity"] * ANALYTICS_BACKPRESSURE_RATIO
+            tables[table] = stats
+
+        return tables
@@ -0,0 +1,198 @@
+# answer_cache.py
+
+import copy
+import os
+import threading
+import time
+
+import numpy as np
+
+from vector_index import KNOWLEDGE_UPDATED_COLUMN
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.97"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_VERSION_CHECK_SECONDS = float(os.getenv("ANSWER_CACHE_VERSION_CHECK_SECONDS", "60"))
+
+# Any change to these tables can change an answer
+KNOWLEDGE_TABLES = ["partner_qa", "partner_chunks", "bridge_qa", "bridge_chunks"]
+
+
+def answer_cache_route(partner_name_matches: list, triggered_partners: list) -> str:
+    """
+    partner:<ids> when a partner was named or triggered, otherwise open
+    (bridge / general retrieval). A cached answer is only reused on the same route.
+    """
+    partner_ids = sorted({
+        str(p["partner_id"])
+        for p in (partner_name_matches or []) + (triggered_partners or [])
+        if p.get("partner_id") is not None
+    })
+
+    if partner_ids:
+        return "partner:" + ",".join(partner_ids)
+
+    return "open"
+
+
+def answer_cache_applies(message: str, retrieval_question: str, embedding) -> bool:
+    """
+    The cache is bypassed when the follow-up rewrite changed the question,
+    i.e. chat history changed its meaning.
+    """
+    if not ANSWER_CACHE_ENABLED or embedding is None:
+        return False
+
+    return retrieval_question.strip().lower() == message.strip().lower()
+
+
+class AnswerCache:
+    """
+    Semantic cache of whole get_answer results.
+
+    A lookup hits when a stored entry on the same route has cosine
+    similarity >= threshold with the query embedding, was stored under the
+    current knowledge-table version and is younger than the TTL.
+    Vectors live in a preallocated float32 ring buffer.
+    """
+
+    def __init__(
+        self,
+        capacity: int = ANSWER_CACHE_SIZE,
+        threshold: float = ANSWER_CACHE_SIMILARITY,
+        ttl_seconds: float = ANSWER_CACHE_TTL_SECONDS
+    ):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.vectors = None
+        self.slots = [None] * capacity
+        self.next_slot = 0
+        self.version = None
+        self.version_checked_at = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    # ---------------------------
+    # INVALIDATION
+    # ---------------------------
+    def invalidate(self):
+        with self._lock:
+            self.slots = [None] * self.capacity
+
+    def version_check_due(self) -> bool:
+        if self.version_checked_at is None:
+            return True
+
+        return time.monotonic() - self.version_checked_at > ANSWER_CACHE_VERSION_CHECK_SECONDS
+
+    @staticmethod
+    def _table_version(supabase, table: str) -> tuple:
+        resp = supabase.table(table) \
+            .select(KNOWLEDGE_UPDATED_COLUMN, count="exact") \
+            .order(KNOWLEDGE_UPDATED_COLUMN, desc=True) \
+            .limit(1) \
+            .execute()
+
+        newest = resp.data[0].get(KNOWLEDGE_UPDATED_COLUMN) if resp.data else None
+
+        return resp.count, newest
+
+    def check_version(self, supabase):
+        """
+        (row count, newest updated_at) of each knowledge table is the
+        version stamp: inserts and deletes change the count, edits the
+        trigger-maintained updated_at (sql/knowledge_updated_at.sql).
+        When any of them changes every cached answer is dropped.
+        """
+        if not self.version_check_due():
+            return
+
+        self.version_checked_at = time.monotonic()
+
+        try:
+            version = tuple(
+                self._table_version(supabase, table)
+                for table in KNOWLEDGE_TABLES
+            )
+        except Exception as e:
+            print("ANSWER CACHE VERSION ERROR:", e)
+            return
+
+        if version != self.version:
+            if self.version is not None:
+                print("ANSWER CACHE INVALIDATED:", self.version, "->", version)
+                self.invalidate()
+
+            self.version = version
+
+    # ---------------------------
+    # LOOKUP / STORE
+    # ---------------------------
+    @staticmethod
+    def _unit(embedding) -> np.ndarray:
+        v = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(v)
+
+        return v / norm if norm else v
+
+    def lookup(self, route: str, embedding):
+        q = self._unit(embedding)
+        now = time.monotonic()
+
+        with self._lock:
+            if self.vectors is None or self.vectors.shape[1] != q.shape[0]:
+                self.misses += 1
+                return None
+
+            sims = self.vectors @ q
+
+            for i in np.argsort(-sims):
+                if sims[i] < self.threshold:
+                    break
+
+                slot = self.slots[i]
+
+                if slot is None:
+                    continue
+
+                slot_route, response, version, stored_at = slot
+
+                if slot_route != route or version != self.version:
+                    continue
+
+                if now - stored_at > self.ttl_seconds:
+                    continue
+
+                self.hits += 1
+                print("ANSWER CACHE HIT:", route, f"{sims[i]:.3f}")
+                return copy.deepcopy(response)
+
+            self.misses += 1
+            return None
+
+    def store(self, route: str, embedding, response: dict):
+        q = self._unit(embedding)
+
+        with self._lock:
+            if self.vectors is None or self.vectors.shape[1] != q.shape[0]:
+                self.vectors = np.zeros((self.capacity, q.shape[0]), dtype=np.float32)
+                self.slots = [None] * self.capacity
+
+            i = self.next_slot
+            self.vectors[i] = q
+            self.slots[i] = (route, copy.deepcopy(response), self.version, time.monotonic())
+            self.next_slot = (i + 1) % self.capacity
+
+    def stats(self) -> dict:
+        return {
+            "entries": sum(1 for s in self.slots if s is not None),
+            "hits": self.hits,
+            "misses": self.misses,
+            "version": self.version
+        }
+
+
+ANSWER_CACHE = AnswerCache()
@@ -0,0 +1,165 @@
+import base64
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency of /auth/login before and after the single-round-trip rewrite,
+# against a local stand-in for the Supabase auth and REST endpoints that
+# answers every request after a fixed delay.
+#
+#   python bench_login.py [samples] [latency_ms]
+
+SAMPLES = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+LATENCY_MS = float(sys.argv[2]) if len(sys.argv) > 2 else 40
+
+EMAIL = "bench@example.com"
+USER_ID = "00000000-0000-0000-0000-000000000001"
+PROFILE = {"id": USER_ID, "name": "Bench", "email": EMAIL, "newsletter": False}
+
+
+def _b64(data: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+
+
+# Unsigned, but shaped like the JWTs Supabase clients expect
+TOKEN = ".".join([
+    _b64({"alg": "HS256", "typ": "JWT"}),
+    _b64({"sub": USER_ID, "role": "authenticated", "exp": int(time.time()) + 3600}),
+    "signature"
+])
+
+SESSION = {
+    "access_token": TOKEN,
+    "refresh_token": "bench-refresh",
+    "expires_in": 3600,
+    "expires_at": int(time.time()) + 3600,
+    "token_type": "bearer",
+    "user": {
+        "id": USER_ID,
+        "aud": "authenticated",
+        "role": "authenticated",
+        "email": EMAIL,
+        "app_metadata": {},
+        "user_metadata": {"name": "Bench"},
+        "created_at": "2024-01-01T00:00:00Z"
+    }
+}
+
+
+class StandIn(BaseHTTPRequestHandler):
+    def _reply(self, status: int, body):
+        time.sleep(LATENCY_MS / 1000)
+        payload = json.dumps(body).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path.startswith("/rest/v1/user_profiles"):
+            if "vnd.pgrst.object" in self.headers.get("Accept", ""):
+                return self._reply(200, PROFILE)
+
+            return self._reply(200, [PROFILE])
+
+        self._reply(404, {"message": "not found"})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+        if self.path.startswith("/auth/v1/token"):
+            return self._reply(200, SESSION)
+
+        if self.path.startswith("/rest/v1/"):
+            return self._reply(201, [])
+
+        self._reply(404, {"message": "not found"})
+
+    def log_message(self, *args):
+        pass
+
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+
+# main.py reads these at import time
+os.environ["SUPABASE_URL"] = f"http://127.0.0.1:{server.server_port}"
+os.environ["SUPABASE_ANON_KEY"] = TOKEN
+os.environ["SUPABASE_SERVICE_ROLE_KEY"] = TOKEN
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import main
+from main import LoginRequest, supabase, supabase_admin
+from profiles import PROFILES
+
+
+def login_before(email: str, password: str) -> dict:
+    """
+    The sequential login this benchmark replaced: existence check,
+    password sign-in, sign-in insert, then a second profile read.
+    """
+    exists = supabase_admin.table("user_profiles") \
+        .select("id") \
+        .eq("email", email) \
+        .limit(1) \
+        .execute()
+
+    if not exists.data:
+        raise RuntimeError("Account not found")
+
+    auth = supabase.auth.sign_in_with_password({"email": email, "password": password})
+
+    supabase_admin.table("user_signins").insert({"user_email": email}).execute()
+
+    profile = supabase_admin.table("user_profiles") \
+        .select("name, email") \
+        .eq("email", email) \
+        .single() \
+        .execute()
+
+    return {"user": auth.user, "name": profile.data.get("name")}
+
+
+def login_after(email: str, password: str) -> dict:
+    # Cold profile cache, the worst case for the new path
+    PROFILES.invalidate(email)
+    return main.login(LoginRequest(email=email, password=password))
+
+
+def timed(fn) -> list:
+    times = []
+
+    for _ in range(SAMPLES):
+        start = time.perf_counter()
+        fn(EMAIL, "password")
+        times.append((time.perf_counter() - start) * 1000)
+
+    return times
+
+
+def pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+# Warm up connections on both clients
+login_before(EMAIL, "password")
+login_after(EMAIL, "password")
+
+print(f"Stand-in latency: {LATENCY_MS:.0f}ms per request, {SAMPLES} logins each")
+
+for label, fn in [("before", login_before), ("after", login_after)]:
+    times = timed(fn)
+    print(
+        f"  {label:<6} p50={pct(times, 0.5):.0f}ms "
+        f"p95={pct(times, 0.95):.0f}ms mean={statistics.mean(times):.0f}ms"
+    )
+
+main.ANALYTICS.close()
+server.shutdown()
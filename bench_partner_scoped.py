@@ -0,0 +1,87 @@
+from supabase import create_client
+from openai import OpenAI
+from dotenv import load_dotenv, find_dotenv
+from embedding_cache import EMBEDDINGS
+from retrieval import match, match_scoped, filter_partners
+import os
+import random
+import statistics
+import sys
+import time
+
+# Compares "global top-k then filter by partner" with partner-scoped top-k
+# for the triggered-partner queries in chat.answer_from_triggered_partners.
+#
+#   python bench_partner_scoped.py [samples]
+
+load_dotenv(find_dotenv("env.txt"))
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+
+supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+client = OpenAI(api_key=OPENAI_API_KEY)
+
+SAMPLES = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+QUERIES = [
+    ("match_partner_qa", 0.45, 20),
+    ("match_partner_chunks", 0.45, 30),
+]
+
+random.seed(7)
+
+partner_ids = [
+    p["id"] for p in
+    supabase.table("partners").select("id").execute().data or []
+]
+
+questions = [
+    r["question"] for r in
+    supabase.table("partner_qa").select("question").limit(1000).execute().data or []
+    if r.get("question")
+]
+
+questions = random.sample(questions, min(SAMPLES, len(questions)))
+
+print(f"Partners: {len(partner_ids)}  Questions: {len(questions)}")
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    rows = fn(*args)
+    return rows, (time.perf_counter() - start) * 1000
+
+
+def pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+for rpc, threshold, count in QUERIES:
+    recalls = []
+    after_ms = []
+    scoped_ms = []
+
+    for question in questions:
+        embedding = EMBEDDINGS.embed(client, question)
+        scope = random.sample(partner_ids, min(len(partner_ids), random.randint(1, 3)))
+
+        rows, ms = timed(match, supabase, rpc, embedding, threshold, count)
+        after = filter_partners(rows, scope)
+        after_ms.append(ms)
+
+        scoped, ms = timed(match_scoped, supabase, rpc, embedding, threshold, count, scope)
+        scoped_ms.append(ms)
+
+        if scoped:
+            found = {r["id"] for r in after}
+            recalls.append(sum(1 for r in scoped if r["id"] in found) / len(scoped))
+
+    print(f"\n{rpc} (threshold={threshold}, count={count})")
+
+    if recalls:
+        print(f"  filter-after recall vs scoped: {statistics.mean(recalls):.3f} over {len(recalls)} queries")
+
+    print(f"  filter-after latency p50={pct(after_ms, 0.5):.0f}ms p95={pct(after_ms, 0.95):.0f}ms")
+    print(f"  scoped       latency p50={pct(scoped_ms, 0.5):.0f}ms p95={pct(scoped_ms, 0.95):.0f}ms")
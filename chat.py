@@ -6,11 +6,30 @@ import requests
 import openai
 import re
 import json
+from concurrent.futures import ThreadPoolExecutor, wait
 from supabase import create_client, Client
 from dotenv import load_dotenv, find_dotenv
 from openai import OpenAI
 from typing import Optional
 from troubleshooting import run_troubleshooting, TROUBLESHOOTING_SESSIONS
+from partners import PARTNER_TRIGGERS, PARTNER_DIRECTORY
+from retrieval import RetrievalSession, match, CHUNK_RERANK_TOP_N, CHUNK_RERANK_MIN_SIMILARITY
+from embedding_cache import EMBEDDINGS
+from answer_cache import ANSWER_CACHE, answer_cache_route, answer_cache_applies
+from rerank_cache import RERANK_CACHE, RERANK_MODEL
+from rerankers import LOCAL_RERANKER, reranker_for
+from chunk_index import PARTNER_CHUNK_INDEX
+from followup import REWRITES, local_rewrite
+from write_behind import WriteBehindLog
+from analytics import AnalyticsPipeline, ClickEvent, user_type
+from profiles import PROFILES
+from chat_history import (
+    HISTORY_BUFFER,
+    HISTORY_COMPACTOR,
+    HISTORY_MAX_MESSAGES,
+    HISTORY_TAIL_ROWS,
+    history_key,
+)
 
 # -------------------------------
 # ENV
@@ -34,20 +53,18 @@ client = OpenAI(api_key=OPENAI_API_KEY)
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
 supabase_admin: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
 
-def get_user_name_by_email(email: str) -> str:
-    try:
-        resp = supabase_admin.table("user_profiles") \
-            .select("name") \
-            .eq("email", email.lower().strip()) \
-            .single() \
-            .execute()
+# chat_messages inserts are batched in the background (write_behind.py);
+# MESSAGE_LOG_ENABLED=0 writes each message inline as before
+MESSAGE_LOG_ENABLED = os.getenv("MESSAGE_LOG_ENABLED", "1") == "1"
+# Journaled: messages acknowledged before a crash are written on restart
+MESSAGE_LOG = WriteBehindLog("chat_messages", supabase_admin, journal=True)
 
-        if resp.data and resp.data.get("name"):
-            return resp.data["name"]
-    except Exception:
-        pass
+# user_clicks, answer_actions and user_signins (analytics.py)
+ANALYTICS = AnalyticsPipeline(supabase_admin)
 
-    return email.split("@")[0].capitalize()
+def get_user_name_by_email(email: str) -> str:
+    # Shared with main.py through the profile cache
+    return PROFILES.name(supabase_admin, email)
 
 def get_experts_by_role(role: str):
     try:
@@ -118,39 +135,15 @@ def normalize(text: str) -> str:
 
 def semantic_partner_match(question: str):
 
-    embedding = client.embeddings.create(
-        model="text-embedding-3-small",
-        input=question
-    ).data[0].embedding
-
-    resp = supabase_admin.rpc(
-        "match_partner_chunks",
-        {
-            "query_embedding": embedding,
-            "match_threshold": 0.72,
-            "match_count": 8
-        }
-    ).execute()
+    embedding = EMBEDDINGS.embed(client, question)
 
-    return resp.data or []
+    return match(supabase_admin, "match_partner_chunks", embedding, 0.72, 8)
 
 def semantic_bridge_match(question: str):
 
-    embedding = client.embeddings.create(
-        model="text-embedding-3-small",
-        input=question
-    ).data[0].embedding
-
-    resp = supabase_admin.rpc(
-        "match_bridge_chunks",
-        {
-            "query_embedding": embedding,
-            "match_threshold": 0.72,
-            "match_count": 5
-        }
-    ).execute()
+    embedding = EMBEDDINGS.embed(client, question)
 
-    return resp.data or []
+    return match(supabase_admin, "match_bridge_chunks", embedding, 0.72, 5)
 
 def adjust_plurality(text: str, question: str) -> str:
     q_words = question.lower().split()
@@ -253,14 +246,7 @@ def ask_openai(question: str) -> str:
 def enrich_question(question: str) -> str:
     return question.lower()
 
-def ask_ai_only(question: str, chat_id: int = None, history: list = None) -> str:
-
-    if not chat_id:
-        history = history or []
-    else:
-        history = get_chat_history(chat_id)
-
-
+def build_ai_only_messages(question: str, history: list) -> list:
     messages = [
     {
         "role": "system",
@@ -296,6 +282,19 @@ def ask_ai_only(question: str, chat_id: int = None, history: list = None) -> str
         "content": question
     })
 
+    return messages
+
+def ask_ai_only(question: str, chat_id: int = None, history: list = None) -> str:
+
+    if not chat_id:
+        history = history or []
+    else:
+        history = get_chat_history(chat_id)
+
+    history = compact_history(chat_id, history)
+
+    messages = build_ai_only_messages(question, history)
+
     r = client.chat.completions.create(
         model="gpt-4o-mini",
         messages=messages,
@@ -325,70 +324,99 @@ def get_chat_history(chat_id: int, limit: int = 15):
     """
     Fetches previous chat messages for context memory.
     Limits history to prevent token overflow.
+    Served from HISTORY_BUFFER when the chat is buffered; otherwise only
+    the tail of the chat is read.
     """
+    history = HISTORY_BUFFER.get(chat_id)
+
+    if history is not None:
+        return history
+
     try:
         resp = supabase_admin.table("chat_messages") \
             .select("role, content") \
             .eq("chat_id", chat_id) \
-            .order("id") \
+            .order("id", desc=True) \
+            .limit(HISTORY_TAIL_ROWS) \
             .execute()
 
-        if not resp.data:
-            return []
+        rows = list(reversed(resp.data or [])) + pending_messages(chat_id)
 
-        history = []
+        history = history_from_rows(rows)
+        HISTORY_BUFFER.load(chat_id, history)
 
-        for msg in resp.data:
-            if msg["role"] in ["user", "assistant"]:
-                history.append({
-                    "role": msg["role"],
-                    "content": msg["content"]
-                })
-
-        # Keep only last N messages for token control
-        return history[-20:]
+        return history
 
     except Exception as e:
         print("HISTORY ERROR:", e)
         return []
 
+def build_history_summary_messages(previous_summary: str, messages: list) -> list:
+    return [
+        {
+            "role": "system",
+            "content": (
+                "You maintain a running summary of a conversation between a user and TheBridge AI.\n"
+                "Update the previous summary with the new messages.\n\n"
+                "Rules:\n"
+                "- Keep partner, company, product, vessel and place names, numbers and anything the user decided or asked for.\n"
+                "- Do not add facts.\n"
+                "- Plain text, at most 150 words.\n"
+                "- Return ONLY the updated summary."
+            )
+        },
+        {
+            "role": "user",
+            "content": json.dumps({
+                "previous_summary": previous_summary,
+                "new_messages": messages
+            })
+        }
+    ]
+
+def summarize_history(previous_summary: str, messages: list) -> str:
+    response = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=build_history_summary_messages(previous_summary, messages),
+        temperature=0
+    )
+
+    return response.choices[0].message.content.strip()
+
+def compact_history(chat_id, history: list) -> list:
+    """
+    Token-budgeted history: recent turns verbatim, older ones summarized.
+    """
+    return HISTORY_COMPACTOR.compact(history_key(chat_id, history), history, summarize_history)
+
+def history_from_rows(rows: list) -> list:
+    history = []
+
+    for msg in rows:
+        if msg["role"] in ["user", "assistant"]:
+            history.append({
+                "role": msg["role"],
+                "content": msg["content"]
+            })
+
+    # Keep only last N messages for token control
+    return history[-HISTORY_MAX_MESSAGES:]
+
 def rewrite_followup_question(message: str, history: list) -> str:
     """
     Rewrites follow-up questions into standalone retrieval questions using chat history.
     Generic: works for any partner, product, company, system, or topic.
+    Standalone messages and repeated follow-ups never reach the LLM.
     """
-    if not history:
-        return message
+    rewritten = local_rewrite(message, history)
 
-    try:
-        recent_history = history[-6:]
+    if rewritten is not None:
+        return rewritten
 
+    try:
         response = client.chat.completions.create(
             model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You rewrite user questions for search/retrieval.\n"
-                        "Use the recent conversation to resolve references like it, they, this company, "
-                        "that system, the cabinet, the product, this, that, he, she, them.\n\n"
-                        "Rules:\n"
-                        "- Return ONLY the rewritten standalone question.\n"
-                        "- Do not answer the question.\n"
-                        "- Do not add facts.\n"
-                        "- Do not invent a topic.\n"
-                        "- If the user question is already standalone, return it unchanged.\n"
-                        "- Preserve the user's language.\n"
-                    )
-                },
-                {
-                    "role": "user",
-                    "content": json.dumps({
-                        "recent_history": recent_history,
-                        "latest_user_question": message
-                    })
-                }
-            ],
+            messages=build_followup_rewrite_messages(message, history),
             temperature=0
         )
 
@@ -397,12 +425,41 @@ def rewrite_followup_question(message: str, history: list) -> str:
         if not rewritten:
             return message
 
+        REWRITES.store(message, history, rewritten)
         return rewritten
 
     except Exception as e:
         print("FOLLOWUP REWRITE ERROR:", e)
         return message
 
+def build_followup_rewrite_messages(message: str, history: list) -> list:
+    recent_history = history[-6:]
+
+    return [
+        {
+            "role": "system",
+            "content": (
+                "You rewrite user questions for search/retrieval.\n"
+                "Use the recent conversation to resolve references like it, they, this company, "
+                "that system, the cabinet, the product, this, that, he, she, them.\n\n"
+                "Rules:\n"
+                "- Return ONLY the rewritten standalone question.\n"
+                "- Do not answer the question.\n"
+                "- Do not add facts.\n"
+                "- Do not invent a topic.\n"
+                "- If the user question is already standalone, return it unchanged.\n"
+                "- Preserve the user's language.\n"
+            )
+        },
+        {
+            "role": "user",
+            "content": json.dumps({
+                "recent_history": recent_history,
+                "latest_user_question": message
+            })
+        }
+    ]
+
 
 def clean_chunks(chunks):
     seen = set()
@@ -468,22 +525,27 @@ def remove_redundant_prefixes(text: str) -> str:
 
     return "\n\n".join(cleaned)
 
-def enforce_yes_no(question: str, answer: str) -> str:
+def is_yes_no_question(question: str) -> bool:
     q = question.lower().strip()
-    a = answer.strip()
-    a_lower = a.lower()
 
-    # 1️⃣ Detect yes/no question
-    is_yes_no = any(q.startswith(w + " ") for w in [
+    return any(q.startswith(w + " ") for w in [
         "is", "are", "does", "do", "can", "should", "will"
     ])
 
-    if not is_yes_no:
-        return a
+def yes_no_prefix(question: str, answer: str) -> str:
+    """
+    "Yes, ", "No, " or "" for the answer to a yes/no question.
+    Streaming callers pass only the first sentence of the answer.
+    """
+    a_lower = answer.strip().lower()
+
+    # 1️⃣ Detect yes/no question
+    if not is_yes_no_question(question):
+        return ""
 
     # 2️⃣ If already starts correctly → keep it
     if a_lower.startswith(("yes", "no")):
-        return a
+        return ""
 
     # 3️⃣ Strong NEGATIVE detection
     negative_patterns = [
@@ -511,19 +573,33 @@ def enforce_yes_no(question: str, answer: str) -> str:
 
     # 5️⃣ Decide
     if is_negative and not is_positive:
-        return "No, " + a
+        return "No, "
 
     if is_positive and not is_negative:
-        return "Yes, " + a
+        return "Yes, "
 
     # fallback → do not invent Yes/No
-    return a
+    return ""
+
+def enforce_yes_no(question: str, answer: str) -> str:
+    return yes_no_prefix(question, answer) + answer.strip()
+
 def generate_contextual_answer(question: str, context_chunks: list, history: list):
     if not context_chunks:
         return NO_ANSWER_FALLBACK
 
+    response = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=build_contextual_answer_messages(question, context_chunks),
+        temperature=0
+    )
+
+    return response.choices[0].message.content.strip()
+
+def build_contextual_answer_messages(question: str, context_chunks: list) -> list:
     context = context_chunks[0]
-    messages = [
+
+    return [
         {
             "role": "system",
             "content": (
@@ -551,14 +627,6 @@ Context:
         }
     ]
 
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=messages,
-        temperature=0
-    )
-
-    return response.choices[0].message.content.strip()
-
 def is_troubleshooting_candidate(message: str) -> bool:
     msg = message.lower()
 
@@ -579,51 +647,10 @@ def get_partner_trigger_matches(message: str):
     """
     Finds partners whose trigger words appear in the user's message.
     Runs before semantic search so known partner categories route correctly.
+    Matching runs against the cached PARTNER_TRIGGERS index (one pass per message).
     """
     try:
-        msg = normalize(message)
-
-        resp = supabase_admin.table("partner_triggers") \
-            .select("partner_id, trigger, partners(id, badge_label)") \
-            .eq("is_active", True) \
-            .execute()
-
-        rows = resp.data or []
-        matches = []
-
-        for row in rows:
-            trigger = row.get("trigger", "")
-            trigger_norm = normalize(trigger)
-
-            if not trigger_norm:
-                continue
-
-            pattern = r"\b" + re.escape(trigger_norm) + r"\b"
-
-            msg_compact = msg.replace(" ", "")
-            trigger_compact = trigger_norm.replace(" ", "")
-
-            if re.search(pattern, msg) or trigger_compact in msg_compact:
-                partner = row.get("partners") or {}
-
-                matches.append({
-                    "partner_id": row["partner_id"],
-                    "partner_name": partner.get("badge_label", "Partner"),
-                    "trigger": trigger
-                })
-
-        unique = {}
-
-        for match in matches:
-            partner_id = match["partner_id"]
-
-            if (
-                partner_id not in unique
-                or len(match["trigger"]) > len(unique[partner_id]["trigger"])
-            ):
-                unique[partner_id] = match
-
-        return list(unique.values())
+        return PARTNER_TRIGGERS.match(supabase_admin, message)
 
     except Exception as e:
         print("PARTNER TRIGGER MATCH ERROR:", e)
@@ -636,36 +663,15 @@ def get_partner_name_match(message: str):
     just because the question contains words like insurance, sonar, safety, etc.
     """
     try:
-        msg = normalize(message)
-        msg_compact = msg.replace(" ", "")
-
-        resp = supabase_admin.table("partners") \
-            .select("id, badge_label") \
-            .execute()
-
-        matches = []
-
-        for partner in resp.data or []:
-            partner_name = partner.get("badge_label") or ""
-            partner_norm = normalize(partner_name)
-            partner_compact = partner_norm.replace(" ", "")
-
-            if not partner_norm:
-                continue
-
-            if partner_norm in msg or partner_compact in msg_compact:
-                matches.append({
-                    "partner_id": partner["id"],
-                    "partner_name": partner_name,
-                    "trigger": partner_name
-                })
-
-        return matches
+        return PARTNER_DIRECTORY.match_names(supabase_admin, message)
 
     except Exception as e:
         print("PARTNER NAME MATCH ERROR:", e)
         return []
 
+def get_partner_badge(partner_id) -> str:
+    return PARTNER_DIRECTORY.badge_label(supabase_admin, partner_id)
+
 def generate_partner_answer(question: str, partner_name: str, context: str) -> str:
     """
     Generates a clean user-facing answer from partner context.
@@ -720,9 +726,18 @@ def generate_adaptive_partner_answer(question: str, partner_name: str, context_c
     if not context_chunks:
         return NO_ANSWER_FALLBACK
 
+    response = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=build_adaptive_partner_messages(question, partner_name, context_chunks),
+        temperature=0
+    )
+
+    return response.choices[0].message.content.strip()
+
+def build_adaptive_partner_messages(question: str, partner_name: str, context_chunks: list) -> list:
     context = "\n\n---\n\n".join(context_chunks[:3])
 
-    messages = [
+    return [
         {
             "role": "system",
             "content": (
@@ -780,14 +795,6 @@ Partner context:
 """
         }
     ]
-
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=messages,
-        temperature=0
-    )
-
-    return response.choices[0].message.content.strip()
     
 def get_best_triggered_partner_chunk(message: str, triggered_partners: list):
     """
@@ -796,6 +803,7 @@ def get_best_triggered_partner_chunk(message: str, triggered_partners: list):
 
     Returns the exact stored chunk unchanged.
     No OpenAI rewrite. No hard-coded partner/topic.
+    Word and phrase overlap come from the positional index in chunk_index.
     """
     try:
         allowed_partner_ids = [
@@ -807,166 +815,103 @@ def get_best_triggered_partner_chunk(message: str, triggered_partners: list):
         if not allowed_partner_ids:
             return None
 
-        resp = supabase_admin.table("partner_chunks") \
-            .select("partner_id, content") \
-            .in_("partner_id", allowed_partner_ids) \
-            .execute()
-
-        rows = resp.data or []
-
-        if not rows:
-            return None
-
-        stop_words = {
-            "what", "why", "how", "when", "where", "which", "who",
-            "do", "does", "did", "is", "are", "was", "were",
-            "the", "a", "an", "and", "or", "but", "with", "from",
-            "for", "to", "of", "in", "on", "at", "by", "about",
-            "my", "your", "our", "their", "this", "that", "it",
-            "i", "me", "we", "you"
-        }
-
-        q_norm = normalize(message)
-
-        q_words = [
-            w for w in q_norm.split()
-            if len(w) > 2 and w not in stop_words
-        ]
-
-        if not q_words:
-            return None
-
-        scored = []
-
-        for row in rows:
-            content = row.get("content") or ""
-            content_norm = normalize(content)
-
-            score = 0
-
-            # Word overlap
-            for word in q_words:
-                if word in content_norm:
-                    score += 3
-
-            # Phrase overlap: much stronger than single words
-            for i in range(len(q_words) - 1):
-                phrase = f"{q_words[i]} {q_words[i + 1]}"
-                if phrase in content_norm:
-                    score += 10
-
-            # Three-word phrase overlap: strongest generic signal
-            for i in range(len(q_words) - 2):
-                phrase = f"{q_words[i]} {q_words[i + 1]} {q_words[i + 2]}"
-                if phrase in content_norm:
-                    score += 20
-
-            scored.append((score, row))
-
-        scored.sort(key=lambda x: x[0], reverse=True)
-
-        best_score, best_row = scored[0]
-
-        if best_score <= 0:
-            return None
+        PARTNER_CHUNK_INDEX.ensure_fresh(supabase_admin)
 
-        return best_row
+        return PARTNER_CHUNK_INDEX.best_overlap(message, allowed_partner_ids)
 
     except Exception as e:
         print("BEST TRIGGERED PARTNER CHUNK ERROR:", e)
         return None
 
-def choose_best_chunk_with_ai(message: str, chunks: list):
-    """
-    Uses AI only to select the best database chunk.
-    It does NOT generate or rewrite the answer.
-    It checks all chunks in batches, then does a final selection.
-    """
+CHUNK_RERANK_BATCH_SIZE = 20
 
-    if not chunks:
-        return None
+# First-pass batches run concurrently on a shared pool sized for several
+# messages at once (ceil(CHUNK_RERANK_TOP_N / batch size) batches each), so
+# one message's batches don't queue behind another's. Batches still running
+# at the deadline are dropped and the final pass uses the winners that
+# arrived; winners are always kept in batch order.
+CHUNK_RERANK_WORKERS = int(os.getenv("CHUNK_RERANK_WORKERS", "16"))
+CHUNK_RERANK_DEADLINE_SECONDS = float(os.getenv("CHUNK_RERANK_DEADLINE_SECONDS", "8"))
 
-    def extract_json(raw: str):
-        raw = raw.strip()
+_rerank_executor = ThreadPoolExecutor(
+    max_workers=CHUNK_RERANK_WORKERS,
+    thread_name_prefix="chunk-rerank"
+)
 
-        # Handles ```json ... ``` if the model ever returns it
-        raw = raw.replace("```json", "").replace("```", "").strip()
+def extract_json(raw: str):
+    raw = raw.strip()
 
-        match = re.search(r"\{.*\}", raw, re.DOTALL)
-        if not match:
-            return None
+    # Handles ```json ... ``` if the model ever returns it
+    raw = raw.replace("```json", "").replace("```", "").strip()
 
-        try:
-            return json.loads(match.group(0))
-        except Exception:
-            return None
+    match = re.search(r"\{.*\}", raw, re.DOTALL)
+    if not match:
+        return None
 
-    def pick_from_candidates(candidates: list):
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": (
-                            "You are a strict retrieval reranker.\n"
-                            "Your only job is to choose which database chunk best answers the user's question.\n"
-                            "Do not answer the question.\n"
-                            "Do not rewrite anything.\n\n"
-                            "Rules:\n"
-                            "- Choose the chunk that directly answers the user's exact question.\n"
-                            "- Do not choose a chunk only because it shares one keyword with the question.\n"
-                            "- If the user asks what something means, choose an explanatory/definition chunk.\n"
-                            "- If the user mentions a need, object, system, product, service, category, or equipment, prioritize chunks about that exact thing.\n"
-                            "- For 'who is' or 'what is' questions, prefer overview/definition chunks.\n"
-                            "- Do not choose a narrow capability, technical, pricing, insurance, network, troubleshooting, or safety chunk unless the user specifically asked about that topic.\n"
-                            "- If the user asks for the best provider, supplier, company, product source, or recommendation, the selected partner chunk MUST actually describe that requested category or service.\n"
-                            "- Never select a partner just because the user used words like 'best', 'provider', 'supplier', or 'recommend'.\n"
-                            "- If the requested category and the partner's actual offering are different, reject that chunk.\n"
-                            "- If none of the chunks directly answer the question, return null.\n\n"
-                            "Return JSON only:\n"
-                            "{\"index\": 0}\n"
-                            "or\n"
-                            "{\"index\": null}"
-                        )
-                    },
-                    {
-                        "role": "user",
-                        "content": json.dumps({
-                            "question": message,
-                            "chunks": candidates
-                        })
-                    }
-                ],
-                temperature=0
-            )
+    try:
+        return json.loads(match.group(0))
+    except Exception:
+        return None
 
-            raw = response.choices[0].message.content.strip()
-            data = extract_json(raw)
+def build_chunk_rerank_messages(message: str, candidates: list) -> list:
+    return [
+        {
+            "role": "system",
+            "content": (
+                "You are a strict retrieval reranker.\n"
+                "Your only job is to choose which database chunk best answers the user's question.\n"
+                "Do not answer the question.\n"
+                "Do not rewrite anything.\n\n"
+                "Rules:\n"
+                "- Choose the chunk that directly answers the user's exact question.\n"
+                "- Do not choose a chunk only because it shares one keyword with the question.\n"
+                "- If the user asks what something means, choose an explanatory/definition chunk.\n"
+                "- If the user mentions a need, object, system, product, service, category, or equipment, prioritize chunks about that exact thing.\n"
+                "- For 'who is' or 'what is' questions, prefer overview/definition chunks.\n"
+                "- Do not choose a narrow capability, technical, pricing, insurance, network, troubleshooting, or safety chunk unless the user specifically asked about that topic.\n"
+                "- If the user asks for the best provider, supplier, company, product source, or recommendation, the selected partner chunk MUST actually describe that requested category or service.\n"
+                "- Never select a partner just because the user used words like 'best', 'provider', 'supplier', or 'recommend'.\n"
+                "- If the requested category and the partner's actual offering are different, reject that chunk.\n"
+                "- If none of the chunks directly answer the question, return null.\n\n"
+                "Return JSON only:\n"
+                "{\"index\": 0}\n"
+                "or\n"
+                "{\"index\": null}"
+            )
+        },
+        {
+            "role": "user",
+            "content": json.dumps({
+                "question": message,
+                "chunks": candidates
+            })
+        }
+    ]
 
-            if not data:
-                return None
+def parse_chunk_pick(raw: str, candidates: list):
+    data = extract_json(raw)
 
-            index = data.get("index")
+    if not data:
+        return None
 
-            if index is None:
-                return None
+    index = data.get("index")
 
-            if not isinstance(index, int):
-                return None
+    if index is None:
+        return None
 
-            if index < 0 or index >= len(candidates):
-                return None
+    if not isinstance(index, int):
+        return None
 
-            return candidates[index]
+    if index < 0 or index >= len(candidates):
+        return None
 
-        except Exception as e:
-            print("CHUNK RERANK PICK ERROR:", e)
-            return None
+    return candidates[index]
 
-    # First pass: check ALL chunks in batches
-    batch_size = 20
-    winners = []
+def chunk_rerank_batches(chunks: list, batch_size: int = CHUNK_RERANK_BATCH_SIZE) -> list:
+    """
+    First-pass candidate lists: every chunk, in batches of batch_size.
+    """
+    batches = []
 
     for start in range(0, len(chunks), batch_size):
         batch = chunks[start:start + batch_size]
@@ -980,15 +925,17 @@ def choose_best_chunk_with_ai(message: str, chunks: list):
                 "content": (chunk.get("content") or "")[:1500]
             })
 
-        picked = pick_from_candidates(candidates)
+        batches.append(candidates)
 
-        if picked is not None:
-            winners.append(picked)
+    return batches
 
-    if not winners:
-        return None
+def chunk_rerank_winners(picks: list) -> list:
+    """
+    picks[i] is batch i's pick, or None if it picked nothing / timed out.
+    """
+    return [picked for picked in picks if picked is not None]
 
-    # Second pass: choose best winner from all batch winners
+def chunk_rerank_final_candidates(winners: list) -> list:
     final_candidates = []
 
     for i, winner in enumerate(winners):
@@ -998,8 +945,9 @@ def choose_best_chunk_with_ai(message: str, chunks: list):
             "content": winner["content"]
         })
 
-    final_pick = pick_from_candidates(final_candidates)
+    return final_candidates
 
+def resolve_chunk_pick(final_pick, chunks: list):
     if final_pick is None:
         return None
 
@@ -1010,177 +958,377 @@ def choose_best_chunk_with_ai(message: str, chunks: list):
 
     return chunks[global_index]
 
-def answer_from_triggered_partners(
-    message: str,
-    embedding,
-    triggered_partners: list,
-    user_role: str = "guest",
-    original_message: str = None
-):
+def choose_best_chunk_with_ai(message: str, chunks: list):
     """
-    Search only the partners that were triggered by keywords.
-    Then generate a clean answer instead of returning raw chunks.
+    Uses AI only to select the best database chunk.
+    It does NOT generate or rewrite the answer.
+    It checks the first CHUNK_RERANK_TOP_N chunks in batches, then does a
+    final selection, so at most ceil(N / batch size) + 1 calls are made.
     """
-    answer_question = original_message or message
-    partner_ids = {
-        str(p["partner_id"])
-        for p in triggered_partners
-        if p.get("partner_id") is not None
-    }
 
-    formatted_answers = []
+    chunks = chunks[:CHUNK_RERANK_TOP_N]
 
-# =====================================================
-# 0. Best partner chunk by AI reranking
-# =====================================================
-    try:
-        partner_chunks_resp = supabase_admin.table("partner_chunks") \
-            .select("id, partner_id, content") \
-            .in_("partner_id", list(partner_ids)) \
-            .execute()
+    if not chunks:
+        return None
 
-        partner_chunks = partner_chunks_resp.data or []
+    def pick_from_candidates(candidates: list):
+        found, picked = RERANK_CACHE.lookup(message, candidates)
 
-        best_chunk = choose_best_chunk_with_ai(message, partner_chunks)
+        if found:
+            return picked
 
-        if best_chunk:
-            partner_info = next(
-                p for p in triggered_partners
-                if str(p["partner_id"]) == str(best_chunk["partner_id"])
+        try:
+            response = client.chat.completions.create(
+                model=RERANK_MODEL,
+                messages=build_chunk_rerank_messages(message, candidates),
+                temperature=0
             )
 
-            clean_answer = generate_adaptive_partner_answer(
-                question=answer_question,
-                partner_name=partner_info["partner_name"],
-                context_chunks=[best_chunk["content"]]
-            )
+            raw = response.choices[0].message.content.strip()
+            picked = parse_chunk_pick(raw, candidates)
 
-            clean_answer = enforce_yes_no(answer_question, clean_answer)
+            RERANK_CACHE.store(message, candidates, picked)
+            return picked
 
-            return {
-                "answers": [
-                    {
-                        "partner_name": partner_info["partner_name"],
-                        "partner_id": best_chunk["partner_id"],
-                        "answer": clean_answer
-                    }
-                ],
-                "source": "partner_trigger_chunk_reranked",
-                "badge": "Partners",
-                "actions": ["ask_ai", "ask_specialist", "ask_ambassador"],
-                "requires_auth": False,
-                "new_title": None
-            }
+        except Exception as e:
+            print("CHUNK RERANK PICK ERROR:", e)
+            return None
 
-    except Exception as e:
-        print("TRIGGERED PARTNER CHUNK RERANK ERROR:", e)
-    question_lower = message.lower()
-    referral_intent_words = [
-        "where", "buy", "purchase", "supplier", "contact",
-        "who should", "who can", "recommend", "provider",
-        "company", "specialist", "partner", "help me"
+    # First pass: all batches concurrently, until the deadline
+    futures = [
+        _rerank_executor.submit(pick_from_candidates, candidates)
+        for candidates in chunk_rerank_batches(chunks)
     ]
 
-    has_referral_intent = any(w in question_lower for w in referral_intent_words)
+    done, pending = wait(futures, timeout=CHUNK_RERANK_DEADLINE_SECONDS)
 
-    # =====================================================
-    # 1. Try Partner QA first
-    # =====================================================
-    if embedding:
-        try:
-            qa_results = supabase_admin.rpc(
-                "match_partner_qa",
-                {
-                    "query_embedding": embedding,
-                    "match_threshold": 0.45,
-                    "match_count": 20
-                }
-            ).execute().data or []
-
-            qa_results = [
-                row for row in qa_results
-                if str(row.get("partner_id")) in partner_ids
-            ]
-
-            grouped_qa = {}
-
-            for row in qa_results:
-                grouped_qa.setdefault(row["partner_id"], []).append(row["answer"])
-
-            for partner_id, answers in grouped_qa.items():
-                partner_info = next(
-                    p for p in triggered_partners
-                    if str(p["partner_id"]) == str(partner_id)
-                )
+    for future in pending:
+        future.cancel()
 
-                partner_name = partner_info["partner_name"]
+    if pending:
+        print("CHUNK RERANK DEADLINE:", f"{len(pending)}/{len(futures)} batches dropped")
 
+    winners = chunk_rerank_winners([
+        future.result() if future in done else None
+        for future in futures
+    ])
 
-                exact_answer = answers[0]
+    if not winners:
+        return None
 
-                formatted_answers.append({
-                    "partner_name": partner_name,
-                    "partner_id": partner_id,
-                    "answer": exact_answer
-                })
-        except Exception as e:
-            print("TRIGGERED PARTNER QA ERROR:", e)
+    # Second pass: choose best winner from all batch winners
+    final_pick = pick_from_candidates(chunk_rerank_final_candidates(winners))
 
-    formatted_answers = keep_only_triggered_partner_answers(
-        formatted_answers,
-        triggered_partners
+    return resolve_chunk_pick(final_pick, chunks)
+
+def choose_best_chunk_locally(message: str, chunks: list):
+    """
+    BM25 + embedding cosine over the candidates; no LLM call.
+    """
+    return LOCAL_RERANKER.pick(supabase_admin, message, chunks)
+
+# Reranker name -> (question, chunks) -> chunk or None
+CHUNK_RERANKERS = {
+    "llm": choose_best_chunk_with_ai,
+    "local": choose_best_chunk_locally,
+}
+
+def choose_best_chunk(message: str, chunks: list):
+    """
+    Picks the reranker for the question's route (rerankers.CHUNK_RERANKER_ROUTES).
+    """
+    name = reranker_for(message)
+
+    return CHUNK_RERANKERS.get(name, choose_best_chunk_with_ai)(message, chunks)
+
+def chunk_rerank_candidates(retrieval: RetrievalSession, embedding, partner_ids: set) -> list:
+    """
+    Stage one of the chunk reranker: the triggered partners' chunks closest
+    to the query embedding, best first. Without an embedding, the first
+    CHUNK_RERANK_TOP_N rows of the partners' chunks.
+    """
+    if embedding:
+        return retrieval.query(
+            "match_partner_chunks",
+            CHUNK_RERANK_MIN_SIMILARITY,
+            CHUNK_RERANK_TOP_N,
+            partner_ids=partner_ids
+        )
+
+    return supabase_admin.table("partner_chunks") \
+        .select("id, partner_id, content") \
+        .in_("partner_id", list(partner_ids)) \
+        .order("id") \
+        .limit(CHUNK_RERANK_TOP_N) \
+        .execute().data or []
+
+PARTNER_ACTIONS = ["ask_ai", "ask_specialist", "ask_ambassador"]
+
+def triggered_partner_ids(triggered_partners: list) -> set:
+    return {
+        str(p["partner_id"])
+        for p in triggered_partners
+        if p.get("partner_id") is not None
+    }
+
+def find_triggered_partner(triggered_partners: list, partner_id):
+    return next(
+        p for p in triggered_partners
+        if str(p["partner_id"]) == str(partner_id)
     )
 
-    if formatted_answers:
-        return {
-            "answers": formatted_answers,
-            "source": "partner_trigger_qa",
-            "badge": "Partners",
-            "actions": ["ask_ai", "ask_specialist", "ask_ambassador"],
-            "requires_auth": False,
-            "new_title": None
-        }
+def group_rows_by_partner(rows: list, partner_ids: set, field: str) -> dict:
+    grouped = {}
+
+    for row in rows:
+        if str(row.get("partner_id")) in partner_ids:
+            grouped.setdefault(row["partner_id"], []).append(row[field])
+
+    return grouped
+
+def select_partner_doc_context(chunks: list, question: str) -> list:
+    cleaned = clean_chunks(chunks)
+    filtered = filter_chunks(cleaned, question)
+
+    return filtered[:3] if filtered else cleaned[:3]
+
+def partner_answers_response(answers: list, source: str) -> dict:
+    return {
+        "answers": answers,
+        "source": source,
+        "badge": "Partners",
+        "actions": list(PARTNER_ACTIONS),
+        "requires_auth": False,
+        "new_title": None
+    }
+
+def single_answer_response(answer: str, source: str, badge: str) -> dict:
+    return {
+        "answer": answer,
+        "source": source,
+        "badge": badge,
+        "actions": list(PARTNER_ACTIONS),
+        "requires_auth": False,
+        "new_title": None
+    }
+
+def partner_referral_response(triggered_partners: list) -> dict:
+    partner_info = triggered_partners[0]
+
+    partner_name = partner_info["partner_name"]
+    partner_id = partner_info["partner_id"]
+    matched_trigger = partner_info.get("trigger", "")
+
+    return partner_answers_response(
+        [
+            {
+                "partner_name": partner_name,
+                "partner_id": partner_id,
+                "answer": (
+                    f"For {matched_trigger or 'this requirement'}, "
+                    f"I'd recommend {partner_name}, one of TheBridge's partners. "
+                    f"They are the relevant partner for this area."
+                )
+            }
+        ],
+        "partner_trigger_referral"
+    )
+
+# -------------------------------
+# ROUTING DECISIONS
+# -------------------------------
+# Where a message goes, without any I/O. Shared by get_answer and
+# chat_async.get_answer_async, which only differ in how they call
+# Supabase / OpenAI.
+
+# (rpc, threshold, count) of the triggered partners' QA / docs lookups
+TRIGGERED_PARTNER_QA = ("match_partner_qa", 0.45, 20)
+TRIGGERED_PARTNER_DOCS = ("match_partner_chunks", 0.45, 30)
+
+# Best partner_docs similarity needed before the chunk reranker runs
+PARTNER_DOCS_RERANK_MIN_SIMILARITY = 0.45
+
+def partner_answer(partner_name: str, partner_id, answer) -> dict:
+    return {
+        "partner_name": partner_name,
+        "partner_id": partner_id,
+        "answer": answer
+    }
+
+def partner_routes(partner_name_matches: list, triggered_partners: list) -> list:
+    """
+    (stage, partners) for the partner router, strongest first. An exact
+    partner name match is strong; trigger words should help retrieval but
+    must not force a wrong partner, so they only run second.
+    """
+    return [
+        (stage, partners)
+        for stage, partners in (
+            ("partner_name", partner_name_matches),
+            ("partner_trigger", triggered_partners),
+        )
+        if partners
+    ]
+
+def triggered_partner_qa_answers(qa_results: list, triggered_partners: list) -> list:
+    """
+    The best stored answer of each triggered partner.
+    """
+    partner_ids = triggered_partner_ids(triggered_partners)
+    grouped_qa = group_rows_by_partner(qa_results, partner_ids, "answer")
+
+    answers = [
+        partner_answer(
+            find_triggered_partner(triggered_partners, partner_id)["partner_name"],
+            partner_id,
+            rows[0]
+        )
+        for partner_id, rows in grouped_qa.items()
+    ]
+
+    return keep_only_triggered_partner_answers(answers, triggered_partners)
+
+def triggered_partner_doc_contexts(doc_results: list, triggered_partners: list, question: str) -> list:
+    """
+    (partner_id, partner_name, context_chunks) for every triggered partner
+    with usable chunks; each gets its own generated answer.
+    """
+    partner_ids = triggered_partner_ids(triggered_partners)
+    contexts = []
+
+    for partner_id, chunks in group_rows_by_partner(doc_results, partner_ids, "content").items():
+        partner_info = find_triggered_partner(triggered_partners, partner_id)
+        selected_chunks = select_partner_doc_context(chunks, question)
+
+        if selected_chunks:
+            contexts.append((partner_id, partner_info["partner_name"], selected_chunks))
+
+    return contexts
+
+def triggered_partner_fallback(doc_answers: list, triggered_partners: list):
+    """
+    Last step of the triggered-partner route: the partners' doc answers,
+    else a referral to the partner that was clearly triggered.
+    """
+    doc_answers = keep_only_triggered_partner_answers(doc_answers, triggered_partners)
+
+    if doc_answers:
+        return partner_answers_response(doc_answers, "partner_trigger_docs")
+
+    if triggered_partners:
+        return partner_referral_response(triggered_partners)
+
+    return None
+
+def partner_docs_rerank_pool(semantic_results: list) -> list:
+    """
+    partner_docs rows for the chunk reranker, best first; none unless the
+    best row is similar enough.
+    """
+    semantic_results = sort_by_similarity(semantic_results)
+
+    if not semantic_results or row_similarity(semantic_results[0]) < PARTNER_DOCS_RERANK_MIN_SIMILARITY:
+        return []
+
+    return semantic_results
+
+def continuation_target(message: str, history: list):
+    """
+    The assistant message a low-information follow-up ("more", "why?")
+    continues, or None.
+    """
+    if not history or not is_low_information_query(message):
+        return None
+
+    return last_assistant_message(history)
+
+def troubleshooting_session(chat_id, message: str):
+    """
+    Id of the troubleshooting session this message continues, or None.
+    A message that has moved on ends the session.
+    """
+    user_id = str(chat_id) if chat_id else "guest_session"
+
+    if user_id not in TROUBLESHOOTING_SESSIONS:
+        return None
+
+    if not is_troubleshooting_candidate(message):
+        TROUBLESHOOTING_SESSIONS.pop(user_id, None)
+        return None
+
+    return user_id
+
+def answer_from_triggered_partners(
+    message: str,
+    embedding,
+    triggered_partners: list,
+    user_role: str = "guest",
+    original_message: str = None,
+    retrieval: RetrievalSession = None
+):
+    """
+    Search only the partners that were triggered by keywords.
+    Then generate a clean answer instead of returning raw chunks.
+    Reuses the caller's retrieval session so each corpus is queried once.
+    """
+    answer_question = original_message or message
+    partner_ids = triggered_partner_ids(triggered_partners)
+
+    if retrieval is None:
+        retrieval = RetrievalSession(supabase_admin, embedding)
 
     # =====================================================
-    # 2. Try Partner Docs second
+    # 0. Best partner chunk by AI reranking
+    # =====================================================
+    try:
+        partner_chunks = chunk_rerank_candidates(retrieval, embedding, partner_ids)
+
+        best_chunk = choose_best_chunk(message, partner_chunks)
+
+        if best_chunk:
+            partner_info = find_triggered_partner(triggered_partners, best_chunk["partner_id"])
+
+            clean_answer = generate_adaptive_partner_answer(
+                question=answer_question,
+                partner_name=partner_info["partner_name"],
+                context_chunks=[best_chunk["content"]]
+            )
+
+            clean_answer = enforce_yes_no(answer_question, clean_answer)
+
+            return partner_answers_response(
+                [partner_answer(partner_info["partner_name"], best_chunk["partner_id"], clean_answer)],
+                "partner_trigger_chunk_reranked"
+            )
+
+    except Exception as e:
+        print("TRIGGERED PARTNER CHUNK RERANK ERROR:", e)
+
+    # =====================================================
+    # 1. Try Partner QA first
     # =====================================================
     if embedding:
         try:
-            doc_results = supabase_admin.rpc(
-                "match_partner_chunks",
-                {
-                    "query_embedding": embedding,
-                    "match_threshold": 0.45,
-                    "match_count": 30
-                }
-            ).execute().data or []
-
-            doc_results = [
-                row for row in doc_results
-                if str(row.get("partner_id")) in partner_ids
-            ]
-
-            grouped_docs = {}
-
-            for row in doc_results:
-                grouped_docs.setdefault(row["partner_id"], []).append(row["content"])
-
-            for partner_id, chunks in grouped_docs.items():
-                partner_info = next(
-                    p for p in triggered_partners
-                    if str(p["partner_id"]) == str(partner_id)
-                )
+            qa_results = retrieval.query(*TRIGGERED_PARTNER_QA, partner_ids=partner_ids)
+            qa_answers = triggered_partner_qa_answers(qa_results, triggered_partners)
 
-                partner_name = partner_info["partner_name"]
-
-                cleaned = clean_chunks(chunks)
-                filtered = filter_chunks(cleaned, message)
+            if qa_answers:
+                return partner_answers_response(qa_answers, "partner_trigger_qa")
+        except Exception as e:
+            print("TRIGGERED PARTNER QA ERROR:", e)
 
-                selected_chunks = filtered[:3] if filtered else cleaned[:3]
+    # =====================================================
+    # 2. Try Partner Docs second
+    # =====================================================
+    doc_answers = []
 
-                if not selected_chunks:
-                    continue
+    if embedding:
+        try:
+            doc_results = retrieval.query(*TRIGGERED_PARTNER_DOCS, partner_ids=partner_ids)
 
+            for partner_id, partner_name, selected_chunks in triggered_partner_doc_contexts(
+                doc_results, triggered_partners, message
+            ):
                 clean_answer = generate_adaptive_partner_answer(
                     question=answer_question,
                     partner_name=partner_name,
@@ -1188,65 +1336,15 @@ def answer_from_triggered_partners(
                 )
 
                 clean_answer = enforce_yes_no(answer_question, clean_answer)
-
-                formatted_answers.append({
-                    "partner_name": partner_name,
-                    "partner_id": partner_id,
-                    "answer": clean_answer
-                })
+                doc_answers.append(partner_answer(partner_name, partner_id, clean_answer))
 
         except Exception as e:
             print("TRIGGERED PARTNER DOC ERROR:", e)
 
-    formatted_answers = keep_only_triggered_partner_answers(
-        formatted_answers,
-        triggered_partners
-    )
-
-    if formatted_answers:
-        return {
-            "answers": formatted_answers,
-            "source": "partner_trigger_docs",
-            "badge": "Partners",
-            "actions": ["ask_ai", "ask_specialist", "ask_ambassador"],
-            "requires_auth": False,
-            "new_title": None
-        }
-
     # =====================================================
     # 3. Partner was clearly triggered, but no answer found
     # =====================================================
-    if triggered_partners:
-        partner_info = triggered_partners[0]
-
-        partner_name = partner_info["partner_name"]
-        partner_id = partner_info["partner_id"]
-        matched_trigger = partner_info.get("trigger", "")
-
-        return {
-            "answers": [
-                {
-                    "partner_name": partner_name,
-                    "partner_id": partner_id,
-                    "answer": (
-                        f"For {matched_trigger or 'this requirement'}, "
-                        f"I'd recommend {partner_name}, one of TheBridge's partners. "
-                        f"They are the relevant partner for this area."
-                    )
-                }
-            ],
-            "source": "partner_trigger_referral",
-            "badge": "Partners",
-            "actions": [
-                "ask_ai",
-                "ask_specialist",
-                "ask_ambassador"
-            ],
-            "requires_auth": False,
-            "new_title": None
-        }
-
-    return None
+    return triggered_partner_fallback(doc_answers, triggered_partners)
 
 def detect_system(message: str):
     msg = message.lower()
@@ -1274,255 +1372,177 @@ def is_low_information_query(message: str) -> bool:
 
     return msg in vague_phrases
 
-def get_answer(message: str, user_role: str = "guest", chat_id: int = None, history: list = None):
+def last_assistant_message(history: list):
+    for msg in reversed(history):
+        if msg["role"] == "assistant":
+            return msg["content"]
 
-    user_norm = normalize(message)
+    return None
 
-    # =====================================================
-    # 1️⃣ HISTORY
-    # =====================================================
-    if not chat_id:
-        history = history or []
-    else:
-        history = get_chat_history(chat_id)
+def build_continuation_messages(last_assistant: str, message: str) -> list:
+    return [
+        {
+            "role": "system",
+            "content": (
+                "Continue the previous answer using ONLY the same topic and context. "
+                "Do not introduce new entities or guess unrelated meanings."
+            )
+        },
+        {
+            "role": "assistant",
+            "content": last_assistant
+        },
+        {
+            "role": "user",
+            "content": message
+        }
+    ]
 
-    print("HISTORY DEBUG:", history)
-    answer_found = False
+def build_fallback_messages(message: str, history: list) -> list:
+    messages = [{"role": "system", "content": BASE_SYSTEM_PROMPT}]
+    messages.extend(history)
+    messages.append({"role": "user", "content": message})
 
-        # Generic context-aware retrieval question
-    retrieval_question = rewrite_followup_question(message, history)
+    return messages
 
-    print("RETRIEVAL QUESTION DEBUG:", retrieval_question)
+YACHTING_KEYWORDS = [
+    "yacht", "crew", "captain", "flag", "port state",
+    "manning", "inspection", "maritime"
+]
 
-    # =====================================================
-# 🔥 CONTEXT CONTINUATION
-# =====================================================
-    if is_low_information_query(message) and history:
+AI_TEMPORARY_ERROR = "⚠️ AI temporary error. Please try again."
 
-        last_assistant = None
+def is_yachting_question(user_norm: str) -> bool:
+    return any(k in user_norm for k in YACHTING_KEYWORDS)
 
-        for msg in reversed(history):
-            if msg["role"] == "assistant":
-                last_assistant = msg["content"]
-                break
+def search_text(retrieval_question: str) -> str:
+    """
+    Text that is embedded for retrieval.
+    """
+    return normalize_question_for_search(enrich_question(retrieval_question))
 
-        if last_assistant:
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": (
-                            "Continue the previous answer using ONLY the same topic and context. "
-                            "Do not introduce new entities or guess unrelated meanings."
-                        )
-                    },
-                    {
-                        "role": "assistant",
-                        "content": last_assistant
-                    },
-                    {
-                        "role": "user",
-                        "content": message
-                    }
-                ],
-                temperature=0.3
-            )
+def row_similarity(row: dict):
+    return row.get("similarity", row.get("score", 0))
 
-            return {
-                "answer": response.choices[0].message.content.strip(),
-                "source": "continuation",
-                "actions": [],
-                "requires_auth": False, 
-                "new_title": None
-            }
+def sort_by_similarity(rows: list) -> list:
+    return sorted(rows, key=row_similarity, reverse=True)
 
-    # =====================================================
-    # 2️⃣ EMBEDDING
-    # =====================================================
-    try:
-        cleaned_question = normalize_question_for_search(
-            enrich_question(retrieval_question)
-        )
+def select_bridge_context(rows: list, field: str, message: str) -> list:
+    cleaned = clean_chunks([row[field] for row in rows])
+    filtered = filter_chunks(cleaned, message)
 
-        embedding = client.embeddings.create(
-            model="text-embedding-3-small",
-            input=cleaned_question
-        ).data[0].embedding
-    except Exception as e:
-        print("EMBEDDING ERROR:", e)
-        embedding = None
+    if field == "answer":
+        filtered = [remove_redundant_prefixes(c) for c in filtered]
 
-    # =====================================================
-    # 🔥 PARTNER NAME / TRIGGER ROUTER
-    # =====================================================
+    return filtered
 
-    # Exact partner name match is strong.
-    partner_name_matches = get_partner_name_match(retrieval_question)
+def plain_answer_response(answer: str, source: str) -> dict:
+    return {
+        "answer": answer,
+        "source": source,
+        "actions": [],
+        "requires_auth": False,
+        "new_title": None
+    }
 
-    if partner_name_matches:
-        result = answer_from_triggered_partners(
-            message=retrieval_question,
-            embedding=embedding,
-            triggered_partners=partner_name_matches,
-            user_role=user_role,
-            original_message=message
-        )
+def troubleshooting_response(troubleshoot: dict) -> dict:
+    return {
+        "answer": troubleshoot["answer"],
+        "source": troubleshoot["source"],
+        "badge": troubleshoot.get("badge"),
+        "actions": [],
+        "requires_auth": False,
+        "new_title": None
+    }
 
-        if result:
-            return result
-    # Trigger words are weaker than partner names.
-    # They should help retrieval, but must not force a wrong partner.
-    triggered_partners = get_partner_trigger_matches(retrieval_question)
+def no_answer_response(user_role: str) -> dict:
+    return {
+        "answer": NO_ANSWER_FALLBACK,
+        "source": "no_answer",
+        "actions": list(PARTNER_ACTIONS),
+        "requires_auth": user_role == "guest",
+        "new_title": None
+    }
 
-    print("PARTNER NAME MATCHES DEBUG:", partner_name_matches)
-    print("TRIGGERED PARTNERS DEBUG:", triggered_partners)
+def answer_from_knowledge_base(
+    message: str,
+    retrieval_question: str,
+    embedding,
+    history: list,
+    user_role: str,
+    partner_name_matches: list,
+    triggered_partners: list
+):
+    """
+    Partner routes and the four retrieval stages of get_answer.
+    Returns None when nothing in TheBridge's knowledge base answers the question.
+    """
+    # One retrieval session per message, shared with the partner routes
+    retrieval = RetrievalSession(supabase_admin, embedding)
 
-    if triggered_partners:
+    # =====================================================
+    # 🔥 PARTNER NAME / TRIGGER ROUTER
+    # =====================================================
+    for stage, partners in partner_routes(partner_name_matches, triggered_partners):
         result = answer_from_triggered_partners(
             message=retrieval_question,
             embedding=embedding,
-            triggered_partners=triggered_partners,
+            triggered_partners=partners,
             user_role=user_role,
-            original_message=message
+            original_message=message,
+            retrieval=retrieval
         )
 
         if result:
+            retrieval.finish(stage)
             return result
+
+    # Only now, in parallel mode, query every corpus at once
+    retrieval.prefetch()
+
     # =====================================================
     # 3️⃣ PARTNER QA (FIRST PRIORITY)
     # =====================================================
     if embedding:
-        try:
-            qa_results = supabase_admin.rpc(
-                "match_partner_qa",
-                {
-                    "query_embedding": embedding,
-                    "match_threshold": 0.45,  # slightly lower for better trigger
-                    "match_count": 5
-                }
-            ).execute().data
-        except Exception as e:
-            print("PARTNER QA ERROR:", e)
-            qa_results = []
+        qa_results = retrieval.results("partner_qa")
 
         if qa_results:
-            qa_results = sorted(
-                qa_results,
-                key=lambda r: r.get("similarity", r.get("score", 0)),
-                reverse=True
-            )
-
-            row = qa_results[0]
-            try:
-                partner = supabase_admin.table("partners") \
-                    .select("badge_label") \
-                    .eq("id", row["partner_id"]) \
-                    .single() \
-                    .execute()
-
-                partner_name = partner.data["badge_label"] if partner.data else "Partner"
-            except Exception as e:
-                print("PARTNER FETCH ERROR:", e)
-                partner_name = "Partner"
+            row = sort_by_similarity(qa_results)[0]
+            partner_name = get_partner_badge(row["partner_id"])
 
             answer = enforce_yes_no(message, row["answer"])
+            retrieval.finish("partner_qa")
 
-            return {
-                "answer": answer,
-                "source": "partner_qa",
-                "badge": partner_name,
-                "actions": ["ask_ai", "ask_specialist", "ask_ambassador"],
-                "requires_auth": False,
-                "new_title": None
-            }
+            return single_answer_response(answer, "partner_qa", partner_name)
 
     # =====================================================
     # 4️⃣ THEBRIDGE QA
     # =====================================================
     if embedding:
-        try:
-            bridge_qa = supabase_admin.rpc(
-                "match_bridge_qa",
-                {
-                    "query_embedding": embedding,
-                    "match_threshold": 0.65,
-                    "match_count": 5
-                }
-            ).execute().data
-        except Exception as e:
-            print("BRIDGE QA ERROR:", e)
-            bridge_qa = []
+        bridge_qa = retrieval.results("bridge_qa")
 
         if bridge_qa:
-            chunks = [row["answer"] for row in bridge_qa]
-            cleaned = clean_chunks(chunks)
-            filtered = filter_chunks(cleaned, message)
-            filtered = [remove_redundant_prefixes(c) for c in filtered]
+            filtered = select_bridge_context(bridge_qa, "answer", message)
+            retrieval.finish("bridge_qa")
 
             answer = generate_contextual_answer(message, filtered, history)
             answer = enforce_yes_no(message, answer)
 
-            return {
-                "answer": answer,
-                "source": "bridge_semantic_raw",
-                "badge": "TheBridge",
-                "actions": ["ask_ai", "ask_specialist", "ask_ambassador"],
-                "requires_auth": False,
-                "new_title": None
-            }
+            return single_answer_response(answer, "bridge_semantic_raw", "TheBridge")
 
     # =====================================================
 # 5️⃣ PARTNER DOCS
 # =====================================================
     if embedding:
-        try:
-            semantic_results = supabase_admin.rpc(
-                "match_partner_chunks",
-                {
-                    "query_embedding": embedding,
-                    "match_threshold": 0.30,
-                    "match_count": 40
-                }
-            ).execute().data
-        except Exception as e:
-            print("PARTNER DOC ERROR:", e)
-            semantic_results = []
-
-        if semantic_results:
-            semantic_results = sorted(
-                semantic_results,
-                key=lambda r: r.get("similarity", r.get("score", 0)),
-                reverse=True
-            )
-
-            top_similarity = semantic_results[0].get(
-                "similarity",
-                semantic_results[0].get("score", 0)
-            )
+        rerank_pool = partner_docs_rerank_pool(retrieval.results("partner_docs"))
 
-            if top_similarity >= 0.45:
-                best_chunk = choose_best_chunk_with_ai(
-                    retrieval_question,
-                    semantic_results
-                )
-            else:
-                best_chunk = None
+        if rerank_pool:
+            best_chunk = choose_best_chunk(retrieval_question, rerank_pool)
 
             if best_chunk:
                 best_partner_id = best_chunk["partner_id"]
-
-                try:
-                    partner = supabase_admin.table("partners") \
-                        .select("badge_label") \
-                        .eq("id", best_partner_id) \
-                        .single() \
-                        .execute()
-
-                    partner_name = partner.data["badge_label"] if partner.data else "Partner"
-                except Exception as e:
-                    print("PARTNER FETCH ERROR:", e)
-                    partner_name = "Partner"
+                partner_name = get_partner_badge(best_partner_id)
+                retrieval.finish("partner_docs")
 
                 clean_answer = generate_adaptive_partner_answer(
                     question=message,
@@ -1532,122 +1552,173 @@ def get_answer(message: str, user_role: str = "guest", chat_id: int = None, hist
 
                 clean_answer = enforce_yes_no(message, clean_answer)
 
-                return {
-                    "answers": [
-                        {
-                            "partner_name": partner_name,
-                            "partner_id": best_partner_id,
-                            "answer": clean_answer
-                        }
-                    ],
-                    "source": "partner_docs_reranked",
-                    "badge": "Partners",
-                    "actions": ["ask_ai", "ask_specialist", "ask_ambassador"],
-                    "requires_auth": False,
-                    "new_title": None
-                }
+                return partner_answers_response(
+                    [partner_answer(partner_name, best_partner_id, clean_answer)],
+                    "partner_docs_reranked"
+                )
     # =====================================================
     # 6️⃣ THEBRIDGE DOCS
     # =====================================================
     if embedding:
-        try:
-            bridge_results = supabase_admin.rpc(
-                "match_bridge_chunks",
-                {
-                    "query_embedding": embedding,
-                    "match_threshold": 0.55,
-                    "match_count": 8
-                }
-            ).execute().data
-        except Exception as e:
-            print("BRIDGE DOC ERROR:", e)
-            bridge_results = []
+        bridge_results = retrieval.results("bridge_docs")
 
         if bridge_results:
-            chunks = [row["content"] for row in bridge_results]
-            cleaned = clean_chunks(chunks)
-            filtered = filter_chunks(cleaned, message)
+            retrieval.finish("bridge_docs")
+            filtered = select_bridge_context(bridge_results, "content", message)
 
             answer = generate_contextual_answer(message, filtered, history)
             answer = enforce_yes_no(message, answer)
 
-            return {
-                "answer": answer,
-                "source": "bridge_docs_raw",
-                "badge": "TheBridge",
-                "actions": ["ask_ai", "ask_specialist", "ask_ambassador"],
-                "requires_auth": False,
-                "new_title": None
-            }
+            return single_answer_response(answer, "bridge_docs_raw", "TheBridge")
+
+    retrieval.finish()
+    return None
+
+def get_answer(message: str, user_role: str = "guest", chat_id: int = None, history: list = None):
+
+    user_norm = normalize(message)
+
+    # =====================================================
+    # 1️⃣ HISTORY
+    # =====================================================
+    if not chat_id:
+        history = history or []
+    else:
+        history = get_chat_history(chat_id)
+
+    history = compact_history(chat_id, history)
+
+    print("HISTORY DEBUG:", history)
+    answer_found = False
+
+        # Generic context-aware retrieval question
+    retrieval_question = rewrite_followup_question(message, history)
+
+    print("RETRIEVAL QUESTION DEBUG:", retrieval_question)
+
+    # =====================================================
+# 🔥 CONTEXT CONTINUATION
+# =====================================================
+    last_assistant = continuation_target(message, history)
+
+    if last_assistant:
+        response = client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=build_continuation_messages(last_assistant, message),
+            temperature=0.3
+        )
+
+        return plain_answer_response(
+            response.choices[0].message.content.strip(),
+            "continuation"
+        )
+
+    # =====================================================
+    # 2️⃣ EMBEDDING
+    # =====================================================
+    try:
+        embedding = EMBEDDINGS.embed(client, search_text(retrieval_question))
+    except Exception as e:
+        print("EMBEDDING ERROR:", e)
+        embedding = None
+
+    # =====================================================
+    # 🔥 PARTNER NAME / TRIGGER MATCHES
+    # =====================================================
+    partner_name_matches = get_partner_name_match(retrieval_question)
+    triggered_partners = get_partner_trigger_matches(retrieval_question)
+
+    print("PARTNER NAME MATCHES DEBUG:", partner_name_matches)
+    print("TRIGGERED PARTNERS DEBUG:", triggered_partners)
+
+    # =====================================================
+    # 🔥 SEMANTIC ANSWER CACHE
+    # =====================================================
+    cache_route = answer_cache_route(partner_name_matches, triggered_partners)
+    use_answer_cache = answer_cache_applies(message, retrieval_question, embedding)
+
+    if use_answer_cache:
+        ANSWER_CACHE.check_version(supabase_admin)
+        cached = ANSWER_CACHE.lookup(cache_route, embedding)
+
+        if cached:
+            return cached
+
+    result = answer_from_knowledge_base(
+        message,
+        retrieval_question,
+        embedding,
+        history,
+        user_role,
+        partner_name_matches,
+        triggered_partners
+    )
+
+    if result:
+        if use_answer_cache:
+            ANSWER_CACHE.store(cache_route, embedding, result)
+
+        return result
 
     # =====================================================
     # 7️⃣ TROUBLESHOOTING + FALLBACK + AI
     # =====================================================
-    user_id = str(chat_id) if chat_id else "guest_session"
+    session_id = troubleshooting_session(chat_id, message)
 
-    if user_id in TROUBLESHOOTING_SESSIONS:
-        if not is_troubleshooting_candidate(message):
-            TROUBLESHOOTING_SESSIONS.pop(user_id, None)
-        else:
-            troubleshoot = run_troubleshooting(user_id, message, supabase_admin)
-            if troubleshoot:
-                return {
-                    "answer": troubleshoot["answer"],
-                    "source": troubleshoot["source"],
-                    "badge": troubleshoot.get("badge"),
-                    "actions": [],
-                    "requires_auth": False,
-                    "new_title": None
-                }
-
-    yachting_keywords = [
-        "yacht", "crew", "captain", "flag", "port state",
-        "manning", "inspection", "maritime"
-    ]
+    if session_id:
+        troubleshoot = run_troubleshooting(session_id, message, supabase_admin)
+        if troubleshoot:
+            return troubleshooting_response(troubleshoot)
 
-    if any(k in user_norm for k in yachting_keywords):
-        return {
-            "answer": NO_ANSWER_FALLBACK,
-            "source": "no_answer",
-            "actions": ["ask_ai", "ask_specialist", "ask_ambassador"],
-            "requires_auth": user_role == "guest",
-            "new_title": None
-        }
+    if is_yachting_question(user_norm):
+        return no_answer_response(user_role)
 
     # AI fallback
-    messages = [{"role": "system", "content": BASE_SYSTEM_PROMPT}]
-    messages.extend(history)
-    messages.append({"role": "user", "content": message})
-
     try:
         response = client.chat.completions.create(
             model="gpt-4o-mini",
-            messages=messages,
+            messages=build_fallback_messages(message, history),
             temperature=0.7
         )
         answer = response.choices[0].message.content.strip()
         answer = enforce_yes_no(message, answer)
     except Exception as e:
         print("OPENAI ERROR:", e)
-        answer = "⚠️ AI temporary error. Please try again."
+        answer = AI_TEMPORARY_ERROR
 
-    return {
-        "answer": answer,
-        "source": "openai_general",
-        "actions": [],
-        "requires_auth": False,
-        "new_title": None
-    }
+    return plain_answer_response(answer, "openai_general")
 
-def save_message(chat_id, role, content, source, user_email=None, partner_name=None):
-    supabase_admin.table("chat_messages").insert({
+def message_row(chat_id, role, content, source, user_email=None, partner_name=None) -> dict:
+    return {
         "chat_id": chat_id,
         "user_email": user_email,
         "role": role,
         "content": content,
         "source": source,
-        "partner_name": partner_name 
-    }).execute()
+        "partner_name": partner_name
+    }
+
+def pending_messages(chat_id) -> list:
+    """
+    Messages of the chat accepted by MESSAGE_LOG but not written yet.
+    """
+    return MESSAGE_LOG.pending(lambda row: row.get("chat_id") == chat_id)
+
+def wait_for_pending_messages(chat_id, timeout: float = 5) -> bool:
+    """
+    Waits for rows of the chat that the flusher is already writing.
+    """
+    return MESSAGE_LOG.wait(lambda row: row.get("chat_id") == chat_id, timeout)
+
+def save_message(chat_id, role, content, source, user_email=None, partner_name=None):
+    row = message_row(chat_id, role, content, source, user_email, partner_name)
+
+    if MESSAGE_LOG_ENABLED:
+        MESSAGE_LOG.append(row)
+    else:
+        supabase_admin.table("chat_messages").insert(row).execute()
+
+    HISTORY_BUFFER.append(chat_id, role, content)
 
 def track_click(
     chat_id: Optional[int],
@@ -1658,18 +1729,15 @@ def track_click(
 ):
 
     """
-    Stores button click analytics in user_clicks table
+    Queues button click analytics for the user_clicks table
     """
-    try:
-        supabase_admin.table("user_clicks").insert({
-            "chat_id": chat_id,
-            "user_email": user_email,
-            "user_type": "user" if user_role != "guest" else "guest",
-            "button": button,
-            "question": question
-        }).execute()
-    except Exception as e:
-        print("❌ CLICK TRACK ERROR:", e)
+    ANALYTICS.track(ClickEvent(
+        chat_id=chat_id,
+        button=button,
+        question=question,
+        user_email=user_email,
+        user_type=user_type(user_role)
+    ))
 
 
 # -------------------------------
@@ -0,0 +1,795 @@
+# chat_async.py
+#
+# Async twin of the chat.get_answer pipeline.
+# Uses AsyncOpenAI and the async Supabase client so an in-flight chat
+# does not hold a worker thread while it waits on the network.
+# Prompts, routing rules and response shapes are shared with chat.py.
+
+import asyncio
+import contextvars
+import os
+from contextlib import contextmanager
+from openai import AsyncOpenAI
+from supabase import acreate_client, AsyncClient
+
+from chat import (
+    OPENAI_API_KEY,
+    SUPABASE_URL,
+    SUPABASE_SERVICE_ROLE_KEY,
+    NO_ANSWER_FALLBACK,
+    AI_TEMPORARY_ERROR,
+    supabase_admin,
+    normalize,
+    search_text,
+    history_from_rows,
+    message_row,
+    pending_messages,
+    MESSAGE_LOG,
+    MESSAGE_LOG_ENABLED,
+    build_ai_only_messages,
+    build_followup_rewrite_messages,
+    build_contextual_answer_messages,
+    build_adaptive_partner_messages,
+    build_chunk_rerank_messages,
+    build_continuation_messages,
+    build_fallback_messages,
+    build_history_summary_messages,
+    choose_best_chunk_locally,
+    parse_chunk_pick,
+    chunk_rerank_batches,
+    chunk_rerank_winners,
+    CHUNK_RERANK_DEADLINE_SECONDS,
+    chunk_rerank_final_candidates,
+    resolve_chunk_pick,
+    enforce_yes_no,
+    is_yes_no_question,
+    yes_no_prefix,
+    is_yachting_question,
+    triggered_partner_ids,
+    find_triggered_partner,
+    select_bridge_context,
+    sort_by_similarity,
+    partner_answers_response,
+    single_answer_response,
+    plain_answer_response,
+    troubleshooting_response,
+    no_answer_response,
+    partner_answer,
+    partner_routes,
+    TRIGGERED_PARTNER_QA,
+    TRIGGERED_PARTNER_DOCS,
+    triggered_partner_qa_answers,
+    triggered_partner_doc_contexts,
+    triggered_partner_fallback,
+    partner_docs_rerank_pool,
+    continuation_target,
+    troubleshooting_session,
+)
+from partners import PARTNER_TRIGGERS, PARTNER_DIRECTORY
+from retrieval import AsyncRetrievalSession, CHUNK_RERANK_TOP_N, CHUNK_RERANK_MIN_SIMILARITY
+from embedding_cache import EMBEDDINGS
+from answer_cache import ANSWER_CACHE, answer_cache_route, answer_cache_applies
+from rerank_cache import RERANK_CACHE
+from rerankers import reranker_for
+from followup import REWRITES, local_rewrite
+from chat_history import HISTORY_BUFFER, HISTORY_COMPACTOR, HISTORY_TAIL_ROWS, history_key
+from troubleshooting import run_troubleshooting
+
+# -------------------------------
+# CLIENTS
+# -------------------------------
+async_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+_async_supabase = None
+_async_supabase_lock = asyncio.Lock()
+
+
+async def get_async_supabase() -> AsyncClient:
+    global _async_supabase
+
+    if _async_supabase is None:
+        async with _async_supabase_lock:
+            if _async_supabase is None:
+                _async_supabase = await acreate_client(
+                    SUPABASE_URL,
+                    SUPABASE_SERVICE_ROLE_KEY
+                )
+
+    return _async_supabase
+
+
+async def _complete(messages: list, temperature: float) -> str:
+    response = await async_client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=messages,
+        temperature=temperature
+    )
+
+    return response.choices[0].message.content.strip()
+
+
+# -------------------------------
+# STREAMING
+# -------------------------------
+# Characters of a streamed answer buffered to decide its Yes/No prefix
+# (cut short at the first sentence end)
+YES_NO_HEAD_CHARS = int(os.getenv("YES_NO_HEAD_CHARS", "160"))
+
+# Set by deferred_generation(): answer generation returns a DeferredAnswer
+# instead of waiting for the full completion
+DEFER_GENERATION = contextvars.ContextVar("defer_generation", default=False)
+
+
+@contextmanager
+def deferred_generation():
+    token = DEFER_GENERATION.set(True)
+
+    try:
+        yield
+    finally:
+        DEFER_GENERATION.reset(token)
+
+
+class DeferredAnswer:
+    """
+    An answer whose completion has not been requested yet.
+    stream() yields its text as the model produces it; if the completion
+    fails it stops and sets failed, and the text so far must not be kept.
+    """
+
+    def __init__(self, messages: list, temperature: float):
+        self.messages = messages
+        self.temperature = temperature
+        self.yes_no_question = None
+        self.failed = False
+
+    async def _deltas(self):
+        response = await async_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=self.messages,
+            temperature=self.temperature,
+            stream=True
+        )
+
+        async for chunk in response:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+
+            if delta:
+                yield delta
+
+    async def stream(self):
+        """
+        Same text as _complete + enforce_yes_no, except that the Yes/No
+        prefix is decided from the first sentence instead of the whole answer.
+        """
+        question = self.yes_no_question
+        decided = question is None or not is_yes_no_question(question)
+        head = ""
+        emitted = False
+
+        try:
+            async for delta in self._deltas():
+                if not emitted:
+                    delta = delta.lstrip()
+
+                    if not delta:
+                        continue
+
+                if decided:
+                    emitted = True
+                    yield delta
+                    continue
+
+                head += delta
+
+                if len(head) >= YES_NO_HEAD_CHARS or any(c in head for c in ".!?\n"):
+                    decided = True
+                    emitted = True
+                    yield yes_no_prefix(question, head) + head
+
+            if not decided and head:
+                yield yes_no_prefix(question, head) + head
+
+        except Exception as e:
+            print("OPENAI STREAM ERROR:", e)
+            self.failed = True
+
+
+async def _generate(messages: list, temperature: float):
+    """
+    Answer generation: the full text, or a DeferredAnswer when streaming.
+    """
+    if DEFER_GENERATION.get():
+        return DeferredAnswer(messages, temperature)
+
+    return await _complete(messages, temperature)
+
+
+def _yes_no(question: str, answer):
+    if isinstance(answer, DeferredAnswer):
+        answer.yes_no_question = question
+        return answer
+
+    return enforce_yes_no(question, answer)
+
+
+def has_deferred_answers(result: dict) -> bool:
+    answers = result.get("answers") or [result]
+
+    return any(isinstance(a.get("answer"), DeferredAnswer) for a in answers)
+
+
+async def stream_answer_events(result: dict):
+    """
+    Yields (event, data) for a get_answer result: "meta" with the routing
+    fields, "token" text deltas per answer index, then "done" with the
+    complete result. Answers that are already text come as one token.
+
+    If any answer's stream fails the last event is "error" instead of
+    "done": the partial result is neither cached nor returned for saving.
+    """
+    answer_cache = result.pop("_answer_cache", None)
+    answers = result.get("answers")
+
+    meta = {k: v for k, v in result.items() if k not in ("answer", "answers")}
+
+    if answers is not None:
+        meta["answers"] = [
+            {"partner_name": a.get("partner_name"), "partner_id": a.get("partner_id")}
+            for a in answers
+        ]
+
+    yield "meta", meta
+
+    for index, slot in enumerate(answers if answers is not None else [result]):
+        answer = slot.get("answer")
+
+        if isinstance(answer, DeferredAnswer):
+            parts = []
+
+            async for delta in answer.stream():
+                parts.append(delta)
+                yield "token", {"index": index, "text": delta}
+
+            if answer.failed:
+                yield "error", {"answer": AI_TEMPORARY_ERROR, "source": "error"}
+                return
+
+            slot["answer"] = "".join(parts)
+
+        elif answer:
+            yield "token", {"index": index, "text": answer}
+
+    if answer_cache:
+        ANSWER_CACHE.store(*answer_cache, result)
+
+    yield "done", result
+
+
+# -------------------------------
+# PARTNER INDEXES
+# -------------------------------
+async def _ensure_fresh(index):
+    # Index refreshes use the sync client; keep them off the event loop
+    if index.is_stale():
+        await asyncio.to_thread(index.ensure_fresh, supabase_admin)
+
+
+async def get_partner_name_match_async(message: str):
+    try:
+        await _ensure_fresh(PARTNER_DIRECTORY)
+        return PARTNER_DIRECTORY.match_names(supabase_admin, message)
+
+    except Exception as e:
+        print("PARTNER NAME MATCH ERROR:", e)
+        return []
+
+
+async def get_partner_trigger_matches_async(message: str):
+    try:
+        await _ensure_fresh(PARTNER_TRIGGERS)
+        return PARTNER_TRIGGERS.match(supabase_admin, message)
+
+    except Exception as e:
+        print("PARTNER TRIGGER MATCH ERROR:", e)
+        return []
+
+
+async def get_partner_badge_async(partner_id) -> str:
+    try:
+        await _ensure_fresh(PARTNER_DIRECTORY)
+    except Exception as e:
+        print("PARTNER FETCH ERROR:", e)
+
+    # badge_label() would retry the refresh on this thread when it failed
+    _, badges, _ = PARTNER_DIRECTORY.state
+    return badges.get(str(partner_id), "Partner")
+
+
+# -------------------------------
+# HISTORY / PERSISTENCE
+# -------------------------------
+async def get_chat_history_async(chat_id: int):
+    history = HISTORY_BUFFER.get(chat_id)
+
+    if history is not None:
+        return history
+
+    try:
+        db = await get_async_supabase()
+
+        resp = await db.table("chat_messages") \
+            .select("role, content") \
+            .eq("chat_id", chat_id) \
+            .order("id", desc=True) \
+            .limit(HISTORY_TAIL_ROWS) \
+            .execute()
+
+        rows = list(reversed(resp.data or [])) + pending_messages(chat_id)
+
+        history = history_from_rows(rows)
+        HISTORY_BUFFER.load(chat_id, history)
+
+        return history
+
+    except Exception as e:
+        print("HISTORY ERROR:", e)
+        return []
+
+
+async def summarize_history_async(previous_summary: str, messages: list) -> str:
+    return await _complete(
+        build_history_summary_messages(previous_summary, messages),
+        temperature=0
+    )
+
+
+async def compact_history_async(chat_id, history: list) -> list:
+    return await HISTORY_COMPACTOR.acompact(
+        history_key(chat_id, history),
+        history,
+        summarize_history_async
+    )
+
+
+async def save_message_async(chat_id, role, content, source, user_email=None, partner_name=None):
+    row = message_row(chat_id, role, content, source, user_email, partner_name)
+
+    if MESSAGE_LOG_ENABLED:
+        MESSAGE_LOG.append(row)
+    else:
+        db = await get_async_supabase()
+        await db.table("chat_messages").insert(row).execute()
+
+    HISTORY_BUFFER.append(chat_id, role, content)
+
+
+# -------------------------------
+# OPENAI STEPS
+# -------------------------------
+async def rewrite_followup_question_async(message: str, history: list) -> str:
+    rewritten = local_rewrite(message, history)
+
+    if rewritten is not None:
+        return rewritten
+
+    try:
+        rewritten = await _complete(
+            build_followup_rewrite_messages(message, history),
+            temperature=0
+        )
+
+        if not rewritten:
+            return message
+
+        REWRITES.store(message, history, rewritten)
+        return rewritten
+
+    except Exception as e:
+        print("FOLLOWUP REWRITE ERROR:", e)
+        return message
+
+
+async def embed_async(text: str):
+    return await EMBEDDINGS.aembed(async_client, text)
+
+
+async def generate_contextual_answer_async(question: str, context_chunks: list) -> str:
+    if not context_chunks:
+        return NO_ANSWER_FALLBACK
+
+    return await _generate(
+        build_contextual_answer_messages(question, context_chunks),
+        temperature=0
+    )
+
+
+async def generate_adaptive_partner_answer_async(question: str, partner_name: str, context_chunks: list) -> str:
+    if not context_chunks:
+        return NO_ANSWER_FALLBACK
+
+    return await _generate(
+        build_adaptive_partner_messages(question, partner_name, context_chunks),
+        temperature=0
+    )
+
+
+async def choose_best_chunk_with_ai_async(message: str, chunks: list):
+    chunks = chunks[:CHUNK_RERANK_TOP_N]
+
+    if not chunks:
+        return None
+
+    async def pick_from_candidates(candidates: list):
+        found, picked = RERANK_CACHE.lookup(message, candidates)
+
+        if found:
+            return picked
+
+        try:
+            raw = await _complete(
+                build_chunk_rerank_messages(message, candidates),
+                temperature=0
+            )
+
+            picked = parse_chunk_pick(raw, candidates)
+
+            RERANK_CACHE.store(message, candidates, picked)
+            return picked
+
+        except Exception as e:
+            print("CHUNK RERANK PICK ERROR:", e)
+            return None
+
+    tasks = [
+        asyncio.ensure_future(pick_from_candidates(candidates))
+        for candidates in chunk_rerank_batches(chunks)
+    ]
+
+    done, pending = await asyncio.wait(tasks, timeout=CHUNK_RERANK_DEADLINE_SECONDS)
+
+    for task in pending:
+        task.cancel()
+
+    if pending:
+        print("CHUNK RERANK DEADLINE:", f"{len(pending)}/{len(tasks)} batches dropped")
+
+    winners = chunk_rerank_winners([
+        task.result() if task in done else None
+        for task in tasks
+    ])
+
+    if not winners:
+        return None
+
+    final_pick = await pick_from_candidates(chunk_rerank_final_candidates(winners))
+
+    return resolve_chunk_pick(final_pick, chunks)
+
+
+async def choose_best_chunk_async(message: str, chunks: list):
+    name = reranker_for(message)
+
+    if name == "local":
+        # May refresh the token index on first use
+        return await asyncio.to_thread(choose_best_chunk_locally, message, chunks)
+
+    return await choose_best_chunk_with_ai_async(message, chunks)
+
+
+async def ask_ai_only_async(question: str, chat_id: int = None, history: list = None) -> str:
+    if not chat_id:
+        history = history or []
+    else:
+        history = await get_chat_history_async(chat_id)
+
+    history = await compact_history_async(chat_id, history)
+
+    return await _generate(build_ai_only_messages(question, history), temperature=0.7)
+
+
+# -------------------------------
+# PARTNER ROUTE
+# -------------------------------
+async def chunk_rerank_candidates_async(db, retrieval: AsyncRetrievalSession, embedding, partner_ids: set) -> list:
+    if embedding:
+        return await retrieval.query(
+            "match_partner_chunks",
+            CHUNK_RERANK_MIN_SIMILARITY,
+            CHUNK_RERANK_TOP_N,
+            partner_ids=partner_ids
+        )
+
+    resp = await db.table("partner_chunks") \
+        .select("id, partner_id, content") \
+        .in_("partner_id", list(partner_ids)) \
+        .order("id") \
+        .limit(CHUNK_RERANK_TOP_N) \
+        .execute()
+
+    return resp.data or []
+
+
+async def answer_from_triggered_partners_async(
+    message: str,
+    embedding,
+    triggered_partners: list,
+    user_role: str = "guest",
+    original_message: str = None,
+    retrieval: AsyncRetrievalSession = None
+):
+    answer_question = original_message or message
+    partner_ids = triggered_partner_ids(triggered_partners)
+    db = await get_async_supabase()
+
+    if retrieval is None:
+        retrieval = AsyncRetrievalSession(db, embedding)
+
+    # 0. Best partner chunk by AI reranking
+    try:
+        partner_chunks = await chunk_rerank_candidates_async(db, retrieval, embedding, partner_ids)
+
+        best_chunk = await choose_best_chunk_async(message, partner_chunks)
+
+        if best_chunk:
+            partner_info = find_triggered_partner(triggered_partners, best_chunk["partner_id"])
+
+            clean_answer = await generate_adaptive_partner_answer_async(
+                question=answer_question,
+                partner_name=partner_info["partner_name"],
+                context_chunks=[best_chunk["content"]]
+            )
+
+            clean_answer = _yes_no(answer_question, clean_answer)
+
+            return partner_answers_response(
+                [partner_answer(partner_info["partner_name"], best_chunk["partner_id"], clean_answer)],
+                "partner_trigger_chunk_reranked"
+            )
+
+    except Exception as e:
+        print("TRIGGERED PARTNER CHUNK RERANK ERROR:", e)
+
+    # 1. Partner QA
+    if embedding:
+        try:
+            qa_results = await retrieval.query(*TRIGGERED_PARTNER_QA, partner_ids=partner_ids)
+            qa_answers = triggered_partner_qa_answers(qa_results, triggered_partners)
+
+            if qa_answers:
+                return partner_answers_response(qa_answers, "partner_trigger_qa")
+        except Exception as e:
+            print("TRIGGERED PARTNER QA ERROR:", e)
+
+    # 2. Partner docs; one answer per partner, generated concurrently
+    doc_answers = []
+
+    if embedding:
+        try:
+            doc_results = await retrieval.query(*TRIGGERED_PARTNER_DOCS, partner_ids=partner_ids)
+            contexts = triggered_partner_doc_contexts(doc_results, triggered_partners, message)
+
+            answers = await asyncio.gather(*[
+                generate_adaptive_partner_answer_async(
+                    question=answer_question,
+                    partner_name=partner_name,
+                    context_chunks=selected_chunks
+                )
+                for _, partner_name, selected_chunks in contexts
+            ])
+
+            for (partner_id, partner_name, _), clean_answer in zip(contexts, answers):
+                doc_answers.append(
+                    partner_answer(partner_name, partner_id, _yes_no(answer_question, clean_answer))
+                )
+
+        except Exception as e:
+            print("TRIGGERED PARTNER DOC ERROR:", e)
+
+    # 3. Partner was clearly triggered, but no answer found
+    return triggered_partner_fallback(doc_answers, triggered_partners)
+
+
+# -------------------------------
+# KNOWLEDGE BASE
+# -------------------------------
+async def answer_from_knowledge_base_async(
+    message: str,
+    retrieval_question: str,
+    embedding,
+    history: list,
+    user_role: str,
+    partner_name_matches: list,
+    triggered_partners: list
+):
+    db = await get_async_supabase()
+    retrieval = AsyncRetrievalSession(db, embedding)
+
+    # Partner name / trigger router
+    for stage, partners in partner_routes(partner_name_matches, triggered_partners):
+        result = await answer_from_triggered_partners_async(
+            message=retrieval_question,
+            embedding=embedding,
+            triggered_partners=partners,
+            user_role=user_role,
+            original_message=message,
+            retrieval=retrieval
+        )
+
+        if result:
+            retrieval.finish(stage)
+            return result
+
+    retrieval.prefetch()
+
+    # 3. Partner QA
+    if embedding:
+        qa_results = await retrieval.results("partner_qa")
+
+        if qa_results:
+            row = sort_by_similarity(qa_results)[0]
+            partner_name = await get_partner_badge_async(row["partner_id"])
+
+            answer = _yes_no(message, row["answer"])
+            retrieval.finish("partner_qa")
+
+            return single_answer_response(answer, "partner_qa", partner_name)
+
+    # 4. TheBridge QA
+    if embedding:
+        bridge_qa = await retrieval.results("bridge_qa")
+
+        if bridge_qa:
+            filtered = select_bridge_context(bridge_qa, "answer", message)
+            retrieval.finish("bridge_qa")
+
+            answer = await generate_contextual_answer_async(message, filtered)
+            answer = _yes_no(message, answer)
+
+            return single_answer_response(answer, "bridge_semantic_raw", "TheBridge")
+
+    # 5. Partner docs
+    if embedding:
+        rerank_pool = partner_docs_rerank_pool(await retrieval.results("partner_docs"))
+
+        if rerank_pool:
+            best_chunk = await choose_best_chunk_async(retrieval_question, rerank_pool)
+
+            if best_chunk:
+                best_partner_id = best_chunk["partner_id"]
+                partner_name = await get_partner_badge_async(best_partner_id)
+                retrieval.finish("partner_docs")
+
+                clean_answer = await generate_adaptive_partner_answer_async(
+                    question=message,
+                    partner_name=partner_name,
+                    context_chunks=[best_chunk["content"]]
+                )
+
+                clean_answer = _yes_no(message, clean_answer)
+
+                return partner_answers_response(
+                    [partner_answer(partner_name, best_partner_id, clean_answer)],
+                    "partner_docs_reranked"
+                )
+
+    # 6. TheBridge docs
+    if embedding:
+        bridge_results = await retrieval.results("bridge_docs")
+
+        if bridge_results:
+            retrieval.finish("bridge_docs")
+            filtered = select_bridge_context(bridge_results, "content", message)
+
+            answer = await generate_contextual_answer_async(message, filtered)
+            answer = _yes_no(message, answer)
+
+            return single_answer_response(answer, "bridge_docs_raw", "TheBridge")
+
+    retrieval.finish()
+    return None
+
+
+# -------------------------------
+# CORE CHAT LOGIC
+# -------------------------------
+async def get_answer_async(message: str, user_role: str = "guest", chat_id: int = None, history: list = None):
+    """
+    Same routing as chat.get_answer (the shared decisions live in chat's
+    ROUTING DECISIONS section); only the I/O is awaited instead.
+    """
+    user_norm = normalize(message)
+
+    # 1. History
+    if not chat_id:
+        history = history or []
+    else:
+        history = await get_chat_history_async(chat_id)
+
+    history = await compact_history_async(chat_id, history)
+
+    print("HISTORY DEBUG:", history)
+
+    retrieval_question = await rewrite_followup_question_async(message, history)
+
+    print("RETRIEVAL QUESTION DEBUG:", retrieval_question)
+
+    # Context continuation
+    last_assistant = continuation_target(message, history)
+
+    if last_assistant:
+        answer = await _generate(
+            build_continuation_messages(last_assistant, message),
+            temperature=0.3
+        )
+
+        return plain_answer_response(answer, "continuation")
+
+    # 2. Embedding
+    try:
+        embedding = await embed_async(search_text(retrieval_question))
+    except Exception as e:
+        print("EMBEDDING ERROR:", e)
+        embedding = None
+
+    partner_name_matches = await get_partner_name_match_async(retrieval_question)
+    triggered_partners = await get_partner_trigger_matches_async(retrieval_question)
+
+    print("PARTNER NAME MATCHES DEBUG:", partner_name_matches)
+    print("TRIGGERED PARTNERS DEBUG:", triggered_partners)
+
+    # Semantic answer cache
+    cache_route = answer_cache_route(partner_name_matches, triggered_partners)
+    use_answer_cache = answer_cache_applies(message, retrieval_question, embedding)
+
+    if use_answer_cache:
+        if ANSWER_CACHE.version_check_due():
+            await asyncio.to_thread(ANSWER_CACHE.check_version, supabase_admin)
+
+        cached = ANSWER_CACHE.lookup(cache_route, embedding)
+
+        if cached:
+            return cached
+
+    result = await answer_from_knowledge_base_async(
+        message,
+        retrieval_question,
+        embedding,
+        history,
+        user_role,
+        partner_name_matches,
+        triggered_partners
+    )
+
+    if result:
+        if use_answer_cache:
+            if has_deferred_answers(result):
+                # Stored by stream_answer_events once the text exists
+                result["_answer_cache"] = (cache_route, embedding)
+            else:
+                ANSWER_CACHE.store(cache_route, embedding, result)
+
+        return result
+
+    # 7. Troubleshooting + fallback + AI
+    session_id = troubleshooting_session(chat_id, message)
+
+    if session_id:
+        troubleshoot = await asyncio.to_thread(
+            run_troubleshooting, session_id, message, supabase_admin
+        )
+        if troubleshoot:
+            return troubleshooting_response(troubleshoot)
+
+    if is_yachting_question(user_norm):
+        return no_answer_response(user_role)
+
+    # AI fallback
+    try:
+        answer = await _generate(build_fallback_messages(message, history), temperature=0.7)
+        answer = _yes_no(message, answer)
+    except Exception as e:
+        print("OPENAI ERROR:", e)
+        answer = AI_TEMPORARY_ERROR
+
+    return plain_answer_response(answer, "openai_general")
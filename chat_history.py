@@ -0,0 +1,332 @@
+# chat_history.py
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Without tiktoken (or its encoding files) count_tokens estimates
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _ENCODING = None
+
+# Messages of context a chat's history is trimmed to
+HISTORY_MAX_MESSAGES = 20
+
+# chat_messages rows read from the tail (extra room for non user/assistant rows)
+HISTORY_TAIL_ROWS = int(os.getenv("HISTORY_TAIL_ROWS", "40"))
+
+# Prompt tokens the history may use before older turns are summarized
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+
+# Most recent messages always kept verbatim, even over budget
+HISTORY_MIN_VERBATIM = int(os.getenv("HISTORY_MIN_VERBATIM", "2"))
+
+# Overflowed messages that are kept verbatim until the summary is refreshed
+HISTORY_SUMMARY_MIN_NEW = int(os.getenv("HISTORY_SUMMARY_MIN_NEW", "4"))
+
+HISTORY_SUMMARY_CHATS = int(os.getenv("HISTORY_SUMMARY_CHATS", "1000"))
+
+# Per-message framing tokens of the chat format
+MESSAGE_OVERHEAD_TOKENS = 4
+
+HISTORY_BUFFER_CHATS = int(os.getenv("HISTORY_BUFFER_CHATS", "1000"))
+HISTORY_BUFFER_TTL_SECONDS = float(os.getenv("HISTORY_BUFFER_TTL_SECONDS", "600"))
+
+
+class ChatHistoryBuffer:
+    """
+    Per-chat ring buffer of the last HISTORY_MAX_MESSAGES messages.
+
+    Loaded from the database tail on first use, then appended to by
+    save_message, so later turns need no history query. Least recently
+    used chats are dropped past HISTORY_BUFFER_CHATS, and a chat is
+    reloaded after the TTL in case another process wrote to it.
+    """
+
+    def __init__(
+        self,
+        max_chats: int = HISTORY_BUFFER_CHATS,
+        ttl_seconds: float = HISTORY_BUFFER_TTL_SECONDS
+    ):
+        self.max_chats = max_chats
+        self.ttl_seconds = ttl_seconds
+        self.chats = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, chat_id):
+        """
+        The buffered history, or None if the chat has to be loaded.
+        """
+        with self._lock:
+            entry = self.chats.get(chat_id)
+
+            if entry is None or time.monotonic() - entry[1] > self.ttl_seconds:
+                self.misses += 1
+                return None
+
+            self.chats.move_to_end(chat_id)
+            self.hits += 1
+            return list(entry[0])
+
+    def load(self, chat_id, history: list):
+        with self._lock:
+            self.chats[chat_id] = (
+                deque(history, maxlen=HISTORY_MAX_MESSAGES),
+                time.monotonic()
+            )
+            self.chats.move_to_end(chat_id)
+
+            while len(self.chats) > self.max_chats:
+                self.chats.popitem(last=False)
+
+    def append(self, chat_id, role: str, content: str):
+        """
+        No-op for chats that are not buffered; their next read loads the tail.
+        """
+        if role not in ["user", "assistant"]:
+            return
+
+        with self._lock:
+            entry = self.chats.get(chat_id)
+
+            if entry is not None:
+                entry[0].append({"role": role, "content": content})
+
+    def invalidate(self, chat_id):
+        with self._lock:
+            self.chats.pop(chat_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "chats": len(self.chats),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+HISTORY_BUFFER = ChatHistoryBuffer()
+
+
+# -------------------------------
+# TOKEN-BUDGETED COMPACTION
+# -------------------------------
+def count_tokens(text: str) -> int:
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text or ""))
+
+    # ~4 characters per token for English text
+    return len(text or "") // 4 + 1
+
+
+def message_tokens(message: dict) -> int:
+    return count_tokens(message.get("content")) + MESSAGE_OVERHEAD_TOKENS
+
+
+def message_fingerprint(message: dict) -> str:
+    raw = f"{message.get('role')}\0{message.get('content')}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def prefix_fingerprints(history: list) -> list:
+    """
+    fingerprints[i] identifies the exact sequence history[:i + 1].
+    """
+    digest = hashlib.sha1()
+    fingerprints = []
+
+    for message in history:
+        digest.update(message_fingerprint(message).encode("utf-8"))
+        fingerprints.append(digest.copy().hexdigest())
+
+    return fingerprints
+
+
+def history_key(chat_id, history: list):
+    """
+    Summary cache key: the chat id, or None for guests. A guest history is
+    sent by the client, so its summaries are keyed on the exact message
+    prefix they cover instead (see HistoryCompactor.plan).
+    """
+    return chat_id or None
+
+
+def summary_message(summary: str) -> dict:
+    return {
+        "role": "system",
+        "content": f"Summary of the earlier conversation:\n{summary}"
+    }
+
+
+class HistoryCompactor:
+    """
+    Keeps the most recent messages verbatim within HISTORY_TOKEN_BUDGET and
+    replaces older ones with a rolling summary, cached per chat.
+
+    A chat's summary remembers the last message it covers and is dropped
+    when that message is no longer in the history. Guest summaries are
+    cached under the fingerprint of the whole prefix they cover, so they
+    are only reused for a history that starts with exactly those messages.
+    Later calls only summarize messages that overflowed since, together
+    with the previous summary, and only once HISTORY_SUMMARY_MIN_NEW of
+    them have piled up; until then they stay verbatim.
+    """
+
+    def __init__(self, budget: int = HISTORY_TOKEN_BUDGET, max_chats: int = HISTORY_SUMMARY_CHATS):
+        self.budget = budget
+        self.max_chats = max_chats
+        # chat_id -> (fingerprint of the last summarized message, summary)
+        # ("guest", prefix fingerprint) -> (same fingerprint, summary)
+        self.summaries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _split(self, history: list) -> int:
+        """
+        Index of the first message kept verbatim.
+        """
+        used = 0
+        split = len(history)
+
+        while split > 0:
+            tokens = message_tokens(history[split - 1])
+
+            if used + tokens > self.budget and len(history) - split >= HISTORY_MIN_VERBATIM:
+                break
+
+            used += tokens
+            split -= 1
+
+        return split
+
+    def _get(self, key):
+        with self._lock:
+            entry = self.summaries.get(key)
+
+            if entry is not None:
+                self.summaries.move_to_end(key)
+
+            return entry
+
+    def _cached_summary(self, key, history: list):
+        """
+        (summary, covered): the cached summary valid for this history and
+        the number of leading messages it covers, or (None, 0).
+        """
+        if key is None:
+            prefixes = prefix_fingerprints(history)
+
+            for covered in range(len(prefixes), 0, -1):
+                entry = self._get(("guest", prefixes[covered - 1]))
+
+                if entry is not None:
+                    return entry[1], covered
+
+            return None, 0
+
+        entry = self._get(key)
+
+        if entry is None:
+            return None, 0
+
+        last_fingerprint, summary = entry
+        fingerprints = [message_fingerprint(m) for m in history]
+
+        # A summary of messages this history does not contain is never used
+        if last_fingerprint not in fingerprints:
+            return None, 0
+
+        return summary, len(fingerprints) - fingerprints[::-1].index(last_fingerprint)
+
+    def plan(self, key, history: list):
+        """
+        (summary, pending, recent, refresh): the cached summary, older
+        messages it does not cover yet, the verbatim tail, and whether the
+        summary must be refreshed with pending before use.
+        None when the history fits the budget as-is.
+        """
+        split = self._split(history)
+
+        if split == 0:
+            return None
+
+        summary, covered = self._cached_summary(key, history)
+
+        # Messages the summary already covers are never repeated verbatim
+        split = max(split, covered)
+        pending = history[covered:split]
+        recent = history[split:]
+
+        if summary is None and len(pending) < HISTORY_SUMMARY_MIN_NEW:
+            return None
+
+        return summary, pending, recent, len(pending) >= HISTORY_SUMMARY_MIN_NEW
+
+    def store(self, key, summarized: list, summary: str):
+        """
+        summarized: every message the summary covers, oldest first.
+        """
+        if key is None:
+            fingerprint = prefix_fingerprints(summarized)[-1]
+            key = ("guest", fingerprint)
+        else:
+            fingerprint = message_fingerprint(summarized[-1])
+
+        with self._lock:
+            self.summaries[key] = (fingerprint, summary)
+            self.summaries.move_to_end(key)
+
+            while len(self.summaries) > self.max_chats:
+                self.summaries.popitem(last=False)
+
+    @staticmethod
+    def assemble(summary, pending: list, recent: list) -> list:
+        messages = [summary_message(summary)] if summary else []
+        return messages + pending + recent
+
+    def compact(self, key, history: list, summarize) -> list:
+        """
+        summarize(previous_summary, messages) -> str.
+        If summarizing fails the pending messages stay verbatim.
+        """
+        plan = self.plan(key, history)
+
+        if plan is None:
+            return history
+
+        summary, pending, recent, refresh = plan
+
+        if refresh:
+            try:
+                summary = summarize(summary, pending)
+                self.store(key, history[:len(history) - len(recent)], summary)
+                pending = []
+            except Exception as e:
+                print("HISTORY SUMMARY ERROR:", e)
+
+        return self.assemble(summary, pending, recent)
+
+    async def acompact(self, key, history: list, summarize) -> list:
+        plan = self.plan(key, history)
+
+        if plan is None:
+            return history
+
+        summary, pending, recent, refresh = plan
+
+        if refresh:
+            try:
+                summary = await summarize(summary, pending)
+                self.store(key, history[:len(history) - len(recent)], summary)
+                pending = []
+            except Exception as e:
+                print("HISTORY SUMMARY ERROR:", e)
+
+        return self.assemble(summary, pending, recent)
+
+
+HISTORY_COMPACTOR = HistoryCompactor()
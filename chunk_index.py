@@ -0,0 +1,356 @@
+# chunk_index.py
+
+import math
+import os
+import threading
+import time
+
+from partners import RefreshingIndex, _normalize
+from vector_index import KNOWLEDGE_UPDATED_COLUMN, VECTOR_INDEX_SYNC_OVERLAP_SECONDS, latest, overlap_since
+
+CHUNK_INDEX_TTL_SECONDS = float(os.getenv("CHUNK_INDEX_TTL_SECONDS", "300"))
+CHUNK_INDEX_SYNC_SECONDS = float(os.getenv("CHUNK_INDEX_SYNC_SECONDS", "60"))
+CHUNK_INDEX_PAGE_SIZE = int(os.getenv("CHUNK_INDEX_PAGE_SIZE", "1000"))
+
+# Same list get_best_triggered_partner_chunk has always used
+STOP_WORDS = {
+    "what", "why", "how", "when", "where", "which", "who",
+    "do", "does", "did", "is", "are", "was", "were",
+    "the", "a", "an", "and", "or", "but", "with", "from",
+    "for", "to", "of", "in", "on", "at", "by", "about",
+    "my", "your", "our", "their", "this", "that", "it",
+    "i", "me", "we", "you"
+}
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Phrase overlap weights of get_best_triggered_partner_chunk
+UNIGRAM_SCORE = 3
+BIGRAM_SCORE = 10
+TRIGRAM_SCORE = 20
+
+
+def tokenize(text: str) -> list:
+    return _normalize(text or "").split()
+
+
+def query_terms(text: str) -> list:
+    return [w for w in tokenize(text) if len(w) > 2 and w not in STOP_WORDS]
+
+
+def _idf(total: int, df: int) -> float:
+    return math.log(1 + (total - df + 0.5) / (df + 0.5))
+
+
+def _follows(positions: list, next_positions: list) -> set:
+    """
+    Positions p in positions where p + 1 is in next_positions.
+    """
+    nxt = set(next_positions)
+    return {p for p in positions if p + 1 in nxt}
+
+
+class PartnerChunkIndex(RefreshingIndex):
+    """
+    Positional inverted index over partner_chunks:
+    term -> {chunk_id: [token positions]}, plus document lengths for BM25.
+
+    Built once, then kept current by sync(): rows whose updated_at is
+    newer than the last sync are (re)tokenized in place, and when the
+    table's row count disagrees afterwards the ids no longer in the table
+    are removed. Writers hold the lock; readers never block.
+    """
+
+    name = "partner chunk index"
+
+    def __init__(self, ttl_seconds: float = CHUNK_INDEX_TTL_SECONDS):
+        super().__init__(ttl_seconds)
+        # (docs, postings, doc_lengths, ranks, totals) swapped as one tuple
+        # on rebuild. docs: chunk_id -> row, ranks: chunk_id -> id order
+        # (tie-break), totals: {"length": summed doc lengths, "added": n}
+        self.state = self._empty_state()
+        self.synced_until = None
+        self._thread = None
+
+    # ---------------------------
+    # DATABASE
+    # ---------------------------
+    def _fetch_changed(self, supabase, since) -> list:
+        """
+        Rows changed after since (every row when since is None).
+        """
+        rows = []
+        offset = 0
+
+        while True:
+            query = supabase.table("partner_chunks") \
+                .select(f"id, partner_id, content, {KNOWLEDGE_UPDATED_COLUMN}") \
+                .order(KNOWLEDGE_UPDATED_COLUMN) \
+                .order("id") \
+                .range(offset, offset + CHUNK_INDEX_PAGE_SIZE - 1)
+
+            if since is not None:
+                query = query.gt(KNOWLEDGE_UPDATED_COLUMN, since)
+
+            page = query.execute().data or []
+            rows.extend(page)
+
+            if len(page) < CHUNK_INDEX_PAGE_SIZE:
+                return rows
+
+            offset += CHUNK_INDEX_PAGE_SIZE
+
+    def _fetch_ids(self, supabase) -> set:
+        ids = set()
+        last_id = None
+
+        while True:
+            query = supabase.table("partner_chunks") \
+                .select("id") \
+                .order("id") \
+                .limit(CHUNK_INDEX_PAGE_SIZE)
+
+            if last_id is not None:
+                query = query.gt("id", last_id)
+
+            page = query.execute().data or []
+            ids.update(row["id"] for row in page)
+
+            if len(page) < CHUNK_INDEX_PAGE_SIZE:
+                return ids
+
+            last_id = page[-1]["id"]
+
+    def fetch(self, supabase) -> list:
+        return self._fetch_changed(supabase, None)
+
+    def _count(self, supabase) -> int:
+        return supabase.table("partner_chunks") \
+            .select("id", count="exact") \
+            .limit(1) \
+            .execute() \
+            .count
+
+    # ---------------------------
+    # BUILD / INCREMENTAL UPDATE
+    # ---------------------------
+    @staticmethod
+    def _empty_state() -> tuple:
+        return ({}, {}, {}, {}, {"length": 0, "added": 0})
+
+    def _add(self, state: tuple, row: dict):
+        docs, postings, doc_lengths, ranks, totals = state
+        chunk_id = row["id"]
+
+        if chunk_id in docs:
+            self._remove(state, chunk_id)
+
+        tokens = tokenize(row.get("content"))
+        positions = {}
+
+        for position, term in enumerate(tokens):
+            positions.setdefault(term, []).append(position)
+
+        for term, term_positions in positions.items():
+            postings.setdefault(term, {})[chunk_id] = term_positions
+
+        docs[chunk_id] = row
+        doc_lengths[chunk_id] = len(tokens)
+        # Tie-break by id, so an edited chunk keeps its place
+        ranks[chunk_id] = chunk_id
+        totals["added"] += 1
+        totals["length"] += len(tokens)
+
+    def _remove(self, state: tuple, chunk_id):
+        docs, postings, doc_lengths, ranks, totals = state
+        row = docs.pop(chunk_id, None)
+
+        if row is None:
+            return
+
+        for term in set(tokenize(row.get("content"))):
+            posting = postings.get(term)
+
+            if posting is not None:
+                posting.pop(chunk_id, None)
+
+                if not posting:
+                    postings.pop(term, None)
+
+        totals["length"] -= doc_lengths.pop(chunk_id, 0)
+        ranks.pop(chunk_id, None)
+
+    def build(self, rows: list):
+        state = self._empty_state()
+
+        for row in rows:
+            self._add(state, row)
+
+        self.state = state
+        self.synced_until = latest(row.get(KNOWLEDGE_UPDATED_COLUMN) for row in rows)
+
+    def add(self, rows: list):
+        """
+        Adds or replaces rows in place (e.g. right after an insert or edit).
+        """
+        with self._lock:
+            for row in rows:
+                self._add(self.state, row)
+
+            self.synced_until = latest(
+                [self.synced_until] + [row.get(KNOWLEDGE_UPDATED_COLUMN) for row in rows]
+            )
+
+    def remove(self, chunk_ids: list):
+        with self._lock:
+            for chunk_id in chunk_ids:
+                self._remove(self.state, chunk_id)
+
+    def sync(self, supabase):
+        """
+        Re-reads rows changed since the last sync (new and edited), then
+        drops deleted rows if the table's row count still disagrees.
+        """
+        if self.loaded_at is None:
+            self.ensure_fresh(supabase)
+            return
+
+        since = overlap_since(self.synced_until, VECTOR_INDEX_SYNC_OVERLAP_SECONDS)
+        changed = self._fetch_changed(supabase, since)
+
+        if changed:
+            self.add(changed)
+
+        if self._count(supabase) != len(self.state[0]):
+            live = self._fetch_ids(supabase)
+            gone = [chunk_id for chunk_id in list(self.state[0]) if chunk_id not in live]
+
+            print("PARTNER CHUNK INDEX PRUNE:", len(gone), "rows")
+            self.remove(gone)
+
+        self.loaded_at = time.monotonic()
+
+    def start_background_sync(self, supabase, interval: float = CHUNK_INDEX_SYNC_SECONDS):
+        if self._thread is not None:
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.sync(supabase)
+                except Exception as e:
+                    print("PARTNER CHUNK INDEX SYNC ERROR:", e)
+
+                time.sleep(interval)
+
+        self._thread = threading.Thread(target=loop, name="chunk-index-sync", daemon=True)
+        self._thread.start()
+
+    # ---------------------------
+    # SCORING
+    # ---------------------------
+    def bm25(self, question: str, chunk_ids: list) -> dict:
+        """
+        BM25 score of each chunk id for the question's content words,
+        using corpus-wide document frequencies. Unknown ids score 0.
+        """
+        docs, postings, doc_lengths, _, totals = self.state
+        total = len(docs)
+        avg_length = totals["length"] / total if total else 0
+        scores = {chunk_id: 0.0 for chunk_id in chunk_ids}
+
+        if not total:
+            return scores
+
+        for term in set(query_terms(question)):
+            posting = postings.get(term)
+
+            if not posting:
+                continue
+
+            idf = _idf(total, len(posting))
+
+            for chunk_id in chunk_ids:
+                positions = posting.get(chunk_id)
+
+                if not positions:
+                    continue
+
+                tf = len(positions)
+                norm = 1 - BM25_B + BM25_B * doc_lengths.get(chunk_id, 0) / (avg_length or 1)
+                scores[chunk_id] += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
+
+        return scores
+
+    def bm25_reference(self, question: str) -> float:
+        """
+        BM25 score of an average-length chunk containing every query term
+        once; terms the corpus never uses count as unseen. bm25() divided
+        by this is an absolute match strength, comparable across questions.
+        """
+        docs, postings, _, _, _ = self.state
+        total = len(docs)
+
+        return sum(
+            _idf(total, len(postings.get(term) or ()))
+            for term in set(query_terms(question))
+        )
+
+    def best_overlap(self, question: str, partner_ids) -> dict:
+        """
+        The chunk of partner_ids with the highest word / phrase overlap
+        score, or None if nothing overlaps. Unigram, bigram and trigram
+        matches are resolved from the postings and their positions.
+        """
+        docs, postings, _, ranks, _ = self.state
+        allowed = {str(p) for p in partner_ids}
+        q_words = query_terms(question)
+
+        if not q_words or not allowed:
+            return None
+
+        def term_postings(term: str) -> dict:
+            return {
+                chunk_id: positions
+                for chunk_id, positions in tuple(postings.get(term, {}).items())
+                if chunk_id in docs and str(docs[chunk_id].get("partner_id")) in allowed
+            }
+
+        word_postings = {word: term_postings(word) for word in set(q_words)}
+        scores = {}
+
+        # Word overlap
+        for word in q_words:
+            for chunk_id in word_postings[word]:
+                scores[chunk_id] = scores.get(chunk_id, 0) + UNIGRAM_SCORE
+
+        # Phrase overlap: adjacent positions in the same chunk
+        for i in range(len(q_words) - 1):
+            first = word_postings[q_words[i]]
+            second = word_postings[q_words[i + 1]]
+
+            for chunk_id, positions in first.items():
+                if chunk_id not in second:
+                    continue
+
+                starts = _follows(positions, second[chunk_id])
+
+                if starts:
+                    scores[chunk_id] += BIGRAM_SCORE
+
+                if i + 2 < len(q_words):
+                    third = word_postings[q_words[i + 2]].get(chunk_id)
+
+                    if third and _follows([p + 1 for p in starts], third):
+                        scores[chunk_id] += TRIGRAM_SCORE
+
+        if not scores:
+            return None
+
+        best = min(scores, key=lambda chunk_id: (-scores[chunk_id], ranks.get(chunk_id, 0)))
+
+        return docs.get(best)
+
+
+PARTNER_CHUNK_INDEX = PartnerChunkIndex()
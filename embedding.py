@@ -1,6 +1,7 @@
 from supabase import create_client
 from openai import OpenAI
 from dotenv import load_dotenv, find_dotenv
+from embedding_cache import EMBEDDINGS
 import os
 
 # Load env.txt explicitly
@@ -27,10 +28,7 @@ print(f"Found {len(rows)} rows")
 for row in rows:
     print("Embedding row id:", row["id"])
 
-    embedding = client.embeddings.create(
-        model="text-embedding-3-small",
-        input=row["question"]
-    ).data[0].embedding
+    embedding = EMBEDDINGS.embed(client, row["question"])
 
     res = supabase.table("partner_qa") \
         .update({"embedding_vec": embedding}) \
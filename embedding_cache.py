@@ -0,0 +1,166 @@
+# embedding_cache.py
+
+import hashlib
+import os
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+
+# Optional persistent tier (SQLite file of float32 vectors). Unset = memory only.
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH")
+
+
+def cache_key(model: str, text: str) -> str:
+    normalized = " ".join(text.split())
+    return hashlib.sha256(f"{model}\0{normalized}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding cache keyed on model + whitespace-normalized text.
+
+    Tier 1 is an in-process LRU; tier 2 an optional SQLite file so embeddings
+    survive restarts and can be shared with the ingestion scripts.
+    """
+
+    def __init__(self, max_size: int = EMBEDDING_CACHE_SIZE, path: str = EMBEDDING_CACHE_PATH):
+        self.max_size = max_size
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = None
+
+        if path:
+            try:
+                self._db = sqlite3.connect(path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings ("
+                    "key TEXT PRIMARY KEY, model TEXT, vector BLOB)"
+                )
+                self._db.commit()
+            except Exception as e:
+                print("EMBEDDING CACHE DB ERROR:", e)
+                self._db = None
+
+    # ---------------------------
+    # LOOKUP / STORE
+    # ---------------------------
+    def lookup(self, model: str, text: str):
+        key = cache_key(model, text)
+
+        with self._lock:
+            vector = self.memory.get(key)
+
+            if vector is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return vector
+
+            if self._db is not None:
+                try:
+                    row = self._db.execute(
+                        "SELECT vector FROM embeddings WHERE key = ?", (key,)
+                    ).fetchone()
+                except Exception as e:
+                    print("EMBEDDING CACHE READ ERROR:", e)
+                    row = None
+
+                if row:
+                    vector = array("f", row[0]).tolist()
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+                    return vector
+
+            self.misses += 1
+            return None
+
+    def store(self, model: str, text: str, vector: list):
+        key = cache_key(model, text)
+
+        with self._lock:
+            self._remember(key, vector)
+
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO embeddings (key, model, vector) VALUES (?, ?, ?)",
+                        (key, model, array("f", vector).tobytes())
+                    )
+                    self._db.commit()
+                except Exception as e:
+                    print("EMBEDDING CACHE WRITE ERROR:", e)
+
+    def _remember(self, key: str, vector: list):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.memory),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "persistent": self._db is not None
+        }
+
+    # ---------------------------
+    # OPENAI WRAPPERS
+    # ---------------------------
+    def embed(self, client, text: str, model: str = EMBEDDING_MODEL) -> list:
+        vector = self.lookup(model, text)
+
+        if vector is None:
+            vector = client.embeddings.create(
+                model=model,
+                input=text
+            ).data[0].embedding
+
+            self.store(model, text, vector)
+
+        return vector
+
+    def embed_many(self, client, texts: list, model: str = EMBEDDING_MODEL) -> list:
+        """
+        Embeds a list of texts with one API call for all cache misses.
+        """
+        vectors = [self.lookup(model, t) for t in texts]
+        missing = [i for i, v in enumerate(vectors) if v is None]
+
+        if missing:
+            resp = client.embeddings.create(
+                model=model,
+                input=[texts[i] for i in missing]
+            )
+
+            for i, item in zip(missing, resp.data):
+                vectors[i] = item.embedding
+                self.store(model, texts[i], item.embedding)
+
+        return vectors
+
+    async def aembed(self, async_client, text: str, model: str = EMBEDDING_MODEL) -> list:
+        vector = self.lookup(model, text)
+
+        if vector is None:
+            resp = await async_client.embeddings.create(
+                model=model,
+                input=text
+            )
+            vector = resp.data[0].embedding
+
+            self.store(model, text, vector)
+
+        return vector
+
+
+EMBEDDINGS = EmbeddingCache()
@@ -0,0 +1,89 @@
+from dotenv import load_dotenv, find_dotenv
+from chat import (
+    supabase_admin,
+    client,
+    choose_best_chunk_with_ai,
+    choose_best_chunk_locally,
+)
+from embedding_cache import EMBEDDINGS
+from rerank_cache import RERANK_CACHE
+from rerankers import chunk_rerank_route
+from retrieval import match_scoped, CHUNK_RERANK_TOP_N, CHUNK_RERANK_MIN_SIMILARITY
+import random
+import statistics
+import sys
+import time
+
+# Offline comparison of the local (BM25 + cosine) chunk reranker against
+# the LLM reranker on partner_qa questions, scoped to the question's partner.
+#
+#   python eval_rerankers.py [samples]
+
+load_dotenv(find_dotenv("env.txt"))
+
+SAMPLES = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+random.seed(7)
+
+rows = [
+    r for r in
+    supabase_admin.table("partner_qa").select("question, partner_id").limit(1000).execute().data or []
+    if r.get("question") and r.get("partner_id")
+]
+
+rows = random.sample(rows, min(SAMPLES, len(rows)))
+
+print(f"Questions: {len(rows)}")
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    picked = fn(*args)
+    return picked, (time.perf_counter() - start) * 1000
+
+
+def pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0
+
+
+# route -> list of (agree, llm_ms, local_ms)
+results = {"factual": [], "open": []}
+
+for row in rows:
+    question = row["question"]
+    embedding = EMBEDDINGS.embed(client, question)
+
+    chunks = match_scoped(
+        supabase_admin,
+        "match_partner_chunks",
+        embedding,
+        CHUNK_RERANK_MIN_SIMILARITY,
+        CHUNK_RERANK_TOP_N,
+        [row["partner_id"]]
+    )
+
+    if not chunks:
+        continue
+
+    # Measure real LLM latency, not cache hits
+    RERANK_CACHE.memory.clear()
+
+    llm_pick, llm_ms = timed(choose_best_chunk_with_ai, question, chunks)
+    local_pick, local_ms = timed(choose_best_chunk_locally, question, chunks)
+
+    agree = (llm_pick or {}).get("id") == (local_pick or {}).get("id")
+    results[chunk_rerank_route(question)].append((agree, llm_ms, local_ms))
+
+for route, entries in results.items():
+    if not entries:
+        continue
+
+    agreement = statistics.mean(1 if agree else 0 for agree, _, _ in entries)
+    llm_ms = [e[1] for e in entries]
+    local_ms = [e[2] for e in entries]
+
+    print(f"\nroute={route} questions={len(entries)}")
+    print(f"  pick agreement: {agreement:.3f}")
+    print(f"  llm   latency p50={pct(llm_ms, 0.5):.0f}ms p95={pct(llm_ms, 0.95):.0f}ms")
+    print(f"  local latency p50={pct(local_ms, 0.5):.1f}ms p95={pct(local_ms, 0.95):.1f}ms")
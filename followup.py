@@ -0,0 +1,126 @@
+# followup.py
+#
+# Decides locally whether a message needs the follow-up rewrite LLM call,
+# and caches the rewrites that still do.
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from partners import _normalize
+from chunk_index import STOP_WORDS
+
+REWRITE_CACHE_SIZE = int(os.getenv("REWRITE_CACHE_SIZE", "2048"))
+
+# Turns of history the rewrite prompt sees (build_followup_rewrite_messages)
+REWRITE_HISTORY_TURNS = 6
+
+# Messages with fewer content words than this are treated as elliptical
+FOLLOWUP_MIN_CONTENT_WORDS = int(os.getenv("FOLLOWUP_MIN_CONTENT_WORDS", "3"))
+
+# Words that only make sense with something earlier in the conversation
+REFERENCE_WORDS = {
+    "it", "its", "itself", "they", "them", "their", "theirs", "themselves",
+    "this", "that", "these", "those", "he", "him", "his", "she", "her", "hers",
+    "there", "same", "former", "latter", "above", "aforementioned",
+    "one", "ones", "else", "other", "another"
+}
+
+CONTINUATION_OPENERS = {"and", "also", "but", "so", "then", "or", "what about", "how about"}
+
+
+def needs_rewrite(message: str, history: list) -> bool:
+    """
+    True when the message probably depends on earlier turns: it uses a
+    pronoun / deictic, opens like a continuation, or is too short to
+    stand alone. Everything else is searched as-is.
+    """
+    if not history:
+        return False
+
+    words = _normalize(message).split()
+
+    if not words:
+        return False
+
+    if REFERENCE_WORDS.intersection(words):
+        return True
+
+    if words[0] in CONTINUATION_OPENERS or " ".join(words[:2]) in CONTINUATION_OPENERS:
+        return True
+
+    content_words = [w for w in words if len(w) > 2 and w not in STOP_WORDS]
+
+    return len(content_words) < FOLLOWUP_MIN_CONTENT_WORDS
+
+
+def rewrite_key(message: str, history: list) -> str:
+    recent = json.dumps(history[-REWRITE_HISTORY_TURNS:], sort_keys=True)
+    normalized = " ".join(message.lower().split())
+
+    return hashlib.sha256(f"{recent}\0{normalized}".encode("utf-8")).hexdigest()
+
+
+class RewriteCache:
+    """
+    LRU of follow-up rewrites keyed on the recent turns + the message.
+    """
+
+    def __init__(self, max_size: int = REWRITE_CACHE_SIZE):
+        self.max_size = max_size
+        self.memory = OrderedDict()
+        self.skipped = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, message: str, history: list):
+        key = rewrite_key(message, history)
+
+        with self._lock:
+            rewritten = self.memory.get(key)
+
+            if rewritten is None:
+                self.misses += 1
+                return None
+
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return rewritten
+
+    def store(self, message: str, history: list, rewritten: str):
+        key = rewrite_key(message, history)
+
+        with self._lock:
+            self.memory[key] = rewritten
+            self.memory.move_to_end(key)
+
+            while len(self.memory) > self.max_size:
+                self.memory.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.memory),
+            "skipped": self.skipped,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+REWRITES = RewriteCache()
+
+
+def local_rewrite(message: str, history: list):
+    """
+    The retrieval question if it can be had without the LLM, else None.
+    """
+    if not history:
+        return message
+
+    if not needs_rewrite(message, history):
+        REWRITES.skipped += 1
+        return message
+
+    return REWRITES.lookup(message, history)
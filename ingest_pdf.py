@@ -4,6 +4,7 @@ from dotenv import load_dotenv, find_dotenv
 from pypdf import PdfReader
 from openai import OpenAI
 from supabase import create_client
+from embedding_cache import EMBEDDINGS
 
 # =====================================================
 # LOAD ENV (same as chat.py / main.py)
@@ -132,10 +133,9 @@ inserted = 0
 
 for i, chunk in enumerate(chunks):
 
-    embedding = client.embeddings.create(
-        model="text-embedding-3-small",
-        input=chunk
-    ).data[0].embedding
+    # Cached: re-ingesting an unchanged PDF costs no embedding calls
+    # when EMBEDDING_CACHE_PATH is set
+    embedding = EMBEDDINGS.embed(client, chunk)
 
     supabase.table("partner_chunks").insert({
         "partner_id": PARTNER_ID,
@@ -2,13 +2,32 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi import FastAPI, HTTPException, Response
 from pydantic import BaseModel, EmailStr
 from typing import Optional, List
-from chat import get_answer, send_help_request, ask_ai_only, save_message, track_click
+from chat import get_answer, send_help_request, ask_ai_only, save_message, track_click, MESSAGE_LOG, ANALYTICS, pending_messages, wait_for_pending_messages
+from analytics import AnswerActionEvent, SigninEvent, user_type
+from users import USER_LOOKUP
+from profiles import PROFILES
+from account_jobs import AccountDeletionJobs, EmailMigrationJobs
+from retrieval import start_vector_index_sync
+from chunk_index import PARTNER_CHUNK_INDEX
+from chat_history import HISTORY_BUFFER
+from chat_async import (
+    get_answer_async,
+    save_message_async,
+    get_async_supabase,
+    ask_ai_only_async,
+    deferred_generation,
+    stream_answer_events,
+)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from supabase import create_client
 import os
 from dotenv import load_dotenv, find_dotenv
 import secrets
 import requests
+import json
 from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import UploadFile, File
 from openai import OpenAI
 
@@ -27,63 +46,62 @@ supabase_admin = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 openai_client = OpenAI(api_key=OPENAI_API_KEY)
 
+# "async": /chat/message runs chat_async.get_answer_async on the event loop.
+# "sync": the original blocking chat.get_answer in the threadpool.
+CHAT_PIPELINE = os.getenv("CHAT_PIPELINE", "async").strip().lower()
 
+# /auth/login reads the profile on this pool while the password is checked
+LOGIN_PROFILE_WORKERS = int(os.getenv("LOGIN_PROFILE_WORKERS", "8"))
 
-FROM_EMAIL = os.getenv("FROM_EMAIL")
+_login_executor = ThreadPoolExecutor(
+    max_workers=LOGIN_PROFILE_WORKERS,
+    thread_name_prefix="login-profile"
+)
 
 
-def get_user_name_by_email(email: str) -> str:
-    try:
-        resp = supabase_admin.table("user_profiles") \
-            .select("name") \
-            .eq("email", email.lower().strip()) \
-            .single() \
-            .execute()
+def forget_deleted_account(job: dict):
+    if job["status"] == "done":
+        USER_LOOKUP.forget(job["email"])
+        PROFILES.invalidate(job["email"])
 
-        if resp.data and resp.data.get("name"):
-            return resp.data["name"]
-    except Exception:
-        pass
 
-    return email.split("@")[0].capitalize()
+ACCOUNT_DELETIONS = AccountDeletionJobs(
+    supabase_admin,
+    message_log=MESSAGE_LOG,
+    click_log=ANALYTICS.logs["user_clicks"],
+    on_done=forget_deleted_account
+)
 
+# Moves chats, messages etc. to the new address after an email change
+EMAIL_MIGRATIONS = EmailMigrationJobs(
+    supabase_admin,
+    message_log=MESSAGE_LOG,
+    click_log=ANALYTICS.logs["user_clicks"]
+)
 
-def get_user_by_email(email: str):
-    email = email.lower().strip()
 
-    users = supabase_admin.auth.admin.list_users()
 
-    for u in users:
-        if u.email and u.email.lower().strip() == email:
-            return u
+FROM_EMAIL = os.getenv("FROM_EMAIL")
 
-    return None
 
+def get_user_name_by_email(email: str) -> str:
+    return PROFILES.name(supabase_admin, email)
 
-def profile_exists(email: str) -> bool:
-    email = email.lower().strip()
 
-    try:
-        resp = supabase_admin.table("user_profiles") \
-            .select("id") \
-            .eq("email", email) \
-            .limit(1) \
-            .execute()
+def get_user_by_email(email: str):
+    # Cached / indexed lookup (users.py) instead of scanning list_users()
+    return USER_LOOKUP.get(supabase_admin, email)
 
-        return bool(resp.data)
+
+def profile_exists(email: str) -> bool:
+    try:
+        return PROFILES.get(supabase_admin, email) is not None
     except Exception as e:
         print("PROFILE CHECK ERROR:", e)
         return False
 
 def track_user_signin(email: str):
-    email = email.lower().strip()
-
-    try:
-        supabase_admin.table("user_signins").insert({
-            "user_email": email
-        }).execute()
-    except Exception as e:
-        print("SIGNIN TRACK ERROR:", e)
+    ANALYTICS.track(SigninEvent(user_email=email.lower().strip()))
 
 
 VERIFICATION_EMAIL_SUBJECT = "Almost There! Verify Your TheBridge Account"
@@ -212,6 +230,35 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+def start_background_workers():
+    # No-op unless RETRIEVAL_BACKEND=local
+    start_vector_index_sync(supabase_admin)
+    PARTNER_CHUNK_INDEX.start_background_sync(supabase_admin)
+
+    # Also replays anything spooled or journaled by a previous run
+    MESSAGE_LOG.start()
+    ANALYTICS.start()
+
+    # Deletions interrupted by a restart continue where they stopped
+    ACCOUNT_DELETIONS.resume()
+    EMAIL_MIGRATIONS.resume()
+
+
+@app.on_event("shutdown")
+def stop_background_workers():
+    MESSAGE_LOG.close()
+    ANALYTICS.close()
+
+
+@app.get("/analytics/stats")
+def analytics_stats():
+    """
+    Queue depth, spooling and flush timings of the analytics tables.
+    """
+    return ANALYTICS.stats()
+
+
 @app.get("/experts")
 def list_experts(role: str):
     experts = supabase_admin.table("experts") \
@@ -331,21 +378,17 @@ def save_answer_action(req: AnswerActionRequest):
     if req.action not in allowed_actions:
         raise HTTPException(status_code=400, detail="Invalid action")
 
-    try:
-        supabase_admin.table("answer_actions").insert({
-            "chat_id": req.chat_id,
-            "user_email": req.user_email,
-            "user_type": "user" if req.user_role != "guest" else "guest",
-            "action": req.action,
-            "answer_text": req.answer_text,
-            "source": req.source
-        }).execute()
-
-        return {"status": "saved"}
+    # Written in the background; spooled and retried if Supabase is down
+    ANALYTICS.track(AnswerActionEvent(
+        chat_id=req.chat_id,
+        action=req.action,
+        answer_text=req.answer_text,
+        source=req.source,
+        user_email=req.user_email,
+        user_type=user_type(req.user_role)
+    ))
 
-    except Exception as e:
-        print("ANSWER ACTION SAVE ERROR:", e)
-        raise HTTPException(status_code=500, detail="Failed to save answer action")
+    return {"status": "saved"}
 
 @app.post("/tts")
 def text_to_speech(req: TTSRequest):
@@ -448,12 +491,34 @@ def health():
 # -------------------------
 # CHAT
 # -------------------------
-@app.post("/chat/message")
-def chat_message(req: ChatRequest):
+async def _chat_answer(req: ChatRequest):
+    if CHAT_PIPELINE == "sync":
+        return await run_in_threadpool(
+            get_answer, req.message, req.user_role, req.chat_id, req.history
+        )
+
+    return await get_answer_async(req.message, req.user_role, req.chat_id, req.history)
+
 
+async def _chat_save(chat_id, role, content, source, user_email=None, partner_name=None):
+    if CHAT_PIPELINE == "sync":
+        return await run_in_threadpool(
+            save_message, chat_id, role, content, source, user_email, partner_name
+        )
+
+    return await save_message_async(chat_id, role, content, source, user_email, partner_name)
+
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _chat_start(req: ChatRequest):
     # ✅ FIX: Ensure chat exists (important for suggested questions)
     if req.chat_id is None and req.user_email:
-        new_chat = supabase_admin.table("user_chats").insert({
+        db = await get_async_supabase()
+
+        new_chat = await db.table("user_chats").insert({
             "user_email": req.user_email,
             "title": "New Chat"
         }).execute()
@@ -462,7 +527,7 @@ def chat_message(req: ChatRequest):
 
     # Save user message
     if req.chat_id is not None:
-        save_message(
+        await _chat_save(
             req.chat_id,
             "user",
             req.message,
@@ -470,54 +535,102 @@ def chat_message(req: ChatRequest):
             req.user_email
         )
 
-    try:
-        result = get_answer(req.message, req.user_role, req.chat_id, req.history)
-    except Exception as e:
-        print("AI ERROR:", e)
-        return {
-            "answer": "⚠️ Temporary error. Please try again.",
-            "source": "error",
-            "actions": ["ask_ai"],
-            "requires_auth": False
-        }
+
+async def _chat_save_result(req: ChatRequest, result: dict):
+    if req.chat_id is None:
+        return
 
     # ✅ MULTI-PARTNER SUPPORT
     if "answers" in result:
-        if req.chat_id is not None:
-            for ans in result["answers"]:
-                save_message(
-                    req.chat_id,
-                    "assistant",
-                    ans.get("answer"),
-                    result.get("source"),
-                    req.user_email,
-                    ans.get("partner_name")
-                )
-        return result
+        for ans in result["answers"]:
+            await _chat_save(
+                req.chat_id,
+                "assistant",
+                ans.get("answer"),
+                result.get("source"),
+                req.user_email,
+                ans.get("partner_name")
+            )
+        return
+
+    await _chat_save(
+        req.chat_id,
+        "assistant",
+        result.get("answer"),
+        result.get("source"),
+        req.user_email,
+        result.get("badge")
+    )
 
-    answer = result.get("answer")
-    source = result.get("source")
-    actions = result.get("actions", [])
-    requires_auth = result.get("requires_auth", False)
 
-    if req.chat_id is not None:
-        save_message(
-            req.chat_id,
-            "assistant",
-            answer,
-            source,
-            req.user_email,
-            result.get("badge")
-        )
+def _chat_response(result: dict) -> dict:
+    if "answers" in result:
+        return result
+
     return {
-    "answer": answer,
-    "source": source,
-    "actions": actions,
-    "requires_auth": requires_auth,
+    "answer": result.get("answer"),
+    "source": result.get("source"),
+    "actions": result.get("actions", []),
+    "requires_auth": result.get("requires_auth", False),
     "new_title": result.get("new_title")
     }
 
 
+CHAT_ERROR_RESPONSE = {
+    "answer": "⚠️ Temporary error. Please try again.",
+    "source": "error",
+    "actions": ["ask_ai"],
+    "requires_auth": False
+}
+
+
+@app.post("/chat/message")
+async def chat_message(req: ChatRequest):
+    await _chat_start(req)
+
+    try:
+        result = await _chat_answer(req)
+    except Exception as e:
+        print("AI ERROR:", e)
+        return dict(CHAT_ERROR_RESPONSE)
+
+    await _chat_save_result(req, result)
+
+    return _chat_response(result)
+
+
+@app.post("/chat/message/stream")
+async def chat_message_stream(req: ChatRequest):
+    """
+    Server-sent events variant of /chat/message (always the async pipeline):
+    "meta" (source, badge, answers[].partner_name ...), then "token" events
+    {index, text}, then "done" with the same body /chat/message returns.
+    The assistant message is saved once the stream has finished; if the
+    generation fails midway the stream ends with "error" and nothing is saved.
+    """
+    await _chat_start(req)
+
+    async def events():
+        try:
+            with deferred_generation():
+                result = await get_answer_async(req.message, req.user_role, req.chat_id, req.history)
+
+            async for event, data in stream_answer_events(result):
+                if event == "done":
+                    await _chat_save_result(req, data)
+                    data = _chat_response(data)
+                elif event == "error":
+                    data = CHAT_ERROR_RESPONSE
+
+                yield sse_event(event, data)
+
+        except Exception as e:
+            print("AI STREAM ERROR:", e)
+            yield sse_event("error", CHAT_ERROR_RESPONSE)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
 
 @app.post("/chat/ask-ai")
 def chat_ask_ai(req: dict):
@@ -568,6 +681,49 @@ def chat_ask_ai(req: dict):
         "source": "openai_only"
     }
 
+@app.post("/chat/ask-ai/stream")
+async def chat_ask_ai_stream(req: dict):
+    """
+    Server-sent events variant of the normal Ask AI flow of /chat/ask-ai.
+    """
+    # Only enqueues, safe on the event loop
+    track_click(
+        chat_id=req.get("chat_id"),
+        button="ask_ai",
+        question=req.get("message"),
+        user_email=req.get("user_email"),
+        user_role=req.get("user_role", "guest")
+    )
+
+    async def events():
+        try:
+            with deferred_generation():
+                answer = await ask_ai_only_async(
+                    req.get("message"),
+                    req.get("chat_id"),
+                    req.get("history")
+                )
+
+            result = {"answer": answer, "source": "openai_only"}
+
+            async for event, data in stream_answer_events(result):
+                if event == "done" and req.get("chat_id"):
+                    await save_message_async(
+                        req.get("chat_id"),
+                        "assistant",
+                        data["answer"],
+                        "openai_only",
+                        req.get("user_email")
+                    )
+
+                yield sse_event(event, data)
+
+        except Exception as e:
+            print("AI STREAM ERROR:", e)
+            yield sse_event("error", {"answer": "⚠️ Temporary error. Please try again.", "source": "error"})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 # -------------------------
 # AUTH
 # -------------------------
@@ -577,22 +733,15 @@ def get_profile(email: EmailStr):
     email = email.lower().strip()
 
     try:
-        profile = (
-            supabase_admin
-            .table("user_profiles")
-            .select("id, name, email, newsletter")
-            .eq("email", email)
-            .single()
-            .execute()
-        )
+        profile = PROFILES.get(supabase_admin, email)
 
-        if not profile.data:
+        if not profile:
             raise HTTPException(
                 status_code=404,
                 detail="Profile not found"
             )
 
-        return profile.data
+        return profile
 
     except HTTPException:
         raise
@@ -636,8 +785,14 @@ def update_profile(req: UpdateProfileRequest):
                     detail="This email is already in use"
                 )
 
+            if EMAIL_MIGRATIONS.active_for(current_email):
+                raise HTTPException(
+                    status_code=409,
+                    detail="A previous email change is still being applied"
+                )
+
         # 1. Update Supabase Auth user
-        supabase_admin.auth.admin.update_user_by_id(
+        updated = supabase_admin.auth.admin.update_user_by_id(
             user.id,
             {
                 "email": new_email,
@@ -648,6 +803,9 @@ def update_profile(req: UpdateProfileRequest):
             }
         )
 
+        USER_LOOKUP.forget(current_email)
+        USER_LOOKUP.remember(new_email, updated.user if updated and updated.user else user)
+
         # 2. Update profile
         (
             supabase_admin
@@ -660,54 +818,20 @@ def update_profile(req: UpdateProfileRequest):
             .execute()
         )
 
-        # 3. Keep chats attached to the new email
-        (
-            supabase_admin
-            .table("user_chats")
-            .update({"user_email": new_email})
-            .eq("user_email", current_email)
-            .execute()
-        )
-
-        # 4. Keep messages attached to the new email
-        (
-            supabase_admin
-            .table("chat_messages")
-            .update({"user_email": new_email})
-            .eq("user_email", current_email)
-            .execute()
-        )
+        PROFILES.invalidate(current_email, new_email)
 
-        # 5. Keep click tracking attached to the new email
-        (
-            supabase_admin
-            .table("user_clicks")
-            .update({"user_email": new_email})
-            .eq("user_email", current_email)
-            .execute()
-        )
+        # 3. Chats, messages, clicks and pending reset / verification rows
+        # follow in the background (account_jobs.EmailMigrationJobs)
+        migration = None
 
-        # 6. Update pending reset / verification rows if any exist
-        (
-            supabase_admin
-            .table("password_resets")
-            .update({"email": new_email})
-            .eq("email", current_email)
-            .execute()
-        )
-
-        (
-            supabase_admin
-            .table("email_verifications")
-            .update({"email": new_email})
-            .eq("email", current_email)
-            .execute()
-        )
+        if new_email != current_email:
+            migration = EMAIL_MIGRATIONS.submit(current_email, new_email=new_email)
 
         return {
             "status": "updated",
             "name": new_name,
-            "email": new_email
+            "email": new_email,
+            "migration_id": migration["id"] if migration else None
         }
 
     except HTTPException:
@@ -841,6 +965,7 @@ def verify(req: VerifyRequest):
                 )
 
             user_id = created_user.user.id
+            USER_LOOKUP.remember(email, created_user.user)
 
         # 6. Create/update profile
         profile_resp = (
@@ -861,6 +986,8 @@ def verify(req: VerifyRequest):
                 detail="Failed to create user profile"
             )
 
+        PROFILES.invalidate(email)
+
         # 7. Delete verification record ONLY after success
         (
             supabase_admin
@@ -899,128 +1026,118 @@ def verify(req: VerifyRequest):
 def login(req: LoginRequest):
     email = req.email.lower().strip()
 
-    if not profile_exists(email):
-        raise HTTPException(
-            status_code=401,
-            detail="Account not found. Please create an account again."
-        )
+    # One profile read, concurrent with the password check, serves both
+    # the existence check and the name
+    profile_future = _login_executor.submit(PROFILES.get, supabase_admin, email)
 
     try:
         auth = supabase.auth.sign_in_with_password({
             "email": email,
             "password": req.password
         })
+    except Exception:
+        auth = None
 
-        track_user_signin(email)
+    try:
+        profile = profile_future.result()
+    except Exception as e:
+        print("PROFILE CHECK ERROR:", e)
+        profile = None
 
-        profile = (
-            supabase_admin
-            .table("user_profiles")
-            .select("name, email")
-            .eq("email", email)
-            .single()
-            .execute()
+    if not profile:
+        raise HTTPException(
+            status_code=401,
+            detail="Account not found. Please create an account again."
         )
 
-        return {
-            "status": "ok",
-            "user": auth.user,
-            "name": profile.data.get("name") if profile.data else None,
-            "email": email
-        }
-
-    except Exception:
+    if auth is None or not auth.user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+
+    # Only enqueues (analytics.py)
+    track_user_signin(email)
+
+    return {
+        "status": "ok",
+        "user": auth.user,
+        "name": profile.get("name"),
+        "email": email
+    }
         
 @app.delete("/auth/account")
 def delete_user_account(req: DeleteAccountRequest):
     email = req.email.lower().strip()
 
     try:
-        # 1. Find Supabase Auth user first
+        # The deletion only covers rows under the current email; a running
+        # migration would move the old-email rows onto the deleted account
+        if EMAIL_MIGRATIONS.active_for(email):
+            raise HTTPException(
+                status_code=409,
+                detail="An email change is still being applied, try again shortly"
+            )
+
+        # Resolved now so a resumed job can still delete the auth user
+        # after the profile row is gone
         user = get_user_by_email(email)
 
-        # 2. Get this user's chats
-        chats = (
-            supabase_admin
-            .table("user_chats")
-            .select("id")
-            .eq("user_email", email)
-            .execute()
-        )
+        # The cascade runs in the background (account_jobs.py)
+        job = ACCOUNT_DELETIONS.submit(email, user_id=user.id if user else None)
 
-        chat_ids = [chat["id"] for chat in chats.data or []]
+        return {
+            "status": "accepted",
+            "job_id": job["id"],
+            "email": email
+        }
 
-        # 3. Delete chat messages for those chats
-        if chat_ids:
-            (
-                supabase_admin
-                .table("chat_messages")
-                .delete()
-                .in_("chat_id", chat_ids)
-                .execute()
-            )
+    except HTTPException:
+        raise
 
-        # 4. Delete user's chats
-        (
-            supabase_admin
-            .table("user_chats")
-            .delete()
-            .eq("user_email", email)
-            .execute()
+    except Exception as e:
+        print("DELETE ACCOUNT ERROR:", repr(e))
+        raise HTTPException(
+            status_code=500,
+            detail="Account deletion failed"
         )
 
-        # 5. Delete click analytics for this user
-        (
-            supabase_admin
-            .table("user_clicks")
-            .delete()
-            .eq("user_email", email)
-            .execute()
-        )
 
-        # 6. Delete any pending password reset rows
-        (
-            supabase_admin
-            .table("password_resets")
-            .delete()
-            .eq("email", email)
-            .execute()
+def _job_status(jobs, job_id: str) -> dict:
+    try:
+        job = jobs.get(job_id)
+    except Exception as e:
+        print("JOB STATUS ERROR:", repr(e))
+        raise HTTPException(
+            status_code=500,
+            detail="Failed to load job status"
         )
 
-        # 7. Delete any pending verification rows
-        (
-            supabase_admin
-            .table("email_verifications")
-            .delete()
-            .eq("email", email)
-            .execute()
+    if not job:
+        raise HTTPException(
+            status_code=404,
+            detail="Job not found"
         )
 
-        # 8. Delete user profile
-        (
-            supabase_admin
-            .table("user_profiles")
-            .delete()
-            .eq("email", email)
-            .execute()
-        )
+    return {
+        "job_id": job["id"],
+        "email": job["email"],
+        "status": job["status"],
+        "step": job.get("step"),
+        "steps_done": job["steps_done"],
+        "steps_total": job["steps_total"],
+        "counts": job.get("counts") or {},
+        "error": job.get("error"),
+        "updated_at": job.get("updated_at")
+    }
 
-        # 9. Delete Supabase Auth user
-        if user:
-            supabase_admin.auth.admin.delete_user(user.id)
 
-        return {
-            "status": "deleted",
-            "email": email
-        }
+@app.get("/auth/account/deletion/{job_id}")
+def account_deletion_status(job_id: str):
+    return _job_status(ACCOUNT_DELETIONS, job_id)
+
+
+@app.get("/auth/profile/migration/{job_id}")
+def email_migration_status(job_id: str):
+    return _job_status(EMAIL_MIGRATIONS, job_id)
 
-    except Exception as e:
-        print("DELETE ACCOUNT ERROR:", repr(e))
-        raise HTTPException(
-            status_code=500,
-            detail="Account deletion failed"
-        )
 # -------------------------
 # PASSWORD RESET (BASIC)
 # -------------------------
@@ -1127,9 +1244,12 @@ def reset_confirm(req: ResetConfirmRequest):
 # -------------------------
 @app.get("/chats")
 def list_chats(user_email: EmailStr):
+    # Chats not yet moved by a running email change
+    emails = [user_email] + EMAIL_MIGRATIONS.previous_emails(user_email)
+
     resp = supabase_admin.table("user_chats") \
         .select("*") \
-        .eq("user_email", user_email) \
+        .in_("user_email", emails) \
         .execute()
     return resp.data 
 
@@ -1172,16 +1292,24 @@ def get_chat_messages(chat_id: int):
         .eq("chat_id", chat_id) \
         .order("id") \
         .execute()
-    return resp.data
+
+    # Acknowledged messages still waiting in the write-behind log
+    return (resp.data or []) + pending_messages(chat_id)
 
 
 @app.delete("/chats/{chat_id}")
 def delete_chat(chat_id: int, user_email: str):
+    # Queued messages would otherwise be inserted after the chat is gone
+    MESSAGE_LOG.discard(lambda row: row.get("chat_id") == chat_id)
+    wait_for_pending_messages(chat_id)
+
     supabase_admin.table("chat_messages") \
         .delete() \
         .eq("chat_id", chat_id) \
         .execute()
 
+    HISTORY_BUFFER.invalidate(chat_id)
+
     supabase_admin.table("user_chats") \
         .delete() \
         .eq("id", chat_id) \
@@ -0,0 +1,286 @@
+# partners.py
+
+import os
+import string
+import threading
+import time
+from abc import ABC, abstractmethod
+
+PARTNER_CACHE_TTL_SECONDS = float(os.getenv("PARTNER_CACHE_TTL_SECONDS", "300"))
+
+
+def _normalize(text: str) -> str:
+    # Same normalisation as chat.normalize (kept local to avoid a circular import)
+    return text.strip().lower().translate(
+        str.maketrans("", "", string.punctuation)
+    )
+
+
+def compact(text: str) -> str:
+    return _normalize(text).replace(" ", "")
+
+
+# -------------------------------
+# AHO-CORASICK AUTOMATON
+# -------------------------------
+class KeywordAutomaton:
+    """
+    Aho-Corasick automaton over compacted keywords.
+
+    find_all() returns the ids of every keyword that occurs as a substring
+    of the text, in one pass over the text.
+    """
+
+    def __init__(self, keywords: list):
+        # keywords: list of (keyword_id, compact_keyword)
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+        for keyword_id, keyword in keywords:
+            if not keyword:
+                continue
+
+            state = 0
+
+            for ch in keyword:
+                nxt = self.goto[state].get(ch)
+
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][ch] = nxt
+
+                state = nxt
+
+            self.output[state].append(keyword_id)
+
+        # Breadth-first pass to build failure links
+        queue = list(self.goto[0].values())
+
+        while queue:
+            state = queue.pop(0)
+
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+
+                if self.fail[nxt] == nxt:
+                    self.fail[nxt] = 0
+
+                self.output[nxt] = self.output[nxt] + self.output[self.fail[nxt]]
+
+    def find_all(self, text: str) -> set:
+        found = set()
+        state = 0
+
+        for ch in text:
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+
+            state = self.goto[state].get(ch, 0)
+
+            if self.output[state]:
+                found.update(self.output[state])
+
+        return found
+
+
+# -------------------------------
+# TTL-REFRESHED INDEX BASE
+# -------------------------------
+class RefreshingIndex(ABC):
+    """
+    Base for in-process indexes built from a Supabase table.
+    Loaded lazily, rebuilt when older than the TTL or after invalidate().
+    If a refresh fails the previous index keeps serving.
+    """
+
+    name = "index"
+
+    def __init__(self, ttl_seconds: float = PARTNER_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.loaded_at = None
+        self._lock = threading.Lock()
+
+    def is_stale(self) -> bool:
+        if self.loaded_at is None:
+            return True
+
+        return time.monotonic() - self.loaded_at > self.ttl_seconds
+
+    def invalidate(self):
+        self.loaded_at = None
+
+    def ensure_fresh(self, supabase):
+        if not self.is_stale():
+            return
+
+        with self._lock:
+            if not self.is_stale():
+                return
+
+            try:
+                self.build(self.fetch(supabase))
+                self.loaded_at = time.monotonic()
+            except Exception as e:
+                print(f"{self.name.upper()} REFRESH ERROR:", e)
+
+                # Keep serving the old index; retry after another TTL
+                if self.loaded_at is not None:
+                    self.loaded_at = time.monotonic()
+                else:
+                    raise
+
+    @abstractmethod
+    def fetch(self, supabase) -> list:
+        """
+        Rows the index is built from.
+        """
+
+    @abstractmethod
+    def build(self, rows: list):
+        """
+        Replaces the index contents with rows.
+        """
+
+
+# -------------------------------
+# PARTNER TRIGGERS
+# -------------------------------
+class PartnerTriggerIndex(RefreshingIndex):
+    """
+    All active partner_triggers compiled into one automaton.
+
+    A trigger matches when its compact form is a substring of the compact
+    message. This also covers the word-boundary form: a \\b-delimited
+    match always survives removing the spaces on both sides.
+    """
+
+    name = "partner trigger index"
+
+    def __init__(self, ttl_seconds: float = PARTNER_CACHE_TTL_SECONDS):
+        super().__init__(ttl_seconds)
+        # (entries, automaton) swapped as one tuple so readers never mix builds
+        self.state = ([], KeywordAutomaton([]))
+
+    def fetch(self, supabase) -> list:
+        resp = supabase.table("partner_triggers") \
+            .select("partner_id, trigger, partners(id, badge_label)") \
+            .eq("is_active", True) \
+            .execute()
+
+        return resp.data or []
+
+    def build(self, rows: list):
+        entries = []
+
+        for row in rows:
+            trigger = row.get("trigger") or ""
+
+            if not _normalize(trigger):
+                continue
+
+            partner = row.get("partners") or {}
+
+            entries.append({
+                "partner_id": row["partner_id"],
+                "partner_name": partner.get("badge_label", "Partner"),
+                "trigger": trigger
+            })
+
+        automaton = KeywordAutomaton([
+            (i, compact(entry["trigger"])) for i, entry in enumerate(entries)
+        ])
+        self.state = (entries, automaton)
+
+    def match(self, supabase, message: str) -> list:
+        self.ensure_fresh(supabase)
+
+        entries, automaton = self.state
+        hits = automaton.find_all(compact(message))
+
+        # Table order, longest trigger wins per partner
+        unique = {}
+
+        for i in sorted(hits):
+            entry = entries[i]
+            partner_id = entry["partner_id"]
+
+            if (
+                partner_id not in unique
+                or len(entry["trigger"]) > len(unique[partner_id]["trigger"])
+            ):
+                unique[partner_id] = dict(entry)
+
+        return list(unique.values())
+
+
+PARTNER_TRIGGERS = PartnerTriggerIndex()
+
+
+# -------------------------------
+# PARTNER DIRECTORY
+# -------------------------------
+class PartnerDirectory(RefreshingIndex):
+    """
+    In-memory copy of the partners table.
+    Holds the id -> badge_label map and a compact-name automaton so
+    name matching and badge lookups need no Supabase round trip.
+    """
+
+    name = "partner directory"
+
+    def __init__(self, ttl_seconds: float = PARTNER_CACHE_TTL_SECONDS):
+        super().__init__(ttl_seconds)
+        # (partners, badges, automaton) swapped as one tuple
+        self.state = ([], {}, KeywordAutomaton([]))
+
+    def fetch(self, supabase) -> list:
+        resp = supabase.table("partners") \
+            .select("id, badge_label") \
+            .execute()
+
+        return resp.data or []
+
+    def build(self, rows: list):
+        automaton = KeywordAutomaton([
+            (i, compact(row.get("badge_label") or ""))
+            for i, row in enumerate(rows)
+        ])
+        badges = {str(row["id"]): row.get("badge_label") for row in rows}
+        self.state = (rows, badges, automaton)
+
+    def badge_label(self, supabase, partner_id) -> str:
+        try:
+            self.ensure_fresh(supabase)
+        except Exception as e:
+            print("PARTNER FETCH ERROR:", e)
+
+        _, badges, _ = self.state
+        return badges.get(str(partner_id), "Partner")
+
+    def match_names(self, supabase, message: str) -> list:
+        self.ensure_fresh(supabase)
+
+        partners, _, automaton = self.state
+        hits = automaton.find_all(compact(message))
+
+        return [
+            {
+                "partner_id": partners[i]["id"],
+                "partner_name": partners[i].get("badge_label") or "",
+                "trigger": partners[i].get("badge_label") or ""
+            }
+            for i in sorted(hits)
+        ]
+
+
+PARTNER_DIRECTORY = PartnerDirectory()
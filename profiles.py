@@ -0,0 +1,111 @@
+# profiles.py
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+PROFILE_CACHE_TTL_SECONDS = float(os.getenv("PROFILE_CACHE_TTL_SECONDS", "300"))
+
+PROFILE_COLUMNS = "id, name, email, newsletter"
+
+
+class ProfileCache:
+    """
+    Read-through LRU of user_profiles rows by email, shared by main.py and
+    chat.py. Entries expire after the TTL and are dropped explicitly when a
+    profile is created, renamed or deleted. Missing profiles are not cached,
+    so a profile created by another worker is visible on the next read.
+    """
+
+    def __init__(
+        self,
+        max_size: int = PROFILE_CACHE_SIZE,
+        ttl_seconds: float = PROFILE_CACHE_TTL_SECONDS
+    ):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _cached(self, email: str):
+        with self._lock:
+            entry = self.memory.get(email)
+
+            if entry is None:
+                return None
+
+            profile, stored_at = entry
+
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                self.memory.pop(email, None)
+                return None
+
+            self.memory.move_to_end(email)
+            return profile
+
+    def get(self, supabase, email: str):
+        """
+        The profile row for email, or None if there is none.
+        Errors are raised to the caller.
+        """
+        email = email.lower().strip()
+        profile = self._cached(email)
+
+        if profile is not None:
+            self.hits += 1
+            return dict(profile)
+
+        self.misses += 1
+
+        resp = supabase.table("user_profiles") \
+            .select(PROFILE_COLUMNS) \
+            .eq("email", email) \
+            .limit(1) \
+            .execute()
+
+        if not resp.data:
+            return None
+
+        profile = resp.data[0]
+
+        with self._lock:
+            self.memory[email] = (profile, time.monotonic())
+            self.memory.move_to_end(email)
+
+            while len(self.memory) > self.max_size:
+                self.memory.popitem(last=False)
+
+        return dict(profile)
+
+    def name(self, supabase, email: str) -> str:
+        """
+        The profile name, or the capitalised local part of the email.
+        """
+        try:
+            profile = self.get(supabase, email)
+
+            if profile and profile.get("name"):
+                return profile["name"]
+        except Exception as e:
+            print("PROFILE NAME ERROR:", e)
+
+        return email.split("@")[0].capitalize()
+
+    def invalidate(self, *emails: str):
+        with self._lock:
+            for email in emails:
+                self.memory.pop(email.lower().strip(), None)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.memory),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+PROFILES = ProfileCache()
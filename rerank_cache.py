@@ -0,0 +1,79 @@
+# rerank_cache.py
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+RERANK_MODEL = "gpt-4o-mini"
+
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "2048"))
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+def rerank_key(question: str, candidates: list, model: str = RERANK_MODEL) -> str:
+    """
+    Normalized question + the ordered content hashes of the candidates.
+    A chunk whose content changes hashes differently, so stale decisions
+    are never matched again and simply age out of the LRU.
+    """
+    normalized = " ".join(question.lower().split())
+    parts = [model, normalized] + [content_hash(c.get("content")) for c in candidates]
+
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+class RerankCache:
+    """
+    LRU of chunk reranker decisions. The reranker runs at temperature 0, so
+    the same question over the same candidate list always gets the same
+    pick; this stores the picked candidate position (or None for "no pick").
+    """
+
+    def __init__(self, max_size: int = RERANK_CACHE_SIZE):
+        self.max_size = max_size
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, question: str, candidates: list):
+        """
+        Returns (found, pick) where pick is the chosen candidate or None.
+        """
+        key = rerank_key(question, candidates)
+
+        with self._lock:
+            if key not in self.memory:
+                self.misses += 1
+                return False, None
+
+            self.memory.move_to_end(key)
+            self.hits += 1
+            index = self.memory[key]
+
+        return True, candidates[index] if index is not None else None
+
+    def store(self, question: str, candidates: list, pick):
+        key = rerank_key(question, candidates)
+        index = candidates.index(pick) if pick is not None else None
+
+        with self._lock:
+            self.memory[key] = index
+            self.memory.move_to_end(key)
+
+            while len(self.memory) > self.max_size:
+                self.memory.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.memory),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+RERANK_CACHE = RerankCache()
@@ -0,0 +1,111 @@
+# rerankers.py
+#
+# Chunk rerankers for the triggered-partner route. A reranker is any
+# callable (question, chunks) -> chunk or None; chat.CHUNK_RERANKERS maps
+# names to them and CHUNK_RERANKER_ROUTES picks one per question route.
+
+import os
+
+from chunk_index import PARTNER_CHUNK_INDEX, query_terms, tokenize
+
+# "<route>:<reranker>" pairs, e.g. "factual:local". Routes: factual, open.
+# Routes not listed use the LLM reranker, so it is the default everywhere.
+CHUNK_RERANKER_ROUTES = dict(
+    pair.strip().split(":", 1)
+    for pair in os.getenv("CHUNK_RERANKER_ROUTES", "").split(",")
+    if ":" in pair
+)
+
+LOCAL_RERANK_BM25_WEIGHT = float(os.getenv("LOCAL_RERANK_BM25_WEIGHT", "0.5"))
+LOCAL_RERANK_MIN_SCORE = float(os.getenv("LOCAL_RERANK_MIN_SCORE", "0.35"))
+
+FACTUAL_OPENERS = {
+    "what", "when", "where", "who", "which", "how",
+    "is", "are", "does", "do", "can", "did", "was"
+}
+
+# Judgement calls the LLM reranker's category rules exist for
+OPEN_MARKERS = {
+    "best", "recommend", "recommendation", "compare", "comparison",
+    "better", "should", "suggest", "provider", "supplier", "options"
+}
+
+
+def chunk_rerank_route(question: str) -> str:
+    """
+    factual: short direct questions (what/when/is/does ...) with no
+    recommendation or comparison wording. Everything else is open.
+    """
+    words = tokenize(question)
+
+    if not words or len(words) > 14:
+        return "open"
+
+    if words[0] not in FACTUAL_OPENERS:
+        return "open"
+
+    if OPEN_MARKERS.intersection(words):
+        return "open"
+
+    return "factual"
+
+
+def reranker_for(question: str) -> str:
+    return CHUNK_RERANKER_ROUTES.get(chunk_rerank_route(question), "llm")
+
+
+class LocalChunkReranker:
+    """
+    BM25 over the partner_chunks token index, blended with the embedding
+    cosine the candidates already carry from retrieval. No network calls
+    once the index is loaded.
+    """
+
+    def __init__(
+        self,
+        index=PARTNER_CHUNK_INDEX,
+        bm25_weight: float = LOCAL_RERANK_BM25_WEIGHT,
+        min_score: float = LOCAL_RERANK_MIN_SCORE
+    ):
+        self.index = index
+        self.bm25_weight = bm25_weight
+        self.min_score = min_score
+
+    def scores(self, supabase, question: str, chunks: list) -> list:
+        try:
+            self.index.ensure_fresh(supabase)
+        except Exception as e:
+            print("LOCAL RERANK INDEX ERROR:", e)
+
+        bm25 = self.index.bm25(question, [c.get("id") for c in chunks])
+
+        # Against a fixed reference, not the best candidate, so a weak
+        # candidate set still scores low and min_score can reject it
+        reference = self.index.bm25_reference(question) or 1
+
+        scored = []
+
+        for chunk in chunks:
+            lexical = min(1.0, bm25.get(chunk.get("id"), 0.0) / reference)
+            cosine = chunk.get("similarity") or 0.0
+
+            scored.append(self.bm25_weight * lexical + (1 - self.bm25_weight) * cosine)
+
+        return scored
+
+    def pick(self, supabase, question: str, chunks: list):
+        if not chunks or not query_terms(question):
+            return None
+
+        scored = self.scores(supabase, question, chunks)
+
+        # max() keeps the first (most similar) chunk on ties
+        best = max(range(len(chunks)), key=lambda i: scored[i])
+
+        if scored[best] < self.min_score:
+            return None
+
+        return chunks[best]
+
+
+LOCAL_RERANKER = LocalChunkReranker()
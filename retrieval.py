@@ -0,0 +1,378 @@
+# retrieval.py
+
+import asyncio
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from vector_index import VectorIndex, RPC_CORPORA
+
+# "sequential": a corpus is only queried when a stage first needs it.
+# "parallel": all corpora are queried at once; winners are still picked
+# in the same priority order and the rest are cancelled or ignored.
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "sequential").strip().lower()
+RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", "16"))
+
+# "rpc": Supabase match_* functions. "local": in-process VectorIndex, which
+# falls back to the RPC until its first sync has completed.
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "rpc").strip().lower()
+
+# get_answer stage name -> (rpc, threshold, count), in priority order
+RETRIEVAL_STAGES = {
+    "partner_qa": ("match_partner_qa", 0.45, 5),
+    "bridge_qa": ("match_bridge_qa", 0.65, 5),
+    "partner_docs": ("match_partner_chunks", 0.30, 40),
+    "bridge_docs": ("match_bridge_chunks", 0.55, 8),
+}
+
+# Partner-scoped variants (sql/match_partner_scoped.sql): top-k is computed
+# inside a partner_id list instead of filtering a global top-k afterwards.
+SCOPED_RPCS = {
+    "match_partner_qa": "match_partner_qa_scoped",
+    "match_partner_chunks": "match_partner_chunks_scoped",
+}
+
+PARTNER_SCOPED_RETRIEVAL = os.getenv("PARTNER_SCOPED_RETRIEVAL", "1") == "1"
+
+# After a scoped RPC fails (e.g. not deployed) it is skipped for this long
+# and the filter-after fallback is used straight away
+SCOPED_RPC_RETRY_SECONDS = float(os.getenv("SCOPED_RPC_RETRY_SECONDS", "600"))
+
+# Stage one of the triggered-partner chunk reranker: only the top N
+# partner_chunks by similarity are handed to the LLM (chat.choose_best_chunk_with_ai),
+# so its call count no longer grows with the partner's corpus size.
+CHUNK_RERANK_TOP_N = int(os.getenv("CHUNK_RERANK_TOP_N", "40"))
+CHUNK_RERANK_MIN_SIMILARITY = float(os.getenv("CHUNK_RERANK_MIN_SIMILARITY", "0"))
+
+# Widest (lowest threshold, highest count) settings any caller uses per corpus.
+# A session fetches each corpus once at these settings; every narrower
+# (threshold, count) query is an exact subset of that result.
+CORPUS_WIDEST = {
+    "match_partner_qa": (0.45, 20),
+    "match_bridge_qa": (0.65, 5),
+    "match_partner_chunks": (0.30, 40),
+    "match_bridge_chunks": (0.55, 8),
+}
+
+# Same for the partner-scoped queries of answer_from_triggered_partners
+SCOPED_WIDEST = {
+    "match_partner_qa": (0.45, 20),
+    "match_partner_chunks": (
+        min(0.45, CHUNK_RERANK_MIN_SIMILARITY),
+        max(30, CHUNK_RERANK_TOP_N)
+    ),
+}
+
+_executor = ThreadPoolExecutor(
+    max_workers=RETRIEVAL_WORKERS,
+    thread_name_prefix="retrieval"
+)
+
+VECTOR_INDEX = VectorIndex() if RETRIEVAL_BACKEND == "local" else None
+
+
+def start_vector_index_sync(supabase):
+    if VECTOR_INDEX is not None:
+        VECTOR_INDEX.start_background_sync(supabase)
+
+
+def local_match(rpc: str, embedding, threshold: float, count: int, partner_ids=None):
+    """
+    Answers a match_* call from the local index, or None if it can't yet.
+    """
+    if VECTOR_INDEX is None or not VECTOR_INDEX.ready(RPC_CORPORA[rpc]):
+        return None
+
+    return VECTOR_INDEX.match(rpc, embedding, threshold, count, partner_ids)
+
+
+def match(supabase, rpc: str, embedding, threshold: float, count: int) -> list:
+    """
+    One match_* query on the configured backend. Raises on RPC errors.
+    """
+    rows = local_match(rpc, embedding, threshold, count)
+
+    if rows is not None:
+        return rows
+
+    return supabase.rpc(
+        rpc,
+        {
+            "query_embedding": embedding,
+            "match_threshold": threshold,
+            "match_count": count
+        }
+    ).execute().data or []
+
+
+def match_scoped(supabase, rpc: str, embedding, threshold: float, count: int, partner_ids) -> list:
+    """
+    match_* restricted to partner_ids, with the top-k taken inside that set.
+    """
+    partner_ids = sorted(str(p) for p in partner_ids)
+    rows = local_match(rpc, embedding, threshold, count, partner_ids)
+
+    if rows is not None:
+        return rows
+
+    return supabase.rpc(
+        SCOPED_RPCS[rpc],
+        {
+            "query_embedding": embedding,
+            "match_threshold": threshold,
+            "match_count": count,
+            "partner_ids": partner_ids
+        }
+    ).execute().data or []
+
+
+async def match_scoped_async(supabase, rpc: str, embedding, threshold: float, count: int, partner_ids) -> list:
+    partner_ids = sorted(str(p) for p in partner_ids)
+    rows = local_match(rpc, embedding, threshold, count, partner_ids)
+
+    if rows is not None:
+        return rows
+
+    resp = await supabase.rpc(
+        SCOPED_RPCS[rpc],
+        {
+            "query_embedding": embedding,
+            "match_threshold": threshold,
+            "match_count": count,
+            "partner_ids": partner_ids
+        }
+    ).execute()
+
+    return resp.data or []
+
+
+def filter_partners(rows: list, partner_ids) -> list:
+    allowed = {str(p) for p in partner_ids}
+    return [row for row in rows if str(row.get("partner_id")) in allowed]
+
+
+async def match_async(supabase, rpc: str, embedding, threshold: float, count: int) -> list:
+    rows = local_match(rpc, embedding, threshold, count)
+
+    if rows is not None:
+        return rows
+
+    resp = await supabase.rpc(
+        rpc,
+        {
+            "query_embedding": embedding,
+            "match_threshold": threshold,
+            "match_count": count
+        }
+    ).execute()
+
+    return resp.data or []
+
+
+def _similarity(row: dict):
+    return row.get("similarity", row.get("score"))
+
+
+def narrow(rows: list, threshold: float, count: int) -> list:
+    """
+    Local equivalent of re-running a match_* query with a tighter
+    threshold/count over a wider result. Rows without a score are kept.
+    """
+    kept = [
+        row for row in rows
+        if _similarity(row) is None or _similarity(row) >= threshold
+    ]
+    kept.sort(key=lambda r: _similarity(r) if _similarity(r) is not None else 1, reverse=True)
+
+    return kept[:count]
+
+
+def _fetch_widest(supabase, rpc: str, embedding) -> list:
+    threshold, count = CORPUS_WIDEST[rpc]
+
+    try:
+        return match(supabase, rpc, embedding, threshold, count)
+    except Exception as e:
+        print("RETRIEVAL ERROR:", rpc, e)
+        return []
+
+
+async def _fetch_widest_async(supabase, rpc: str, embedding) -> list:
+    threshold, count = CORPUS_WIDEST[rpc]
+
+    try:
+        return await match_async(supabase, rpc, embedding, threshold, count)
+    except Exception as e:
+        print("RETRIEVAL ERROR:", rpc, e)
+        return []
+
+
+# rpc -> time.monotonic() of its scoped RPC's last failure
+_scoped_failed_at = {}
+
+
+def _scoped_available(rpc: str) -> bool:
+    failed_at = _scoped_failed_at.get(rpc)
+    return failed_at is None or time.monotonic() - failed_at > SCOPED_RPC_RETRY_SECONDS
+
+
+def _scoped_failed(rpc: str, e: Exception):
+    print("SCOPED RETRIEVAL ERROR:", rpc, e)
+    _scoped_failed_at[rpc] = time.monotonic()
+
+
+def _fetch_scoped(supabase, rpc: str, embedding, partner_ids) -> list:
+    threshold, count = SCOPED_WIDEST[rpc]
+
+    if _scoped_available(rpc):
+        try:
+            return match_scoped(supabase, rpc, embedding, threshold, count, partner_ids)
+        except Exception as e:
+            # Scoped RPC not deployed / failing: fall back to filter-after
+            _scoped_failed(rpc, e)
+
+    return filter_partners(_fetch_widest(supabase, rpc, embedding), partner_ids)
+
+
+async def _fetch_scoped_async(supabase, rpc: str, embedding, partner_ids) -> list:
+    threshold, count = SCOPED_WIDEST[rpc]
+
+    if _scoped_available(rpc):
+        try:
+            return await match_scoped_async(supabase, rpc, embedding, threshold, count, partner_ids)
+        except Exception as e:
+            _scoped_failed(rpc, e)
+
+    return filter_partners(await _fetch_widest_async(supabase, rpc, embedding), partner_ids)
+
+
+def _scope_key(rpc: str, partner_ids):
+    if partner_ids is None:
+        return rpc
+
+    return (rpc, frozenset(str(p) for p in partner_ids))
+
+
+class RetrievalSession:
+    """
+    All semantic retrieval for one message and one query embedding.
+
+    Each corpus is queried at most once, at its CORPUS_WIDEST settings, and
+    memoized; query() then narrows locally. In parallel mode prefetch()
+    submits every corpus to the thread pool at once.
+    """
+
+    def __init__(self, supabase, embedding, mode: str = None):
+        self.supabase = supabase
+        self.embedding = embedding
+        self.mode = mode or RETRIEVAL_MODE
+        self.futures = {}
+
+    def prefetch(self):
+        """
+        Parallel mode: starts every corpus not fetched yet. Called once the
+        caller knows it needs the generic stages.
+        """
+        if self.mode != "parallel" or not self.embedding:
+            return
+
+        for rpc in CORPUS_WIDEST:
+            if rpc not in self.futures:
+                self.futures[rpc] = _executor.submit(
+                    _fetch_widest, self.supabase, rpc, self.embedding
+                )
+
+    def corpus(self, rpc: str, partner_ids=None) -> list:
+        if not self.embedding:
+            return []
+
+        key = _scope_key(rpc, partner_ids)
+        future = self.futures.get(key)
+
+        if future is None:
+            future = Future()
+
+            if partner_ids is None:
+                future.set_result(_fetch_widest(self.supabase, rpc, self.embedding))
+            else:
+                future.set_result(_fetch_scoped(self.supabase, rpc, self.embedding, partner_ids))
+
+            self.futures[key] = future
+
+        return future.result()
+
+    def query(self, rpc: str, threshold: float, count: int, partner_ids=None) -> list:
+        """
+        With partner_ids (and PARTNER_SCOPED_RETRIEVAL on) the top-k is
+        computed inside that partner set; otherwise over the whole corpus.
+        """
+        if partner_ids is not None and not PARTNER_SCOPED_RETRIEVAL:
+            return filter_partners(narrow(self.corpus(rpc), threshold, count), partner_ids)
+
+        return narrow(self.corpus(rpc, partner_ids), threshold, count)
+
+    def results(self, stage: str) -> list:
+        rpc, threshold, count = RETRIEVAL_STAGES[stage]
+        return self.query(rpc, threshold, count)
+
+    def finish(self, stage: str = None):
+        """
+        Drops corpora nobody asked for once a winner is chosen.
+        Futures already running finish in the background and are ignored.
+        """
+        for future in self.futures.values():
+            future.cancel()
+
+
+class AsyncRetrievalSession:
+    """
+    RetrievalSession for the async pipeline; parallel mode uses asyncio
+    tasks on the async Supabase client instead of the thread pool.
+    """
+
+    def __init__(self, supabase, embedding, mode: str = None):
+        self.supabase = supabase
+        self.embedding = embedding
+        self.mode = mode or RETRIEVAL_MODE
+        self.tasks = {}
+
+    def prefetch(self):
+        if self.mode != "parallel" or not self.embedding:
+            return
+
+        for rpc in CORPUS_WIDEST:
+            if rpc not in self.tasks:
+                self._start(rpc)
+
+    def _start(self, rpc: str, partner_ids=None):
+        if partner_ids is None:
+            fetch = _fetch_widest_async(self.supabase, rpc, self.embedding)
+        else:
+            fetch = _fetch_scoped_async(self.supabase, rpc, self.embedding, partner_ids)
+
+        self.tasks[_scope_key(rpc, partner_ids)] = asyncio.ensure_future(fetch)
+
+    async def corpus(self, rpc: str, partner_ids=None) -> list:
+        if not self.embedding:
+            return []
+
+        key = _scope_key(rpc, partner_ids)
+
+        if key not in self.tasks:
+            self._start(rpc, partner_ids)
+
+        return await self.tasks[key]
+
+    async def query(self, rpc: str, threshold: float, count: int, partner_ids=None) -> list:
+        if partner_ids is not None and not PARTNER_SCOPED_RETRIEVAL:
+            return filter_partners(narrow(await self.corpus(rpc), threshold, count), partner_ids)
+
+        return narrow(await self.corpus(rpc, partner_ids), threshold, count)
+
+    async def results(self, stage: str) -> list:
+        rpc, threshold, count = RETRIEVAL_STAGES[stage]
+        return await self.query(rpc, threshold, count)
+
+    def finish(self, stage: str = None):
+        for task in self.tasks.values():
+            task.cancel()
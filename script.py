@@ -1,5 +1,6 @@
 from openai import OpenAI
 from supabase import create_client
+from embedding_cache import EMBEDDINGS
 import os
 
 client = OpenAI()
@@ -9,10 +10,7 @@ supabase = create_client(
 )
 
 def embed(text):
-    return client.embeddings.create(
-        model="text-embedding-3-small",
-        input=text
-    ).data[0].embedding
+    return EMBEDDINGS.embed(client, text)
 
 rows = supabase.table("partner_qa").select("id, question").execute().data
 
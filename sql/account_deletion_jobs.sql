@@ -0,0 +1,25 @@
+-- Background account deletions (account_jobs.py). One row per request;
+-- the worker updates step / counts after every chunk so a restarted
+-- process can pick up queued and running jobs where they stopped.
+-- A running job is leased to the worker in claimed_by until lease_until.
+
+create table if not exists account_deletion_jobs (
+  id uuid primary key default gen_random_uuid(),
+  email text not null,
+  user_id uuid,
+  status text not null default 'queued',   -- queued | running | done | failed
+  step text,
+  counts jsonb not null default '{}'::jsonb,    -- rows deleted per table
+  error text,
+  claimed_by text,
+  lease_until timestamptz not null default now(),
+  created_at timestamptz not null default now(),
+  updated_at timestamptz not null default now()
+);
+
+create index if not exists account_deletion_jobs_active
+  on account_deletion_jobs (email)
+  where status in ('queued', 'running');
+
+alter table account_deletion_jobs add column if not exists claimed_by text;
+alter table account_deletion_jobs add column if not exists lease_until timestamptz not null default now();
@@ -0,0 +1,18 @@
+-- Direct email -> auth user id lookup for users.AuthUserDirectory, so a
+-- miss does not need a paginated auth.admin.list_users() scan.
+-- Runs as the owner to read auth.users; only the service role may call it.
+
+create or replace function auth_user_id_by_email(lookup_email text)
+returns uuid
+language sql stable
+security definer
+set search_path = ''
+as $$
+  select id
+  from auth.users
+  where lower(email) = lower(trim(lookup_email))
+  limit 1;
+$$;
+
+revoke all on function auth_user_id_by_email(text) from public, anon, authenticated;
+grant execute on function auth_user_id_by_email(text) to service_role;
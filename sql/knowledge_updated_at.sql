@@ -0,0 +1,35 @@
+-- updated_at on the four knowledge tables, kept current by a trigger.
+-- The local vector index (vector_index.py), the partner chunk index
+-- (chunk_index.py) and the answer cache version (answer_cache.py) use it
+-- to pick up edited rows, not just new ones.
+
+create or replace function touch_updated_at()
+returns trigger
+language plpgsql
+as $$
+begin
+  new.updated_at := now();
+  return new;
+end;
+$$;
+
+do $$
+declare
+  t text;
+begin
+  foreach t in array array['partner_qa', 'partner_chunks', 'bridge_qa', 'bridge_chunks']
+  loop
+    execute format(
+      'alter table %I add column if not exists updated_at timestamptz not null default now()', t
+    );
+    execute format(
+      'create index if not exists %I on %I (updated_at, id)', t || '_updated_at', t
+    );
+    execute format('drop trigger if exists touch_updated_at on %I', t);
+    execute format(
+      'create trigger touch_updated_at before update on %I '
+      'for each row execute function touch_updated_at()', t
+    );
+  end loop;
+end;
+$$;
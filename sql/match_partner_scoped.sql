@@ -0,0 +1,63 @@
+-- Partner-scoped variants of match_partner_qa / match_partner_chunks.
+-- Same row shape as the unscoped functions; the partner_id filter is applied
+-- before ORDER BY ... LIMIT so top-k is computed inside the partner set.
+
+create or replace function match_partner_qa_scoped(
+  query_embedding vector(1536),
+  match_threshold float,
+  match_count int,
+  partner_ids uuid[]
+)
+returns table (
+  id bigint,
+  partner_id uuid,
+  question text,
+  answer text,
+  similarity float
+)
+language sql stable
+as $$
+  select
+    partner_qa.id,
+    partner_qa.partner_id,
+    partner_qa.question,
+    partner_qa.answer,
+    1 - (partner_qa.embedding_vec <=> query_embedding) as similarity
+  from partner_qa
+  where partner_qa.partner_id = any(partner_ids)
+    and partner_qa.embedding_vec is not null
+    and 1 - (partner_qa.embedding_vec <=> query_embedding) >= match_threshold
+  order by partner_qa.embedding_vec <=> query_embedding
+  limit match_count;
+$$;
+
+create or replace function match_partner_chunks_scoped(
+  query_embedding vector(1536),
+  match_threshold float,
+  match_count int,
+  partner_ids uuid[]
+)
+returns table (
+  id bigint,
+  partner_id uuid,
+  content text,
+  similarity float
+)
+language sql stable
+as $$
+  select
+    partner_chunks.id,
+    partner_chunks.partner_id,
+    partner_chunks.content,
+    1 - (partner_chunks.embedding <=> query_embedding) as similarity
+  from partner_chunks
+  where partner_chunks.partner_id = any(partner_ids)
+    and partner_chunks.embedding is not null
+    and 1 - (partner_chunks.embedding <=> query_embedding) >= match_threshold
+  order by partner_chunks.embedding <=> query_embedding
+  limit match_count;
+$$;
+
+-- The scoped queries filter on partner_id first
+create index if not exists partner_qa_partner_id_idx on partner_qa (partner_id);
+create index if not exists partner_chunks_partner_id_idx on partner_chunks (partner_id);
@@ -0,0 +1,66 @@
+-- Email change for PUT /auth/profile (account_jobs.EmailMigrationJobs).
+-- migrate_user_email moves every row of old_email to new_email in one
+-- transaction, so readers see either all old or all new rows. It returns
+-- the number of rows changed per table.
+
+create table if not exists email_migration_jobs (
+  id uuid primary key default gen_random_uuid(),
+  email text not null,                     -- old address
+  new_email text not null,
+  status text not null default 'queued',   -- queued | running | done | failed
+  step text,
+  counts jsonb not null default '{}'::jsonb,
+  error text,
+  claimed_by text,                         -- see account_deletion_jobs.sql
+  lease_until timestamptz not null default now(),
+  created_at timestamptz not null default now(),
+  updated_at timestamptz not null default now()
+);
+
+alter table email_migration_jobs add column if not exists claimed_by text;
+alter table email_migration_jobs add column if not exists lease_until timestamptz not null default now();
+
+create index if not exists email_migration_jobs_active
+  on email_migration_jobs (email, new_email)
+  where status in ('queued', 'running');
+
+-- previous_emails(): active migrations to an address
+create index if not exists email_migration_jobs_active_new_email
+  on email_migration_jobs (new_email)
+  where status in ('queued', 'running');
+
+create index if not exists chat_messages_user_email on chat_messages (user_email);
+create index if not exists user_clicks_user_email on user_clicks (user_email);
+create index if not exists user_chats_user_email on user_chats (user_email);
+
+create or replace function migrate_user_email(old_email text, new_email text)
+returns jsonb
+language plpgsql
+as $$
+declare
+  counts jsonb := '{}'::jsonb;
+  changed int;
+begin
+  update chat_messages set user_email = new_email where user_email = old_email;
+  get diagnostics changed = row_count;
+  counts := counts || jsonb_build_object('chat_messages', changed);
+
+  update user_clicks set user_email = new_email where user_email = old_email;
+  get diagnostics changed = row_count;
+  counts := counts || jsonb_build_object('user_clicks', changed);
+
+  update password_resets set email = new_email where email = old_email;
+  get diagnostics changed = row_count;
+  counts := counts || jsonb_build_object('password_resets', changed);
+
+  update email_verifications set email = new_email where email = old_email;
+  get diagnostics changed = row_count;
+  counts := counts || jsonb_build_object('email_verifications', changed);
+
+  update user_chats set user_email = new_email where user_email = old_email;
+  get diagnostics changed = row_count;
+  counts := counts || jsonb_build_object('user_chats', changed);
+
+  return counts;
+end;
+$$;
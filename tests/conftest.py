@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# The modules live at the repo root, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# chat / chat_async build their clients and write-behind logs at import
+os.environ.setdefault("SUPABASE_URL", "http://localhost:54321")
+os.environ.setdefault("SUPABASE_ANON_KEY", "test")
+os.environ.setdefault("SUPABASE_SERVICE_ROLE_KEY", "test")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("WRITE_BEHIND_SPOOL_DIR", tempfile.mkdtemp(prefix="spool-"))
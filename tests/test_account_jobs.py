@@ -0,0 +1,242 @@
+import itertools
+from types import SimpleNamespace
+
+import pytest
+
+import account_jobs
+from account_jobs import AccountDeletionJobs, EmailMigrationJobs, LeaseLost
+
+
+class FakeQuery:
+    def __init__(self, db, table):
+        self.db, self.table = db, table
+        self.filters = []
+        self.operation, self.values, self.count = "select", None, None
+
+    def select(self, columns):
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def lt(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] < value)
+        return self
+
+    def in_(self, column, values):
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def order(self, column):
+        return self
+
+    def limit(self, count):
+        self.count = count
+        return self
+
+    def delete(self):
+        self.operation = "delete"
+        return self
+
+    def update(self, values):
+        self.operation, self.values = "update", values
+        return self
+
+    def insert(self, values):
+        self.operation, self.values = "insert", values
+        return self
+
+    def execute(self):
+        rows = self.db.tables.setdefault(self.table, [])
+
+        if self.operation == "insert":
+            row = {"id": f"job-{next(self.db.ids)}", "created_at": account_jobs._now(), **self.values}
+            rows.append(row)
+            return SimpleNamespace(data=[dict(row)])
+
+        matched = [row for row in rows if all(f(row) for f in self.filters)]
+
+        if self.operation == "delete":
+            self.db.tables[self.table] = [row for row in rows if row not in matched]
+        elif self.operation == "update":
+            for row in matched:
+                row.update(self.values)
+
+        return SimpleNamespace(data=[dict(row) for row in matched[:self.count]])
+
+
+class FakeSupabase:
+    def __init__(self, tables):
+        self.tables = tables
+        self.ids = itertools.count(1)
+        self.deleted_users = []
+        self.auth = SimpleNamespace(admin=SimpleNamespace(delete_user=self.deleted_users.append))
+        self.rpc_deployed = False
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    def rpc(self, name, params):
+        def execute():
+            if not self.rpc_deployed:
+                raise RuntimeError(f"function {name} does not exist")
+
+            counts = {}
+
+            for table, (_, column, _) in account_jobs.MIGRATION_TABLES.items():
+                for row in self.tables.get(table, []):
+                    if row.get(column) == params["old_email"]:
+                        row[column] = params["new_email"]
+                        counts[table] = counts.get(table, 0) + 1
+
+            return SimpleNamespace(data=counts)
+
+        return SimpleNamespace(execute=execute)
+
+
+class FakeLog:
+    table = "fake"
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def discard(self, predicate):
+        before = len(self.rows)
+        self.rows[:] = [row for row in self.rows if not predicate(row)]
+        return before - len(self.rows)
+
+    def wait(self, predicate, timeout):
+        return not any(predicate(row) for row in self.rows)
+
+
+def account_tables():
+    return {
+        "user_chats": [{"id": i, "user_email": "a@b.c"} for i in range(7)] + [{"id": 99, "user_email": "z@b.c"}],
+        "chat_messages": [{"id": i, "chat_id": i % 7, "user_email": "a@b.c"} for i in range(20)]
+                         + [{"id": 50, "chat_id": 99, "user_email": "z@b.c"}],
+        "user_clicks": [{"id": i, "user_email": "a@b.c"} for i in range(5)],
+        "password_resets": [{"id": 1, "email": "a@b.c"}],
+        "email_verifications": [],
+        "user_profiles": [{"id": "u1", "email": "a@b.c"}],
+    }
+
+
+@pytest.fixture(autouse=True)
+def no_threads(monkeypatch):
+    # Jobs are run by the tests, not by a worker thread
+    monkeypatch.setattr(account_jobs.AccountJobs, "start", lambda self: None)
+    monkeypatch.setattr(account_jobs, "ACCOUNT_JOB_CHUNK_SIZE", 3)
+    monkeypatch.setattr(account_jobs, "WORKER_ID", "worker-a")
+
+
+@pytest.fixture
+def db():
+    return FakeSupabase(account_tables())
+
+
+def test_deletion_cascade(db):
+    messages = FakeLog([{"chat_id": 3}, {"chat_id": 99}])
+    clicks = FakeLog([{"user_email": "a@b.c"}, {"user_email": "z@b.c"}])
+    jobs = AccountDeletionJobs(db, message_log=messages, click_log=clicks)
+
+    job = jobs.submit(" A@b.c ", user_id="u1")
+    jobs.run(jobs.queue.get_nowait())
+
+    assert [c["id"] for c in db.tables["user_chats"]] == [99]
+    assert [m["id"] for m in db.tables["chat_messages"]] == [50]
+    assert db.tables["user_clicks"] == []
+    assert db.tables["user_profiles"] == []
+    assert db.deleted_users == ["u1"]
+
+    # Queued rows for the deleted chats / user were dropped, not written later
+    assert messages.rows == [{"chat_id": 99}]
+    assert clicks.rows == [{"user_email": "z@b.c"}]
+
+    done = jobs.get(job["id"])
+
+    assert done["status"] == "done"
+    assert done["steps_done"] == done["steps_total"]
+    assert done["counts"] == {"user_chats": 7, "user_clicks": 5}
+
+
+def test_submitting_again_returns_the_active_job(db):
+    jobs = AccountDeletionJobs(db)
+
+    assert jobs.submit("a@b.c")["id"] == jobs.submit("A@B.C")["id"]
+    assert jobs.queue.qsize() == 1
+
+
+def test_only_one_worker_claims_a_job(db, monkeypatch):
+    jobs = AccountDeletionJobs(db)
+    job = jobs.submit("a@b.c")
+
+    assert jobs._claim(dict(job))
+
+    monkeypatch.setattr(account_jobs, "WORKER_ID", "worker-b")
+
+    assert not jobs._claim(dict(job))
+
+    # worker-b skips it; nothing is deleted
+    jobs.run(dict(job))
+
+    assert len(db.tables["user_chats"]) == 8
+
+
+def test_expired_lease_is_resumed_by_another_worker(db, monkeypatch):
+    jobs = AccountDeletionJobs(db)
+    job = jobs.submit("a@b.c")
+    jobs.queue.get_nowait()
+
+    stale = dict(job)
+    assert jobs._claim(stale)
+
+    # worker-a dies; its lease runs out
+    db.tables["account_deletion_jobs"][0]["lease_until"] = "2000-01-01T00:00:00+00:00"
+    monkeypatch.setattr(account_jobs, "WORKER_ID", "worker-b")
+
+    jobs.resume()
+    jobs.run(jobs.queue.get_nowait())
+
+    assert jobs.get(job["id"])["status"] == "done"
+    assert jobs.get(job["id"])["claimed_by"] == "worker-b"
+
+    # worker-a coming back cannot write to the job any more
+    monkeypatch.setattr(account_jobs, "WORKER_ID", "worker-a")
+
+    with pytest.raises(LeaseLost):
+        jobs._update(stale, step="chats")
+
+
+def test_resume_skips_running_jobs_with_a_live_lease(db):
+    jobs = AccountDeletionJobs(db)
+    job = jobs.submit("a@b.c")
+    jobs.queue.get_nowait()
+    jobs._claim(dict(job))
+
+    jobs.resume()
+
+    assert jobs.queue.empty()
+
+
+@pytest.mark.parametrize("rpc_deployed", [True, False])
+def test_email_migration_moves_every_row(db, rpc_deployed):
+    db.rpc_deployed = rpc_deployed
+    jobs = EmailMigrationJobs(db, message_log=FakeLog([]), click_log=FakeLog([]))
+
+    job = jobs.submit("a@b.c", new_email="new@b.c")
+
+    assert jobs.previous_emails("NEW@b.c") == ["a@b.c"]
+    assert jobs.active_for("a@b.c")["id"] == job["id"]
+    assert jobs.active_for("new@b.c")["id"] == job["id"]
+
+    jobs.run(jobs.queue.get_nowait())
+
+    for table, (_, column, _) in account_jobs.MIGRATION_TABLES.items():
+        assert not [row for row in db.tables[table] if row[column] == "a@b.c"]
+
+    assert len([c for c in db.tables["user_chats"] if c["user_email"] == "new@b.c"]) == 7
+    assert jobs.get(job["id"])["counts"]["chat_messages"] == 20
+    assert jobs.previous_emails("new@b.c") == []
+    assert jobs.active_for("a@b.c") is None
+
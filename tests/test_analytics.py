@@ -0,0 +1,71 @@
+import pytest
+
+from analytics import AnalyticsPipeline, AnswerActionEvent, ClickEvent, SigninEvent, user_type
+
+
+class FakeTable:
+    def __init__(self, db, name):
+        self.db, self.name = db, name
+
+    def insert(self, rows):
+        self.rows = rows
+        return self
+
+    def execute(self):
+        self.db.written.setdefault(self.name, []).extend(self.rows)
+
+
+class FakeSupabase:
+    def __init__(self):
+        self.written = {}
+
+    def table(self, name):
+        return FakeTable(self, name)
+
+
+@pytest.fixture
+def db():
+    return FakeSupabase()
+
+
+@pytest.fixture
+def pipeline(db, tmp_path):
+    pipeline = AnalyticsPipeline(db, spool_dir=str(tmp_path), flush_seconds=60, queue_size=4)
+    yield pipeline
+    pipeline.close()
+
+
+def test_user_type():
+    assert user_type("guest") == "guest"
+    assert user_type("member") == "user"
+
+
+def test_events_go_to_their_own_tables(db, pipeline):
+    pipeline.track(ClickEvent(chat_id=1, button="yes", question="Q?", user_type="user"))
+    pipeline.track(AnswerActionEvent(chat_id=1, action="copy", source="bridge_qa"))
+    pipeline.track(SigninEvent(user_email="a@b.c"))
+
+    # Nothing is written on the request path
+    assert db.written == {}
+
+    pipeline.close()
+
+    assert db.written == {
+        "user_clicks": [{"chat_id": 1, "button": "yes", "question": "Q?", "user_email": None, "user_type": "user"}],
+        "answer_actions": [{
+            "chat_id": 1, "action": "copy", "answer_text": None, "source": "bridge_qa",
+            "user_email": None, "user_type": "guest"
+        }],
+        "user_signins": [{"user_email": "a@b.c"}],
+    }
+
+
+def test_stats_report_backpressure(pipeline):
+    for i in range(4):
+        pipeline.track(SigninEvent(user_email=f"{i}@b.c"))
+
+    stats = pipeline.stats()
+
+    assert stats["user_signins"]["depth"] == 4
+    assert stats["user_signins"]["backpressure"]
+    assert not stats["user_clicks"]["backpressure"]
@@ -0,0 +1,93 @@
+from types import SimpleNamespace
+
+import pytest
+
+import answer_cache
+from answer_cache import AnswerCache, answer_cache_applies, answer_cache_route
+
+
+class FakeQuery:
+    def __init__(self, db, table):
+        self.db, self.table = db, table
+
+    def select(self, columns, count=None):
+        return self
+
+    def order(self, column, desc=False):
+        return self
+
+    def limit(self, count):
+        return self
+
+    def execute(self):
+        count, newest = self.db.versions[self.table]
+        return SimpleNamespace(data=[{"updated_at": newest}], count=count)
+
+
+class FakeSupabase:
+    def __init__(self):
+        self.versions = {table: (1, "2026-01-01T00:00:00+00:00") for table in answer_cache.KNOWLEDGE_TABLES}
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+
+@pytest.fixture
+def db():
+    return FakeSupabase()
+
+
+@pytest.fixture
+def cache(db, monkeypatch):
+    monkeypatch.setattr(answer_cache, "ANSWER_CACHE_VERSION_CHECK_SECONDS", 0)
+    cache = AnswerCache(capacity=4, threshold=0.95)
+    cache.check_version(db)
+    return cache
+
+
+def test_route_is_the_sorted_partner_ids():
+    assert answer_cache_route([], []) == "open"
+    assert answer_cache_route([{"partner_id": 7}], [{"partner_id": 3}, {"partner_id": 7}]) == "partner:3,7"
+
+
+def test_rewritten_follow_ups_bypass_the_cache(monkeypatch):
+    monkeypatch.setattr(answer_cache, "ANSWER_CACHE_ENABLED", True)
+
+    assert answer_cache_applies("Who is Liiontek?", " who is liiontek? ", [1.0])
+    assert not answer_cache_applies("How much?", "How much is a Liiontek cabinet?", [1.0])
+    assert not answer_cache_applies("Who is Liiontek?", "Who is Liiontek?", None)
+
+
+def test_similar_question_on_same_route_hits(cache):
+    cache.store("open", [1, 0, 0], {"answer": "A"})
+
+    assert cache.lookup("open", [1, 0.05, 0]) == {"answer": "A"}
+    assert cache.lookup("partner:1", [1, 0, 0]) is None
+    assert cache.lookup("open", [0, 1, 0]) is None
+
+
+def test_hit_is_a_copy(cache):
+    cache.store("open", [1, 0], {"answer": "A", "buttons": []})
+    cache.lookup("open", [1, 0])["buttons"].append("x")
+
+    assert cache.lookup("open", [1, 0]) == {"answer": "A", "buttons": []}
+
+
+def test_knowledge_change_invalidates(cache, db):
+    cache.store("open", [1, 0], {"answer": "A"})
+    cache.check_version(db)
+
+    assert cache.lookup("open", [1, 0]) == {"answer": "A"}
+
+    # An edit bumps the trigger-maintained updated_at
+    db.versions["partner_chunks"] = (1, "2026-01-02T00:00:00+00:00")
+    cache.check_version(db)
+
+    assert cache.lookup("open", [1, 0]) is None
+
+
+def test_expired_entry_misses(cache):
+    cache.ttl_seconds = -1
+    cache.store("open", [1, 0], {"answer": "A"})
+
+    assert cache.lookup("open", [1, 0]) is None
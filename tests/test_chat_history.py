@@ -0,0 +1,133 @@
+import pytest
+
+import chat_history
+from chat_history import ChatHistoryBuffer, HistoryCompactor, history_key, summary_message
+
+
+def turn(role, content):
+    return {"role": role, "content": content}
+
+
+def conversation(prefix, n):
+    return [
+        turn("user" if i % 2 == 0 else "assistant", f"{prefix} message {i} " + "word " * 20)
+        for i in range(n)
+    ]
+
+
+def summarize(previous, messages):
+    return (previous or "") + "|" + ",".join(m["content"].split()[0] for m in messages)
+
+
+@pytest.fixture
+def compactor(monkeypatch):
+    monkeypatch.setattr(chat_history, "HISTORY_SUMMARY_MIN_NEW", 2)
+    monkeypatch.setattr(chat_history, "HISTORY_MIN_VERBATIM", 2)
+    return HistoryCompactor(budget=60)
+
+
+def test_history_within_budget_is_unchanged(compactor):
+    history = conversation("a", 2)
+    assert compactor.compact(1, history, summarize) == history
+
+
+def test_old_turns_are_summarized_and_recent_kept(compactor):
+    history = conversation("a", 10)
+    compacted = compactor.compact(1, history, summarize)
+
+    assert compacted[0]["role"] == "system"
+    assert compacted[-1] == history[-1]
+    assert len(compacted) < len(history)
+
+
+def test_summary_failure_keeps_old_turns_verbatim(compactor):
+    history = conversation("a", 11)
+
+    def failing(previous, messages):
+        raise RuntimeError("down")
+
+    assert compactor.compact(1, history, failing) == history
+
+
+def test_summary_not_reused_when_its_last_message_is_gone(compactor):
+    compactor.compact(1, conversation("alice", 10), summarize)
+    other = conversation("bob", 10)
+
+    compacted = compactor.compact(1, other, summarize)
+
+    assert "alice" not in compacted[0]["content"]
+
+
+def test_guests_with_same_opener_never_share_summaries(compactor):
+    alice = [turn("user", "hi")] + conversation("alice", 10)
+    bob = [turn("user", "hi")] + conversation("bob", 10)
+
+    assert history_key(None, alice) is None
+
+    compactor.compact(None, alice, summarize)
+    compacted = compactor.compact(None, bob, summarize)
+
+    assert all("alice" not in m["content"] for m in compacted)
+
+
+def test_guest_summary_reused_for_same_prefix(compactor):
+    history = conversation("g", 10)
+    calls = []
+
+    def counting(previous, messages):
+        calls.append(len(messages))
+        return summarize(previous, messages)
+
+    first = compactor.compact(None, history, counting)
+    second = compactor.compact(None, history, counting)
+
+    assert first == second
+    assert len(calls) == 1
+
+
+def test_summary_message_shape():
+    assert summary_message("x") == {
+        "role": "system",
+        "content": "Summary of the earlier conversation:\nx"
+    }
+
+
+def test_buffer_appends_to_loaded_chats_only():
+    buffer = ChatHistoryBuffer()
+
+    assert buffer.get(1) is None
+
+    buffer.load(1, [turn("user", "hi")])
+    buffer.append(1, "assistant", "hello")
+    buffer.append(1, "system", "ignored")
+    buffer.append(2, "user", "not buffered")
+
+    assert buffer.get(1) == [turn("user", "hi"), turn("assistant", "hello")]
+    assert buffer.get(2) is None
+
+
+def test_buffer_keeps_the_last_messages():
+    buffer = ChatHistoryBuffer()
+    buffer.load(1, conversation("a", chat_history.HISTORY_MAX_MESSAGES))
+    buffer.append(1, "user", "newest")
+
+    history = buffer.get(1)
+
+    assert len(history) == chat_history.HISTORY_MAX_MESSAGES
+    assert history[-1] == turn("user", "newest")
+
+
+def test_buffer_evicts_least_recent_chat_and_expires():
+    buffer = ChatHistoryBuffer(max_chats=2)
+    buffer.load(1, [])
+    buffer.load(2, [])
+    buffer.get(1)
+    buffer.load(3, [])
+
+    assert buffer.get(2) is None
+    assert buffer.get(1) == []
+
+    expired = ChatHistoryBuffer(ttl_seconds=-1)
+    expired.load(1, [turn("user", "hi")])
+
+    assert expired.get(1) is None
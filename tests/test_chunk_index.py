@@ -0,0 +1,86 @@
+import pytest
+
+from chunk_index import STOP_WORDS, PartnerChunkIndex
+from partners import _normalize
+
+ROWS = [
+    {"id": 1, "partner_id": "p1", "content": "Liiontek builds lithium battery fire containment cabinets."},
+    {"id": 2, "partner_id": "p1", "content": "Battery cabinets are certified; fire tests are run yearly."},
+    {"id": 3, "partner_id": "p1", "content": "Contact Liiontek sales for pricing and delivery times."},
+    {"id": 4, "partner_id": "p2", "content": "Crew insurance with worldwide medical cover for yacht crew."},
+    {"id": 5, "partner_id": "p2", "content": "Medical cover for crew injuries abroad, including evacuation."},
+    {"id": 6, "partner_id": "p3", "content": "Lithium battery fire cabinets for tenders and jet skis."},
+]
+
+
+def baseline_best(message: str, rows: list):
+    """
+    The scan get_best_triggered_partner_chunk did before the index.
+    """
+    q_words = [w for w in _normalize(message).split() if len(w) > 2 and w not in STOP_WORDS]
+
+    if not q_words:
+        return None
+
+    scored = []
+
+    for row in rows:
+        content_norm = _normalize(row.get("content") or "")
+        score = 0
+
+        for word in q_words:
+            if word in content_norm:
+                score += 3
+
+        for i in range(len(q_words) - 1):
+            if f"{q_words[i]} {q_words[i + 1]}" in content_norm:
+                score += 10
+
+        for i in range(len(q_words) - 2):
+            if f"{q_words[i]} {q_words[i + 1]} {q_words[i + 2]}" in content_norm:
+                score += 20
+
+        scored.append((score, row))
+
+    scored.sort(key=lambda x: x[0], reverse=True)
+
+    if scored[0][0] <= 0:
+        return None
+
+    return scored[0][1]
+
+
+@pytest.fixture(scope="module")
+def index():
+    index = PartnerChunkIndex()
+    index.build(ROWS)
+    return index
+
+
+@pytest.mark.parametrize("question, partner_ids", [
+    ("Do you have lithium battery fire cabinets?", {"p1"}),
+    ("Are the battery cabinets certified?", {"p1"}),
+    ("What is the pricing for delivery?", {"p1"}),
+    ("Medical cover for crew injuries?", {"p2"}),
+    ("Does it include evacuation?", {"p2"}),
+    ("Lithium battery fire cabinets", {"p1", "p3"}),
+    ("fire cabinets for tenders", {"p1", "p3"}),
+    ("Teak deck restoration", {"p1", "p2", "p3"}),
+    ("What is it?", {"p1"}),
+])
+def test_matches_the_baseline_scan(index, question, partner_ids):
+    rows = [row for row in ROWS if row["partner_id"] in partner_ids]
+
+    assert index.best_overlap(question, partner_ids) == baseline_best(question, rows)
+
+
+def test_only_the_given_partners(index):
+    assert index.best_overlap("crew insurance", {"p1"}) is None
+
+
+def test_removed_rows_are_not_returned():
+    index = PartnerChunkIndex()
+    index.build(ROWS)
+    index.remove([1])
+
+    assert index.best_overlap("lithium battery fire containment", {"p1"})["id"] == 2
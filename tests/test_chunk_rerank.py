@@ -0,0 +1,99 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("openai")
+pytest.importorskip("supabase")
+
+import chat
+import chat_async
+from rerank_cache import RerankCache
+
+SLOW_SECONDS = 0.5
+
+
+def make_chunks(slow_second_batch=False):
+    chunks = [{"id": i, "content": f"filler {i}"} for i in range(40)]
+    chunks[3]["content"] = "winner one"
+    chunks[25]["content"] = "winner two"
+
+    if slow_second_batch:
+        chunks[30]["content"] = "slow"
+
+    return chunks
+
+
+def pick(messages):
+    """
+    First pass: the "winner" chunk of the batch. Final pass (only winners):
+    the last one, so the result shows which winners made it.
+    """
+    contents = [c["content"] for c in json.loads(messages[-1]["content"])["chunks"]]
+
+    if all(content.startswith("winner") for content in contents):
+        index = len(contents) - 1
+    else:
+        index = next(i for i, content in enumerate(contents) if content.startswith("winner"))
+
+    return contents, json.dumps({"index": index})
+
+
+def response(raw):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=raw))])
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(chat, "RERANK_CACHE", RerankCache())
+    monkeypatch.setattr(chat_async, "RERANK_CACHE", RerankCache())
+    monkeypatch.setattr(chat, "CHUNK_RERANK_DEADLINE_SECONDS", 0.1)
+    monkeypatch.setattr(chat_async, "CHUNK_RERANK_DEADLINE_SECONDS", 0.1)
+
+
+@pytest.fixture
+def sync_llm(monkeypatch):
+    def create(model, messages, temperature):
+        contents, raw = pick(messages)
+
+        if "slow" in contents:
+            time.sleep(SLOW_SECONDS)
+
+        return response(raw)
+
+    completions = SimpleNamespace(create=create)
+    monkeypatch.setattr(chat, "client", SimpleNamespace(chat=SimpleNamespace(completions=completions)))
+
+
+@pytest.fixture
+def async_llm(monkeypatch):
+    async def complete(messages, temperature):
+        contents, raw = pick(messages)
+
+        if "slow" in contents:
+            await asyncio.sleep(SLOW_SECONDS)
+
+        return raw
+
+    monkeypatch.setattr(chat_async, "_complete", complete)
+
+
+def test_all_batches_in_time(sync_llm):
+    assert chat.choose_best_chunk_with_ai("q", make_chunks())["id"] == 25
+
+
+def test_slow_batch_is_dropped_at_deadline(sync_llm):
+    started_at = time.perf_counter()
+
+    assert chat.choose_best_chunk_with_ai("q", make_chunks(slow_second_batch=True))["id"] == 3
+    assert time.perf_counter() - started_at < SLOW_SECONDS
+
+
+def test_async_slow_batch_is_dropped_at_deadline(async_llm):
+    async def run(chunks):
+        return await chat_async.choose_best_chunk_with_ai_async("q", chunks)
+
+    assert asyncio.run(run(make_chunks()))["id"] == 25
+    assert asyncio.run(run(make_chunks(slow_second_batch=True)))["id"] == 3
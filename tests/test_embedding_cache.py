@@ -0,0 +1,64 @@
+from types import SimpleNamespace
+
+from embedding_cache import EmbeddingCache, cache_key
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls = []
+        self.embeddings = self
+
+    def create(self, model, input):
+        self.calls.append(input)
+        texts = input if isinstance(input, list) else [input]
+
+        return SimpleNamespace(data=[
+            SimpleNamespace(embedding=[float(len(text)), 0.5]) for text in texts
+        ])
+
+
+def test_key_ignores_whitespace_but_not_model():
+    assert cache_key("m", " a  b\n") == cache_key("m", "a b")
+    assert cache_key("m", "a b") != cache_key("other", "a b")
+
+
+def test_embed_calls_the_api_once_per_text():
+    cache, client = EmbeddingCache(), FakeClient()
+
+    assert cache.embed(client, "hello") == [5.0, 0.5]
+    assert cache.embed(client, " hello ") == [5.0, 0.5]
+    assert client.calls == ["hello"]
+    assert cache.stats()["hits"] == 1
+
+
+def test_embed_many_batches_only_the_misses():
+    cache, client = EmbeddingCache(), FakeClient()
+    cache.embed(client, "b")
+
+    assert cache.embed_many(client, ["a", "b", "ccc"]) == [[1.0, 0.5], [1.0, 0.5], [3.0, 0.5]]
+    assert client.calls == ["b", ["a", "ccc"]]
+
+
+def test_least_recently_used_is_evicted():
+    cache = EmbeddingCache(max_size=2)
+    cache.store("m", "one", [1.0])
+    cache.store("m", "two", [2.0])
+    cache.lookup("m", "one")
+    cache.store("m", "three", [3.0])
+
+    assert cache.lookup("m", "two") is None
+    assert cache.lookup("m", "one") == [1.0]
+
+
+def test_disk_tier_survives_a_restart(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite")
+    EmbeddingCache(path=path).store("m", "text", [0.25, -1.5])
+
+    restarted = EmbeddingCache(path=path)
+
+    assert restarted.lookup("m", "text") == [0.25, -1.5]
+    assert restarted.stats()["disk_hits"] == 1
+
+    # Now in memory too
+    assert restarted.lookup("m", "text") == [0.25, -1.5]
+    assert restarted.stats()["hits"] == 1
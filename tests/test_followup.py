@@ -0,0 +1,35 @@
+import pytest
+
+from followup import needs_rewrite
+
+HISTORY = [
+    {"role": "user", "content": "Who installs lithium battery cabinets?"},
+    {"role": "assistant", "content": "Liiontek does."},
+]
+
+
+@pytest.mark.parametrize("message", [
+    "How much does it cost?",
+    "Are those fireproof?",
+    "And for tenders?",
+    "What about Antibes",
+    "price?",
+])
+def test_follow_ups_need_rewrite(message):
+    assert needs_rewrite(message, HISTORY)
+
+
+@pytest.mark.parametrize("message", [
+    "Which insurance covers crew injuries abroad?",
+    "How do I register a yacht under the Cayman flag?",
+])
+def test_standalone_questions_are_searched_as_is(message):
+    assert not needs_rewrite(message, HISTORY)
+
+
+def test_no_history_never_rewrites():
+    assert not needs_rewrite("How much does it cost?", [])
+
+
+def test_empty_message():
+    assert not needs_rewrite("  ?! ", HISTORY)
@@ -0,0 +1,31 @@
+from partners import KeywordAutomaton, compact
+
+
+def automaton(*keywords):
+    return KeywordAutomaton([(keyword, compact(keyword)) for keyword in keywords])
+
+
+def test_compact_drops_case_punctuation_and_spaces():
+    assert compact("  Lithium-Ion Battery! ") == "lithiumionbattery"
+
+
+def test_finds_every_keyword_in_one_pass():
+    found = automaton("battery", "fire", "crew").find_all(compact("Battery fire on board"))
+
+    assert found == {"battery", "fire"}
+
+
+def test_overlapping_and_nested_keywords():
+    # "she" / "he" / "hers" share suffixes, so they need the failure links
+    found = automaton("he", "she", "his", "hers").find_all("ushers")
+
+    assert found == {"he", "she", "hers"}
+
+
+def test_keyword_spanning_words_matches_compacted_text():
+    assert automaton("sea star").find_all(compact("Is Sea Star any good?")) == {"sea star"}
+
+
+def test_no_match_and_empty_keywords():
+    assert automaton("anchor", "").find_all(compact("teak deck")) == set()
+    assert KeywordAutomaton([]).find_all("anything") == set()
@@ -0,0 +1,112 @@
+from types import SimpleNamespace
+
+from profiles import ProfileCache
+
+
+class FakeQuery:
+    def __init__(self, db):
+        self.db = db
+
+    def select(self, columns):
+        return self
+
+    def eq(self, column, value):
+        self.email = value
+        return self
+
+    def limit(self, count):
+        return self
+
+    def execute(self):
+        self.db.reads += 1
+
+        if self.db.down:
+            raise ConnectionError("unreachable")
+
+        profile = self.db.profiles.get(self.email)
+        return SimpleNamespace(data=[dict(profile)] if profile else [])
+
+
+class FakeSupabase:
+    def __init__(self):
+        self.profiles = {}
+        self.reads = 0
+        self.down = False
+
+    def table(self, name):
+        return FakeQuery(self)
+
+
+def test_read_through_and_cached():
+    db = FakeSupabase()
+    db.profiles["a@b.c"] = {"id": "u1", "name": "Ann", "email": "a@b.c"}
+    cache = ProfileCache()
+
+    assert cache.get(db, " A@b.c")["name"] == "Ann"
+    assert cache.get(db, "a@b.c")["name"] == "Ann"
+    assert db.reads == 1
+
+
+def test_returned_profile_is_a_copy():
+    db = FakeSupabase()
+    db.profiles["a@b.c"] = {"id": "u1", "name": "Ann", "email": "a@b.c"}
+    cache = ProfileCache()
+
+    cache.get(db, "a@b.c")["name"] = "changed"
+
+    assert cache.get(db, "a@b.c")["name"] == "Ann"
+
+
+def test_missing_profile_is_not_cached():
+    db = FakeSupabase()
+    cache = ProfileCache()
+
+    assert cache.get(db, "a@b.c") is None
+
+    db.profiles["a@b.c"] = {"id": "u1", "name": "Ann", "email": "a@b.c"}
+
+    assert cache.get(db, "a@b.c")["name"] == "Ann"
+
+
+def test_invalidate_rereads_after_a_rename():
+    db = FakeSupabase()
+    db.profiles["a@b.c"] = {"id": "u1", "name": "Ann", "email": "a@b.c"}
+    cache = ProfileCache()
+    cache.get(db, "a@b.c")
+
+    db.profiles["a@b.c"]["name"] = "Anne"
+    cache.invalidate("A@B.C")
+
+    assert cache.name(db, "a@b.c") == "Anne"
+
+
+def test_name_falls_back_to_the_email():
+    db = FakeSupabase()
+    db.down = True
+
+    assert ProfileCache().name(db, "ann.smith@b.c") == "Ann.smith"
+
+
+def test_least_recently_used_and_expired_are_reread():
+    db = FakeSupabase()
+
+    for email in ("a@b.c", "b@b.c", "c@b.c"):
+        db.profiles[email] = {"id": email, "name": email, "email": email}
+
+    cache = ProfileCache(max_size=2)
+    cache.get(db, "a@b.c")
+    cache.get(db, "b@b.c")
+    cache.get(db, "a@b.c")
+    cache.get(db, "c@b.c")
+    db.reads = 0
+
+    cache.get(db, "a@b.c")
+    cache.get(db, "b@b.c")
+
+    assert db.reads == 1
+
+    expired = ProfileCache(ttl_seconds=-1)
+    expired.get(db, "a@b.c")
+    expired.get(db, "a@b.c")
+
+    assert db.reads == 3
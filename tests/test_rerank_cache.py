@@ -0,0 +1,45 @@
+from rerank_cache import RerankCache, rerank_key
+
+
+def candidates(*contents):
+    return [{"index": i, "content": content} for i, content in enumerate(contents)]
+
+
+def test_miss_then_hit_returns_same_position():
+    cache = RerankCache()
+    batch = candidates("a", "b", "c")
+
+    assert cache.lookup("Which one?", batch) == (False, None)
+
+    cache.store("Which one?", batch, batch[1])
+
+    # New dicts with the same content, as a later request would build
+    assert cache.lookup("  which ONE? ", candidates("a", "b", "c")) == (True, batch[1])
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 1}
+
+
+def test_no_pick_is_cached():
+    cache = RerankCache()
+    batch = candidates("a", "b")
+    cache.store("q", batch, None)
+
+    assert cache.lookup("q", batch) == (True, None)
+
+
+def test_changed_content_or_order_is_a_different_key():
+    assert rerank_key("q", candidates("a", "b")) != rerank_key("q", candidates("a", "changed"))
+    assert rerank_key("q", candidates("a", "b")) != rerank_key("q", candidates("b", "a"))
+
+
+def test_least_recently_used_is_evicted():
+    cache = RerankCache(max_size=2)
+    one, two, three = candidates("1"), candidates("2"), candidates("3")
+
+    cache.store("q", one, None)
+    cache.store("q", two, None)
+    cache.lookup("q", one)
+    cache.store("q", three, None)
+
+    assert cache.lookup("q", one)[0]
+    assert not cache.lookup("q", two)[0]
+    assert cache.lookup("q", three)[0]
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+import rerankers
+from chunk_index import PartnerChunkIndex
+from rerankers import LocalChunkReranker, chunk_rerank_route
+
+ROWS = [
+    {"id": 1, "partner_id": "p1", "content": "Lithium battery fire containment cabinets for yachts and tenders"},
+    {"id": 2, "partner_id": "p2", "content": "Crew insurance for superyacht crew members worldwide"},
+    {"id": 3, "partner_id": "p3", "content": "Satellite internet and onboard network installation"},
+    {"id": 4, "partner_id": "p4", "content": "Teak deck restoration and caulking services"},
+]
+
+
+@pytest.fixture
+def reranker():
+    index = PartnerChunkIndex()
+    index.build(ROWS)
+    index.ensure_fresh = lambda supabase: None
+
+    return LocalChunkReranker(index=index)
+
+
+def chunks(similarity=0.3):
+    return [dict(row, similarity=similarity) for row in ROWS]
+
+
+def test_picks_the_chunk_matching_the_question(reranker):
+    assert reranker.pick(None, "Which battery fire cabinets exist?", chunks())["id"] == 1
+
+
+def test_rejects_when_no_candidate_really_matches(reranker):
+    # One weak word in common; normalizing to the best candidate used to accept it
+    assert reranker.pick(None, "What about teak anchor chain pricing?", chunks()) is None
+
+
+@pytest.mark.skipif("CHUNK_RERANKER_ROUTES" in os.environ, reason="routes configured")
+def test_routes_default_to_llm():
+    assert rerankers.CHUNK_RERANKER_ROUTES == {}
+    assert rerankers.reranker_for("What is a flag state?") == "llm"
+
+
+def test_route_of_question():
+    assert chunk_rerank_route("What is a flag state?") == "factual"
+    assert chunk_rerank_route("Who is the best insurance provider?") == "open"
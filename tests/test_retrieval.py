@@ -0,0 +1,110 @@
+from types import SimpleNamespace
+
+import pytest
+
+import retrieval
+from retrieval import RetrievalSession, narrow
+
+ROWS = [
+    {"id": 1, "partner_id": "p1", "similarity": 0.9},
+    {"id": 2, "partner_id": "p2", "similarity": 0.7},
+    {"id": 3, "partner_id": "p1", "similarity": 0.5},
+    {"id": 4, "partner_id": "p3", "similarity": 0.35},
+]
+
+
+class FakeSupabase:
+    def __init__(self, failing=()):
+        self.calls = []
+        self.failing = set(failing)
+
+    def rpc(self, name, params):
+        self.calls.append(name)
+
+        def execute():
+            if name in self.failing:
+                raise RuntimeError(f"function {name} does not exist")
+
+            rows = [row for row in ROWS if row["similarity"] >= params["match_threshold"]]
+
+            if "partner_ids" in params:
+                rows = [row for row in rows if row["partner_id"] in params["partner_ids"]]
+
+            return SimpleNamespace(data=rows[:params["match_count"]])
+
+        return SimpleNamespace(execute=execute)
+
+
+def ids(rows):
+    return [row["id"] for row in rows]
+
+
+def test_narrow_is_a_tighter_query_over_the_wider_result():
+    shuffled = [ROWS[2], ROWS[0], ROWS[3], ROWS[1]]
+
+    assert ids(narrow(shuffled, 0.5, 10)) == [1, 2, 3]
+    assert ids(narrow(shuffled, 0, 2)) == [1, 2]
+
+
+def test_narrow_keeps_rows_without_a_score():
+    assert ids(narrow([{"id": 9}, ROWS[3]], 0.5, 5)) == [9]
+
+
+@pytest.mark.parametrize("mode", ["sequential", "parallel"])
+def test_each_corpus_is_fetched_once_per_session(mode):
+    db = FakeSupabase()
+    session = RetrievalSession(db, [0.1], mode=mode)
+    session.prefetch()
+
+    assert ids(session.results("partner_docs")) == [1, 2, 3, 4]
+    assert ids(session.query("match_partner_chunks", 0.6, 5)) == [1, 2]
+
+    session.finish()
+
+    assert db.calls.count("match_partner_chunks") == 1
+
+    if mode == "sequential":
+        assert db.calls == ["match_partner_chunks"]
+
+
+def test_no_embedding_means_no_retrieval():
+    db = FakeSupabase()
+
+    assert RetrievalSession(db, None).results("bridge_qa") == []
+    assert db.calls == []
+
+
+@pytest.fixture
+def scoped_state(monkeypatch):
+    monkeypatch.setattr(retrieval, "_scoped_failed_at", {})
+    monkeypatch.setattr(retrieval, "PARTNER_SCOPED_RETRIEVAL", True)
+
+
+def test_scoped_query_takes_top_k_inside_the_partners(scoped_state):
+    db = FakeSupabase()
+    session = RetrievalSession(db, [0.1])
+
+    assert ids(session.query("match_partner_chunks", 0.3, 1, partner_ids={"p1"})) == [1]
+    assert ids(session.query("match_partner_chunks", 0.3, 5, partner_ids={"p3"})) == [4]
+    assert db.calls == ["match_partner_chunks_scoped", "match_partner_chunks_scoped"]
+
+
+def test_failing_scoped_rpc_falls_back_and_is_skipped_until_retry(scoped_state, monkeypatch):
+    db = FakeSupabase(failing={"match_partner_chunks_scoped"})
+
+    rows = RetrievalSession(db, [0.1]).query("match_partner_chunks", 0.3, 5, partner_ids={"p1"})
+
+    assert ids(rows) == [1, 3]
+    assert db.calls == ["match_partner_chunks_scoped", "match_partner_chunks"]
+
+    # Within SCOPED_RPC_RETRY_SECONDS the scoped RPC is not tried again
+    db.calls.clear()
+    RetrievalSession(db, [0.1]).query("match_partner_chunks", 0.3, 5, partner_ids={"p1"})
+
+    assert db.calls == ["match_partner_chunks"]
+
+    monkeypatch.setattr(retrieval, "SCOPED_RPC_RETRY_SECONDS", -1)
+    db.calls.clear()
+    RetrievalSession(db, [0.1]).query("match_partner_chunks", 0.3, 5, partner_ids={"p1"})
+
+    assert db.calls[0] == "match_partner_chunks_scoped"
@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("openai")
+pytest.importorskip("supabase")
+
+import chat_async
+from chat_async import DeferredAnswer, stream_answer_events
+
+
+def deltas(*parts, fail_after=None):
+    async def generate(self):
+        for i, part in enumerate(parts):
+            if i == fail_after:
+                raise ConnectionError("stream dropped")
+
+            yield part
+
+    return generate
+
+
+def collect(result):
+    async def run():
+        return [event async for event in stream_answer_events(result)]
+
+    return asyncio.run(run())
+
+
+@pytest.fixture
+def stored(monkeypatch):
+    stored = []
+    monkeypatch.setattr(chat_async.ANSWER_CACHE, "store", lambda *args: stored.append(args))
+    return stored
+
+
+def deferred_result():
+    return {
+        "answer": DeferredAnswer([], 0),
+        "source": "bridge_docs_raw",
+        "_answer_cache": ("open", [0.1])
+    }
+
+
+def test_finished_stream_is_cached_and_done(monkeypatch, stored):
+    monkeypatch.setattr(DeferredAnswer, "_deltas", deltas("Hello", " there."))
+
+    events = collect(deferred_result())
+
+    assert [e for e, _ in events] == ["meta", "token", "token", "done"]
+    assert events[-1][1]["answer"] == "Hello there."
+    assert len(stored) == 1
+
+
+def test_failed_stream_ends_with_error_and_is_not_cached(monkeypatch, stored):
+    monkeypatch.setattr(DeferredAnswer, "_deltas", deltas("Hello", " the", "re.", fail_after=2))
+
+    events = collect(deferred_result())
+
+    assert [e for e, _ in events] == ["meta", "token", "token", "error"]
+    assert events[-1][1]["source"] == "error"
+    assert stored == []
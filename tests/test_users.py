@@ -0,0 +1,141 @@
+from types import SimpleNamespace
+
+import users
+from users import AuthUserDirectory, UserLookup
+
+
+def auth_user(id, email):
+    return SimpleNamespace(id=id, email=email)
+
+
+class FakeQuery:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def select(self, columns):
+        return self
+
+    def eq(self, column, value):
+        self.rows = [row for row in self.rows if row[column] == value]
+        return self
+
+    def limit(self, count):
+        return self
+
+    def execute(self):
+        return SimpleNamespace(data=self.rows)
+
+
+class FakeSupabase:
+    def __init__(self, rpc_deployed=True):
+        self.users = {}
+        self.profiles = []
+        self.rpc_deployed = rpc_deployed
+        self.calls = []
+        self.auth = SimpleNamespace(admin=self)
+
+    def add_user(self, id, email, profile=True):
+        self.users[id] = auth_user(id, email)
+
+        if profile:
+            self.profiles.append({"id": id, "email": email})
+
+    def table(self, name):
+        self.calls.append(name)
+        return FakeQuery(self.profiles)
+
+    def rpc(self, name, params):
+        self.calls.append(name)
+
+        def execute():
+            if not self.rpc_deployed:
+                raise RuntimeError("function auth_user_id_by_email does not exist")
+
+            return SimpleNamespace(data=next(
+                (u.id for u in self.users.values() if u.email == params["lookup_email"]),
+                None
+            ))
+
+        return SimpleNamespace(execute=execute)
+
+    def get_user_by_id(self, user_id):
+        self.calls.append("get_user_by_id")
+        return SimpleNamespace(user=self.users.get(user_id))
+
+    def list_users(self, page, per_page):
+        self.calls.append("list_users")
+        return list(self.users.values())[(page - 1) * per_page:page * per_page]
+
+
+def test_found_through_the_profile_then_cached():
+    db = FakeSupabase()
+    db.add_user("u1", "a@b.c")
+    lookup = UserLookup()
+
+    assert lookup.get(db, " A@B.c ").id == "u1"
+    assert db.calls == ["user_profiles", "get_user_by_id"]
+
+    db.calls.clear()
+
+    assert lookup.get(db, "a@b.c").id == "u1"
+    assert db.calls == []
+
+
+def test_auth_user_without_profile_found_through_the_rpc():
+    db = FakeSupabase()
+    db.add_user("u1", "a@b.c", profile=False)
+
+    assert UserLookup().get(db, "a@b.c").id == "u1"
+    assert "list_users" not in db.calls
+
+
+def test_stale_profile_email_is_not_trusted():
+    db = FakeSupabase()
+    db.add_user("u1", "new@b.c", profile=False)
+    db.profiles.append({"id": "u1", "email": "old@b.c"})
+
+    assert UserLookup().get(db, "old@b.c") is None
+
+
+def test_unknown_email_is_not_cached():
+    db = FakeSupabase()
+    lookup = UserLookup()
+
+    assert lookup.get(db, "a@b.c") is None
+
+    db.add_user("u1", "a@b.c")
+
+    assert lookup.get(db, "a@b.c").id == "u1"
+
+
+def test_without_the_rpc_the_snapshot_rescans_at_most_once_per_window(monkeypatch):
+    db = FakeSupabase(rpc_deployed=False)
+    db.add_user("u1", "a@b.c", profile=False)
+    directory = AuthUserDirectory()
+
+    assert directory.lookup(db, "a@b.c") == "u1"
+    assert db.calls == ["auth_user_id_by_email", "list_users"]
+
+    # A new user misses; the snapshot was just loaded, so no rescan yet
+    db.add_user("u2", "new@b.c", profile=False)
+    db.calls.clear()
+
+    assert directory.lookup(db, "new@b.c") is None
+    assert db.calls == []
+
+    monkeypatch.setattr(users, "USER_DIRECTORY_MISS_REFRESH_SECONDS", -1)
+
+    assert directory.lookup(db, "new@b.c") == "u2"
+    assert db.calls == ["list_users"]
+
+
+def test_remember_and_forget_keep_the_directory_current():
+    lookup = UserLookup()
+    lookup.remember("A@b.c", auth_user("u1", "a@b.c"))
+
+    assert lookup.directory.ids == {"a@b.c": "u1"}
+
+    lookup.forget("a@b.c")
+
+    assert lookup.directory.ids == {}
+    assert lookup.stats()["size"] == 0
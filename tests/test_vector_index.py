@@ -0,0 +1,119 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from vector_index import CorpusIndex
+
+
+class FakeQuery:
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.not_ = self
+        self.start, self.stop = 0, None
+
+    def select(self, columns, count=None):
+        return self
+
+    def order(self, column):
+        self.rows.sort(key=lambda r: (r["updated_at"], r["id"]))
+        return self
+
+    def gt(self, column, value):
+        self.rows = [r for r in self.rows if r[column] > value]
+        return self
+
+    def is_(self, column, value):
+        self.rows = [r for r in self.rows if r[column] is not None]
+        return self
+
+    def range(self, start, stop):
+        self.start, self.stop = start, stop + 1
+        return self
+
+    def limit(self, count):
+        self.stop = count
+        return self
+
+    def execute(self):
+        return SimpleNamespace(data=self.rows[self.start:self.stop], count=len(self.rows))
+
+
+class FakeSupabase:
+    def __init__(self):
+        self.rows = {}
+
+    def put(self, id, partner_id, embedding, minute):
+        self.rows[id] = {
+            "id": id,
+            "partner_id": partner_id,
+            "content": f"chunk {id}",
+            "embedding": embedding,
+            "updated_at": f"2026-01-01T00:{minute:02d}:00+00:00"
+        }
+
+    def table(self, name):
+        return FakeQuery(self.rows.values())
+
+
+@pytest.fixture
+def db():
+    db = FakeSupabase()
+    db.put(1, "p1", [1, 0, 0], 0)
+    db.put(2, "p2", [0, 1, 0], 0)
+    db.put(3, "p2", [0, 0, 1], 0)
+    return db
+
+
+@pytest.fixture
+def index(db, tmp_path):
+    index = CorpusIndex("partner_chunks", str(tmp_path))
+    index.sync(db)
+    return index
+
+
+def ids(results):
+    return [row["id"] for row in results]
+
+
+def test_search_ranks_by_cosine_and_filters_partners(index):
+    assert ids(index.search([0.1, 1, 0.5], 0, 3)) == [2, 3, 1]
+    assert ids(index.search([0.1, 1, 0.5], 0, 3, partner_ids={"p1"})) == [1]
+    assert ids(index.search([0.1, 1, 0.5], 0.4, 3)) == [2, 3]
+
+
+def test_sync_applies_edits_adds_and_deletes(db, index):
+    db.put(1, "p1", [0, 1, 0], 5)
+    db.put(4, "p4", [1, 0, 0], 5)
+    del db.rows[3]
+
+    index.sync(db)
+
+    assert index.snapshot[2]["count"] == 3
+    assert ids(index.search([1, 0, 0], 0.9, 3)) == [4]
+    assert ids(index.search([0, 1, 0], 0.9, 3)) == [1, 2]
+
+
+def test_edit_leaves_the_previous_snapshot_intact(db, index):
+    before = index.snapshot
+
+    db.put(1, "p1", [0, 1, 0], 5)
+    index.sync(db)
+
+    # A search still holding the old snapshot sees the old vector
+    assert np.allclose(before[0][0], [1, 0, 0])
+    assert np.allclose(index.snapshot[0][0], [0, 1, 0])
+
+
+def test_orphan_vectors_from_a_dead_append_are_truncated(db, index, tmp_path):
+    # An append that wrote the matrix but died before the rows/meta
+    with open(index.matrix_path, "ab") as f:
+        f.write(np.array([0, 0, 1], dtype=np.float32).tobytes())
+
+    reopened = CorpusIndex("partner_chunks", str(tmp_path))
+    assert reopened.load()
+
+    db.put(4, "p4", [1, 1, 0], 5)
+    reopened.sync(db)
+
+    assert reopened.search([1, 1, 0], 0.99, 1)[0]["id"] == 4
@@ -0,0 +1,179 @@
+import json
+import os
+
+import pytest
+
+from write_behind import WriteBehindLog, is_permanent_error
+
+
+class APIError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+class FakeTable:
+    def __init__(self, db, rows=None):
+        self.db = db
+        self.rows = rows
+
+    def insert(self, rows):
+        return FakeTable(self.db, rows)
+
+    def execute(self):
+        if self.db.down:
+            raise ConnectionError("unreachable")
+
+        if any(row.get("bad") for row in self.rows):
+            raise APIError("23503")
+
+        self.db.written.extend(self.rows)
+
+
+class FakeSupabase:
+    def __init__(self):
+        self.written = []
+        self.down = False
+
+    def table(self, name):
+        return FakeTable(self)
+
+
+@pytest.fixture
+def db():
+    return FakeSupabase()
+
+
+def make_log(db, tmp_path, **options):
+    options.setdefault("flush_seconds", 60)
+    return WriteBehindLog("t", db, spool_dir=str(tmp_path), **options)
+
+
+def test_permanent_errors_are_sqlstate_row_errors():
+    assert is_permanent_error(APIError("23503"))
+    assert is_permanent_error(APIError("22P02"))
+    assert not is_permanent_error(ConnectionError("x"))
+    assert not is_permanent_error(APIError("PGRST301"))
+
+
+def test_flush_writes_in_order(db, tmp_path):
+    log = make_log(db, tmp_path)
+
+    for i in range(5):
+        log.append({"n": i})
+
+    assert [r["n"] for r in log.pending(lambda r: True)] == list(range(5))
+
+    log.flush()
+
+    assert [r["n"] for r in db.written] == list(range(5))
+    assert log.pending(lambda r: True) == []
+
+
+def test_outage_spools_and_replays(db, tmp_path):
+    log = make_log(db, tmp_path)
+    db.down = True
+    log.append({"n": 1})
+    log.flush()
+
+    assert db.written == []
+    assert os.path.exists(log.spool_path)
+
+    db.down = False
+    log.append({"n": 2})
+    log.flush()
+
+    assert [r["n"] for r in db.written] == [1, 2]
+    assert not os.path.exists(log.spool_path)
+
+
+def test_rejected_row_is_dead_lettered_not_retried(db, tmp_path):
+    log = make_log(db, tmp_path)
+
+    for i in range(6):
+        log.append({"n": i, "bad": i == 3})
+
+    log.flush()
+    log.append({"n": 6})
+    log.flush()
+
+    assert [r["n"] for r in db.written] == [0, 1, 2, 4, 5, 6]
+    assert not os.path.exists(log.spool_path)
+
+    with open(log.dead_letter_path) as f:
+        dead = [json.loads(line) for line in f]
+
+    assert [d["row"]["n"] for d in dead] == [3]
+    assert log.stats()["dead_lettered"] == 1
+
+
+def test_full_queue_spools_instead_of_blocking(db, tmp_path):
+    log = make_log(db, tmp_path, queue_size=2)
+
+    for i in range(4):
+        log.append({"n": i})
+
+    assert log.stats()["queue_full"] == 2
+
+    log.flush()
+
+    assert sorted(r["n"] for r in db.written) == [0, 1, 2, 3]
+
+
+def test_discard_drops_queued_rows(db, tmp_path):
+    log = make_log(db, tmp_path)
+    log.append({"chat_id": 1})
+    log.append({"chat_id": 2})
+
+    assert log.discard(lambda r: r["chat_id"] == 1) == 1
+
+    log.flush()
+
+    assert db.written == [{"chat_id": 2}]
+
+
+def test_journal_recovers_rows_after_crash(db, tmp_path):
+    log = make_log(db, tmp_path, journal=True)
+    log.append({"n": 1})
+
+    # New process, the old one never flushed
+    restarted = make_log(db, tmp_path, journal=True)
+    restarted.start()
+    restarted.flush()
+
+    assert db.written == [{"n": 1}]
+
+    again = make_log(db, tmp_path, journal=True)
+    again.start()
+    again.flush()
+
+    assert db.written == [{"n": 1}]
+
+
+def test_discarded_rows_are_not_recovered_from_the_journal(db, tmp_path):
+    log = make_log(db, tmp_path, journal=True)
+    log.append({"chat_id": 1})
+    log.append({"chat_id": 2})
+    log.discard(lambda r: r["chat_id"] == 2)
+
+    restarted = make_log(db, tmp_path, journal=True)
+    restarted.start()
+    restarted.flush()
+
+    assert db.written == [{"chat_id": 1}]
+
+
+def test_constructing_a_log_leaves_the_journal_alone(db, tmp_path):
+    log = make_log(db, tmp_path, journal=True)
+    log.append({"n": 1})
+
+    with open(log.journal_path) as f:
+        journal = f.read()
+
+    # e.g. a tool importing the module that holds the log
+    make_log(db, tmp_path, journal=True)
+
+    with open(log.journal_path) as f:
+        assert f.read() == journal
+
+    assert not os.path.exists(log.spool_path)
@@ -2,6 +2,7 @@ import os
 from pypdf import PdfReader
 from openai import OpenAI
 from supabase import create_client
+from embedding_cache import EMBEDDINGS
 
 # -----------------------
 # CONFIG
@@ -62,10 +63,7 @@ for chunk in chunks:
     if len(chunk.strip()) < 40:
         continue
 
-    embedding = client.embeddings.create(
-        model="text-embedding-3-small",
-        input=chunk
-    ).data[0].embedding
+    embedding = EMBEDDINGS.embed(client, chunk)
 
     supabase.table("partner_chunks").insert({
         "partner_id": PARTNER_ID,
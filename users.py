@@ -0,0 +1,223 @@
+# users.py
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from partners import RefreshingIndex
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "300"))
+USER_DIRECTORY_TTL_SECONDS = float(os.getenv("USER_DIRECTORY_TTL_SECONDS", "600"))
+USER_DIRECTORY_PAGE_SIZE = int(os.getenv("USER_DIRECTORY_PAGE_SIZE", "1000"))
+USER_DIRECTORY_MISS_REFRESH_SECONDS = float(os.getenv("USER_DIRECTORY_MISS_REFRESH_SECONDS", "60"))
+
+
+def normalize_email(email: str) -> str:
+    return (email or "").lower().strip()
+
+
+class AuthUserDirectory(RefreshingIndex):
+    """
+    email -> auth user id for every auth user. Covers auth users without a
+    user_profiles row.
+
+    Looked up directly through the auth_user_id_by_email RPC
+    (sql/auth_user_id_by_email.sql). While that fails, falls back to a
+    snapshot built by paging through auth.admin.list_users(), loaded on
+    first use and rescanned on a miss at most every
+    USER_DIRECTORY_MISS_REFRESH_SECONDS; add() / remove() keep it current.
+    """
+
+    name = "auth user directory"
+
+    def __init__(self, ttl_seconds: float = USER_DIRECTORY_TTL_SECONDS):
+        super().__init__(ttl_seconds)
+        self.ids = {}
+        self.rpc_failed_at = None
+
+    def fetch(self, supabase) -> list:
+        users = []
+        page = 1
+
+        while True:
+            batch = supabase.auth.admin.list_users(page=page, per_page=USER_DIRECTORY_PAGE_SIZE) or []
+            users.extend(batch)
+
+            if len(batch) < USER_DIRECTORY_PAGE_SIZE:
+                return users
+
+            page += 1
+
+    def build(self, users: list):
+        self.ids = {
+            normalize_email(u.email): u.id
+            for u in users
+            if u.email
+        }
+
+    def add(self, email: str, user_id):
+        self.ids[normalize_email(email)] = user_id
+
+    def remove(self, email: str):
+        self.ids.pop(normalize_email(email), None)
+
+    def _lookup_rpc(self, supabase, email: str):
+        resp = supabase.rpc("auth_user_id_by_email", {"lookup_email": email}).execute()
+        return resp.data or None
+
+    def _lookup_snapshot(self, supabase, email: str):
+        self.ensure_fresh(supabase)
+        user_id = self.ids.get(email)
+
+        if user_id is not None:
+            return user_id
+
+        # The user may be newer than the snapshot; rescan, but not per miss
+        if time.monotonic() - self.loaded_at < USER_DIRECTORY_MISS_REFRESH_SECONDS:
+            return None
+
+        self.invalidate()
+        self.ensure_fresh(supabase)
+
+        return self.ids.get(email)
+
+    def lookup(self, supabase, email: str):
+        email = normalize_email(email)
+
+        # After an RPC failure (e.g. not deployed) use the snapshot for a TTL
+        if self.rpc_failed_at is None or time.monotonic() - self.rpc_failed_at > self.ttl_seconds:
+            try:
+                user_id = self._lookup_rpc(supabase, email)
+                self.rpc_failed_at = None
+                return user_id
+            except Exception as e:
+                print("AUTH USER DIRECTORY RPC ERROR:", e)
+                self.rpc_failed_at = time.monotonic()
+
+        return self._lookup_snapshot(supabase, email)
+
+
+class UserLookup:
+    """
+    Auth user by email without scanning every user.
+
+    Hits come from an LRU of auth users (TTL bounded). A miss resolves the
+    user id through user_profiles (whose id is the auth user id), falling
+    back to the auth user directory, then loads that one user by id.
+    Signup, verify, profile updates and deletes keep it current through
+    remember() / forget(). Unknown emails are not cached.
+    """
+
+    def __init__(
+        self,
+        max_size: int = USER_CACHE_SIZE,
+        ttl_seconds: float = USER_CACHE_TTL_SECONDS
+    ):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.memory = OrderedDict()
+        self.directory = AuthUserDirectory()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _cached(self, email: str):
+        with self._lock:
+            entry = self.memory.get(email)
+
+            if entry is None:
+                return None
+
+            user, stored_at = entry
+
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                self.memory.pop(email, None)
+                return None
+
+            self.memory.move_to_end(email)
+            return user
+
+    def _profile_user_id(self, supabase, email: str):
+        resp = supabase.table("user_profiles") \
+            .select("id") \
+            .eq("email", email) \
+            .limit(1) \
+            .execute()
+
+        return resp.data[0]["id"] if resp.data else None
+
+    def _load(self, supabase, user_id, email: str):
+        try:
+            user = supabase.auth.admin.get_user_by_id(user_id).user
+        except Exception as e:
+            print("USER LOOKUP LOAD ERROR:", e)
+            return None
+
+        # A profile row can outlive an email change made elsewhere
+        if not user or normalize_email(user.email) != email:
+            return None
+
+        return user
+
+    def get(self, supabase, email: str):
+        email = normalize_email(email)
+        user = self._cached(email)
+
+        if user is not None:
+            self.hits += 1
+            return user
+
+        self.misses += 1
+        user = None
+
+        try:
+            user_id = self._profile_user_id(supabase, email)
+
+            if user_id is not None:
+                user = self._load(supabase, user_id, email)
+        except Exception as e:
+            print("USER LOOKUP PROFILE ERROR:", e)
+
+        if user is None:
+            user_id = self.directory.lookup(supabase, email)
+
+            if user_id is not None:
+                user = self._load(supabase, user_id, email)
+
+        if user is not None:
+            self.remember(email, user)
+
+        return user
+
+    def remember(self, email: str, user):
+        email = normalize_email(email)
+
+        with self._lock:
+            self.memory[email] = (user, time.monotonic())
+            self.memory.move_to_end(email)
+
+            while len(self.memory) > self.max_size:
+                self.memory.popitem(last=False)
+
+        self.directory.add(email, user.id)
+
+    def forget(self, email: str):
+        email = normalize_email(email)
+
+        with self._lock:
+            self.memory.pop(email, None)
+
+        self.directory.remove(email)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.memory),
+            "hits": self.hits,
+            "misses": self.misses,
+            "directory_size": len(self.directory.ids)
+        }
+
+
+USER_LOOKUP = UserLookup()
@@ -0,0 +1,442 @@
+# vector_index.py
+
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", ".vector_index")
+VECTOR_INDEX_SYNC_SECONDS = float(os.getenv("VECTOR_INDEX_SYNC_SECONDS", "60"))
+VECTOR_INDEX_PAGE_SIZE = int(os.getenv("VECTOR_INDEX_PAGE_SIZE", "500"))
+
+# Trigger-maintained column on the knowledge tables (sql/knowledge_updated_at.sql)
+KNOWLEDGE_UPDATED_COLUMN = os.getenv("KNOWLEDGE_UPDATED_COLUMN", "updated_at")
+
+# Changed rows are re-read this far behind the newest updated_at seen, so
+# a transaction committing late with an older timestamp is not missed
+VECTOR_INDEX_SYNC_OVERLAP_SECONDS = float(os.getenv("VECTOR_INDEX_SYNC_OVERLAP_SECONDS", "30"))
+
+# Corpus -> source table, embedding column and the fields the match_* RPC returns
+CORPORA = {
+    "partner_qa": {
+        "table": "partner_qa",
+        "embedding": os.getenv("PARTNER_QA_EMBEDDING_COLUMN", "embedding_vec"),
+        "fields": ["id", "partner_id", "question", "answer"]
+    },
+    "bridge_qa": {
+        "table": "bridge_qa",
+        "embedding": "embedding",
+        "fields": ["id", "question", "answer"]
+    },
+    "partner_chunks": {
+        "table": "partner_chunks",
+        "embedding": "embedding",
+        "fields": ["id", "partner_id", "content"]
+    },
+    "bridge_chunks": {
+        "table": "bridge_chunks",
+        "embedding": "embedding",
+        "fields": ["id", "content"]
+    },
+}
+
+# Supabase RPC name -> corpus it searches
+RPC_CORPORA = {
+    "match_partner_qa": "partner_qa",
+    "match_bridge_qa": "bridge_qa",
+    "match_partner_chunks": "partner_chunks",
+    "match_bridge_chunks": "bridge_chunks",
+}
+
+
+def parse_embedding(value):
+    # pgvector columns come back from PostgREST as "[0.1,0.2,...]"
+    if isinstance(value, str):
+        value = json.loads(value)
+
+    return np.asarray(value, dtype=np.float32)
+
+
+def overlap_since(timestamp: str, seconds: float) -> str:
+    """
+    The ISO timestamp `seconds` before timestamp (None stays None).
+    """
+    if not timestamp:
+        return None
+
+    moment = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+
+    return (moment - timedelta(seconds=seconds)).isoformat()
+
+
+def latest(timestamps) -> str:
+    """
+    The newest of PostgREST timestamps, compared as instants.
+    """
+    values = [t for t in timestamps if t]
+
+    if not values:
+        return None
+
+    return max(values, key=lambda t: datetime.fromisoformat(t.replace("Z", "+00:00")))
+
+
+def unit_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+
+    return matrix / norms
+
+
+class CorpusIndex:
+    """
+    One corpus on disk: <name>.f32 (row-major float32 unit vectors, memory
+    mapped), <name>.jsonl (one sidecar row per vector) and <name>.meta.json.
+    """
+
+    def __init__(self, name: str, directory: str = VECTOR_INDEX_DIR):
+        self.name = name
+        self.config = CORPORA[name]
+        self.matrix_path = os.path.join(directory, f"{name}.f32")
+        self.rows_path = os.path.join(directory, f"{name}.jsonl")
+        self.meta_path = os.path.join(directory, f"{name}.meta.json")
+
+        # (matrix, rows, meta, partner_ids) swapped as one tuple so searches
+        # never mix syncs
+        self.snapshot = None
+
+    # ---------------------------
+    # DISK
+    # ---------------------------
+    def load(self) -> bool:
+        try:
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+
+            rows = []
+            with open(self.rows_path) as f:
+                for line in f:
+                    rows.append(json.loads(line))
+
+            count, dim = meta["count"], meta["dim"]
+
+            if count != len(rows):
+                return False
+
+            # An append that died before its rows/meta were written leaves
+            # orphan vectors at the end; later appends would land after them
+            # and every new row would point at the wrong vector
+            if count and os.path.getsize(self.matrix_path) > count * dim * 4:
+                print("VECTOR INDEX TRUNCATE:", self.name)
+                os.truncate(self.matrix_path, count * dim * 4)
+
+            if count:
+                matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r", shape=(count, dim))
+            else:
+                matrix = np.zeros((0, dim), dtype=np.float32)
+
+            partner_ids = np.array([str(row.get("partner_id")) for row in rows], dtype=object)
+
+            self.snapshot = (matrix, rows, meta, partner_ids)
+            return True
+
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print("VECTOR INDEX LOAD ERROR:", self.name, e)
+            return False
+
+    def _write(self, vectors: np.ndarray, rows: list, meta: dict, append: bool):
+        mode = "ab" if append else "wb"
+        suffix = "" if append else ".tmp"
+
+        with open(self.matrix_path + suffix, mode) as f:
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+
+        with open(self.rows_path + suffix, "a" if append else "w") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+
+        if not append:
+            os.replace(self.matrix_path + suffix, self.matrix_path)
+            os.replace(self.rows_path + suffix, self.rows_path)
+
+        self._write_meta(meta)
+
+    def _write_meta(self, meta: dict):
+        with open(self.meta_path + ".tmp", "w") as f:
+            json.dump(meta, f)
+
+        os.replace(self.meta_path + ".tmp", self.meta_path)
+
+    def _replace(self, positions: list, vectors: np.ndarray, rows: list, meta: dict):
+        """
+        Rewrites the files with the vectors and sidecar rows at positions
+        replaced. The matrix is written to a new file and renamed over the
+        old one, so the memmap searches are reading keeps its old contents
+        until load() swaps the snapshot.
+        """
+        matrix, all_rows, _, _ = self.snapshot
+        matrix = np.array(matrix, dtype=np.float32)
+        all_rows = list(all_rows)
+
+        for position, vector, row in zip(positions, vectors, rows):
+            matrix[position] = vector
+            all_rows[position] = row
+
+        self._write(matrix, all_rows, meta, append=False)
+
+    def _keep(self, keep: np.ndarray, meta: dict):
+        """
+        Drops every row not in keep (positions) from the local files,
+        without refetching any embedding.
+        """
+        matrix, rows, _, _ = self.snapshot
+        vectors = np.array(matrix[keep], dtype=np.float32)
+        sidecar = [rows[i] for i in keep]
+
+        self._write(vectors, sidecar, {**meta, "count": len(sidecar)}, append=False)
+
+    # ---------------------------
+    # DATABASE SYNC
+    # ---------------------------
+    def _columns(self, with_embedding: bool = True) -> str:
+        columns = self.config["fields"] + [KNOWLEDGE_UPDATED_COLUMN]
+
+        if with_embedding:
+            columns = columns + [self.config["embedding"]]
+
+        return ", ".join(columns)
+
+    def _fetch_changed(self, supabase, since) -> list:
+        """
+        Rows with an embedding whose updated_at is after since (all rows
+        when since is None), oldest change first.
+        """
+        rows = []
+        offset = 0
+
+        while True:
+            query = supabase.table(self.config["table"]) \
+                .select(self._columns()) \
+                .order(KNOWLEDGE_UPDATED_COLUMN) \
+                .order("id") \
+                .range(offset, offset + VECTOR_INDEX_PAGE_SIZE - 1)
+
+            if since is not None:
+                query = query.gt(KNOWLEDGE_UPDATED_COLUMN, since)
+
+            page = query.execute().data or []
+            rows.extend(row for row in page if row.get(self.config["embedding"]))
+
+            if len(page) < VECTOR_INDEX_PAGE_SIZE:
+                return rows
+
+            offset += VECTOR_INDEX_PAGE_SIZE
+
+    def _fetch_ids(self, supabase) -> set:
+        ids = set()
+        last_id = None
+
+        while True:
+            query = supabase.table(self.config["table"]) \
+                .select("id") \
+                .not_.is_(self.config["embedding"], "null") \
+                .order("id") \
+                .limit(VECTOR_INDEX_PAGE_SIZE)
+
+            if last_id is not None:
+                query = query.gt("id", last_id)
+
+            page = query.execute().data or []
+            ids.update(row["id"] for row in page)
+
+            if len(page) < VECTOR_INDEX_PAGE_SIZE:
+                return ids
+
+            last_id = page[-1]["id"]
+
+    def _count(self, supabase) -> int:
+        return supabase.table(self.config["table"]) \
+            .select("id", count="exact") \
+            .not_.is_(self.config["embedding"], "null") \
+            .limit(1) \
+            .execute() \
+            .count
+
+    def _rebuild(self, supabase):
+        embedding_column = self.config["embedding"]
+        fields = self.config["fields"]
+        all_rows = self._fetch_changed(supabase, None)
+
+        if all_rows:
+            vectors = unit_rows(np.stack([parse_embedding(r[embedding_column]) for r in all_rows]))
+        else:
+            # Keep the known dimension; an empty corpus never gets searched
+            dim = self.snapshot[2]["dim"] if self.snapshot is not None else 0
+            vectors = np.zeros((0, dim), dtype=np.float32)
+
+        meta = {
+            "dim": int(vectors.shape[1]),
+            "count": len(all_rows),
+            "synced_until": latest(r.get(KNOWLEDGE_UPDATED_COLUMN) for r in all_rows),
+            "synced_at": time.time()
+        }
+
+        self._write(vectors, [{f: r.get(f) for f in fields} for r in all_rows], meta, append=False)
+        self.load()
+
+    def sync(self, supabase):
+        """
+        Applies rows changed since the last sync (new rows are appended,
+        edited ones replaced), then, if the table's row count
+        disagrees with ours, drops the locally held rows that no longer
+        exist. Only a dimension change or an empty index forces a rebuild.
+        """
+        snapshot = self.snapshot
+
+        if snapshot is None or not snapshot[2].get("count") or "synced_until" not in snapshot[2]:
+            if snapshot is not None and snapshot[2].get("count"):
+                print("VECTOR INDEX REBUILD:", self.name)
+
+            self._rebuild(supabase)
+            return
+
+        embedding_column = self.config["embedding"]
+        fields = self.config["fields"]
+        _, rows, meta, _ = snapshot
+
+        since = overlap_since(meta.get("synced_until"), VECTOR_INDEX_SYNC_OVERLAP_SECONDS)
+        changed = self._fetch_changed(supabase, since)
+
+        if changed:
+            vectors = unit_rows(np.stack([parse_embedding(r[embedding_column]) for r in changed]))
+
+            if vectors.shape[1] != meta["dim"]:
+                print("VECTOR INDEX REBUILD (dimension changed):", self.name)
+                self._rebuild(supabase)
+                return
+
+            positions = {row["id"]: i for i, row in enumerate(rows)}
+            sidecar = [{f: r.get(f) for f in fields} for r in changed]
+            meta = {
+                **meta,
+                "synced_until": latest([meta.get("synced_until")] + [r.get(KNOWLEDGE_UPDATED_COLUMN) for r in changed]),
+                "synced_at": time.time()
+            }
+
+            edited = [i for i, r in enumerate(changed) if r["id"] in positions]
+            added = [i for i, r in enumerate(changed) if r["id"] not in positions]
+
+            if edited:
+                self._replace(
+                    [positions[changed[i]["id"]] for i in edited],
+                    vectors[edited],
+                    [sidecar[i] for i in edited],
+                    meta
+                )
+
+            if added:
+                meta = {**meta, "count": meta["count"] + len(added)}
+                self._write(vectors[added], [sidecar[i] for i in added], meta, append=True)
+
+            self.load()
+
+        if self._count(supabase) == self.snapshot[2]["count"]:
+            return
+
+        # Deletes (or an embedding set to null): keep only live ids
+        live = self._fetch_ids(supabase)
+        _, rows, meta, _ = self.snapshot
+        keep = np.array([i for i, row in enumerate(rows) if row["id"] in live], dtype=np.int64)
+
+        print("VECTOR INDEX PRUNE:", self.name, len(rows) - len(keep), "rows")
+        self._keep(keep, meta)
+        self.load()
+
+    # ---------------------------
+    # SEARCH
+    # ---------------------------
+    def search(self, embedding, threshold: float, count: int, partner_ids=None) -> list:
+        """
+        Cosine top-k. With partner_ids the top-k is taken inside that set.
+        """
+        matrix, rows, _, row_partner_ids = self.snapshot
+
+        if not rows or count <= 0:
+            return []
+
+        q = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(q)
+
+        if norm:
+            q = q / norm
+
+        sims = matrix @ q
+        allowed = sims >= threshold
+
+        if partner_ids is not None:
+            allowed &= np.isin(row_partner_ids, [str(p) for p in partner_ids])
+
+        candidates = np.flatnonzero(allowed)
+
+        if len(candidates) > count:
+            top = np.argpartition(-sims[candidates], count - 1)[:count]
+            candidates = candidates[top]
+
+        candidates = candidates[np.argsort(-sims[candidates], kind="stable")]
+
+        return [
+            {**rows[i], "similarity": float(sims[i])}
+            for i in candidates
+        ]
+
+
+class VectorIndex:
+    """
+    In-process cosine top-k over the four match_* corpora.
+    Returns the same row shape as the Supabase RPCs.
+    """
+
+    def __init__(self, directory: str = VECTOR_INDEX_DIR):
+        self.directory = directory
+        self.corpora = {name: CorpusIndex(name, directory) for name in CORPORA}
+        self.synced_at = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+        os.makedirs(directory, exist_ok=True)
+
+        for corpus in self.corpora.values():
+            corpus.load()
+
+    def ready(self, corpus: str) -> bool:
+        return self.corpora[corpus].snapshot is not None
+
+    def sync(self, supabase):
+        with self._lock:
+            for corpus in self.corpora.values():
+                try:
+                    corpus.sync(supabase)
+                except Exception as e:
+                    print("VECTOR INDEX SYNC ERROR:", corpus.name, e)
+
+            self.synced_at = time.time()
+
+    def start_background_sync(self, supabase, interval: float = VECTOR_INDEX_SYNC_SECONDS):
+        if self._thread is not None:
+            return
+
+        def loop():
+            while True:
+                self.sync(supabase)
+                time.sleep(interval)
+
+        self._thread = threading.Thread(target=loop, name="vector-index-sync", daemon=True)
+        self._thread.start()
+
+    def match(self, rpc: str, embedding, threshold: float, count: int, partner_ids=None) -> list:
+        return self.corpora[RPC_CORPORA[rpc]].search(embedding, threshold, count, partner_ids)
@@ -0,0 +1,418 @@
+# write_behind.py
+
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+
+WRITE_BEHIND_QUEUE_SIZE = int(os.getenv("WRITE_BEHIND_QUEUE_SIZE", "10000"))
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "200"))
+WRITE_BEHIND_FLUSH_SECONDS = float(os.getenv("WRITE_BEHIND_FLUSH_SECONDS", "1"))
+WRITE_BEHIND_SPOOL_DIR = os.getenv("WRITE_BEHIND_SPOOL_DIR", ".spool")
+
+# Postgres SQLSTATE classes that reject the rows themselves (bad data,
+# constraint violations, unknown columns): retrying never succeeds
+PERMANENT_SQLSTATE_CLASSES = ("22", "23", "42")
+
+
+def is_permanent_error(e: Exception) -> bool:
+    """
+    True for row-level rejections; False for connection errors, timeouts
+    and server trouble, which are worth retrying.
+    """
+    code = getattr(e, "code", None)
+
+    return isinstance(code, str) and code[:2] in PERMANENT_SQLSTATE_CLASSES
+
+
+class WriteBehindLog:
+    """
+    Write-behind inserts into one Supabase table.
+
+    append() only enqueues; a background thread writes queued rows as one
+    multi-row insert every flush_seconds or as soon as batch_size rows are
+    waiting. Rows that cannot be written (Supabase down, queue full) go to
+    a JSONL spool file, which is replayed before the next batch once
+    inserts succeed again, and on the next start. close() drains the queue.
+    A batch that Supabase rejects row-level (see is_permanent_error) is
+    split until the offending rows are found; those go to a dead-letter
+    file and are never retried, so one bad row cannot stall the log.
+
+    With journal=True every accepted row is also appended to a journal
+    file with a sequence number, and the highest written sequence is
+    recorded after each batch, so rows still queued when the process dies
+    are spooled and written on the next start. The journal is read in
+    start() (called by main.py's startup, or by the first append()), not
+    on construction, so a tool that only imports the module holding a log
+    never replays another process's journal.
+    """
+
+    def __init__(
+        self,
+        table: str,
+        supabase,
+        queue_size: int = WRITE_BEHIND_QUEUE_SIZE,
+        batch_size: int = WRITE_BEHIND_BATCH_SIZE,
+        flush_seconds: float = WRITE_BEHIND_FLUSH_SECONDS,
+        spool_dir: str = WRITE_BEHIND_SPOOL_DIR,
+        journal: bool = False
+    ):
+        self.table = table
+        self.supabase = supabase
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.spool_path = os.path.join(spool_dir, f"{table}.jsonl")
+        self.dead_letter_path = os.path.join(spool_dir, f"{table}.dead.jsonl")
+        self.journal_path = os.path.join(spool_dir, f"{table}.journal.jsonl") if journal else None
+        self.committed_path = os.path.join(spool_dir, f"{table}.committed")
+
+        # Items are (sequence, row)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.sequence = 0
+        self.committed = 0
+
+        # Rows taken off the queue but not yet written (see pending())
+        self.in_flight = []
+
+        self.appended = 0
+        self.written = 0
+        self.spooled = 0
+        self.queue_full = 0
+        self.failed_flushes = 0
+        self.dead_lettered = 0
+        self.max_depth = 0
+        self.last_flush_ms = None
+
+        self._spool_lock = threading.Lock()
+        self._journal_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = None
+
+        os.makedirs(spool_dir, exist_ok=True)
+
+    # ---------------------------
+    # PRODUCERS
+    # ---------------------------
+    def append(self, row: dict):
+        if self._closed:
+            self._spool([row])
+            return
+
+        self.start()
+
+        try:
+            with self._journal_lock:
+                self.queue.put_nowait((self.sequence + 1, row))
+                self.sequence += 1
+                self._journal(self.sequence, row)
+        except queue.Full:
+            # Backpressure: never block the request, never drop the row
+            self.queue_full += 1
+            self._spool([row])
+            return
+
+        self.appended += 1
+        depth = self.queue.qsize()
+        self.max_depth = max(self.max_depth, depth)
+
+        if depth >= self.batch_size:
+            self._wake.set()
+
+    def pending(self, predicate) -> list:
+        """
+        Rows accepted but not yet written that match predicate, oldest first.
+        """
+        with self.queue.mutex:
+            queued = list(self.queue.queue)
+
+        return [row for _, row in list(self.in_flight) + queued if predicate(row)]
+
+    def wait(self, predicate, timeout: float) -> bool:
+        """
+        Waits until no row matching predicate is pending. False on timeout.
+        """
+        deadline = time.monotonic() + timeout
+
+        while self.pending(predicate):
+            if time.monotonic() > deadline:
+                return False
+
+            self._wake.set()
+            time.sleep(0.05)
+
+        return True
+
+    def discard(self, predicate) -> int:
+        """
+        Drops queued rows matching predicate (e.g. for a chat being deleted).
+        Rows already being written are not affected; see pending().
+        """
+        with self.queue.mutex:
+            kept = [item for item in self.queue.queue if not predicate(item[1])]
+            dropped = [item[0] for item in self.queue.queue if predicate(item[1])]
+            self.queue.queue.clear()
+            self.queue.queue.extend(kept)
+
+        # Otherwise a crash before the next commit would replay them
+        self._journal_drops(dropped)
+
+        return len(dropped)
+
+    # ---------------------------
+    # JOURNAL
+    # ---------------------------
+    def _journal(self, sequence: int, row: dict):
+        if not self.journal_path:
+            return
+
+        try:
+            with open(self.journal_path, "a") as f:
+                f.write(json.dumps({"seq": sequence, "row": row}, default=str) + "\n")
+        except Exception as e:
+            print(f"{self.table.upper()} JOURNAL ERROR:", e)
+
+    def _journal_drops(self, sequences: list):
+        if not self.journal_path or not sequences:
+            return
+
+        try:
+            with self._journal_lock, open(self.journal_path, "a") as f:
+                for sequence in sequences:
+                    f.write(json.dumps({"drop": sequence}) + "\n")
+        except Exception as e:
+            print(f"{self.table.upper()} JOURNAL ERROR:", e)
+
+    def _commit(self, sequence: int):
+        """
+        Rows up to sequence are written or spooled; once the queue is empty
+        and everything is committed the journal starts over.
+        """
+        self.committed = sequence
+
+        if not self.journal_path:
+            return
+
+        with self._journal_lock:
+            with open(self.committed_path, "w") as f:
+                f.write(str(sequence))
+
+            if self.committed == self.sequence and os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+
+    def _recover_journal(self):
+        try:
+            with open(self.committed_path) as f:
+                self.committed = int(f.read().strip() or 0)
+        except FileNotFoundError:
+            self.committed = 0
+
+        self.sequence = self.committed
+
+        if not os.path.exists(self.journal_path):
+            return
+
+        with open(self.journal_path) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+
+        dropped = {e["drop"] for e in entries if "drop" in e}
+        entries = [e for e in entries if "seq" in e]
+        lost = [e["row"] for e in entries if e["seq"] > self.committed and e["seq"] not in dropped]
+
+        if lost:
+            print(f"{self.table.upper()} JOURNAL RECOVERED:", len(lost), "rows")
+            self._spool(lost)
+
+        self.sequence = max([self.committed] + [e["seq"] for e in entries])
+        self._commit(self.sequence)
+
+    # ---------------------------
+    # FLUSHING
+    # ---------------------------
+    def _take_batch(self) -> list:
+        batch = []
+
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _insert(self, rows: list):
+        self.supabase.table(self.table).insert(rows).execute()
+
+    def _write(self, rows: list) -> list:
+        """
+        Inserts rows and returns the ones left unwritten by a retryable
+        error. Row-level rejections are bisected down to the bad rows,
+        which are dead-lettered; everything else in the batch is written.
+        """
+        if not rows:
+            return []
+
+        try:
+            self._insert(rows)
+            self.written += len(rows)
+            return []
+        except Exception as e:
+            if not is_permanent_error(e):
+                print(f"{self.table.upper()} FLUSH ERROR:", e)
+                return rows
+
+            if len(rows) == 1:
+                self._dead_letter(rows[0], e)
+                return []
+
+        middle = len(rows) // 2
+        unwritten = self._write(rows[:middle])
+
+        if unwritten:
+            return unwritten + rows[middle:]
+
+        return self._write(rows[middle:])
+
+    def _dead_letter(self, row: dict, error: Exception):
+        print(f"{self.table.upper()} ROW REJECTED:", error)
+
+        try:
+            with open(self.dead_letter_path, "a") as f:
+                f.write(json.dumps({"row": row, "error": str(error)}, default=str) + "\n")
+
+            self.dead_lettered += 1
+        except Exception as e:
+            print(f"{self.table.upper()} DEAD LETTER ERROR:", e, "row lost")
+
+    def _spool(self, rows: list):
+        with self._spool_lock:
+            try:
+                with open(self.spool_path, "a") as f:
+                    for row in rows:
+                        f.write(json.dumps(row, default=str) + "\n")
+
+                self.spooled += len(rows)
+            except Exception as e:
+                print(f"{self.table.upper()} SPOOL ERROR:", e, len(rows), "rows lost")
+
+    def _replay_spool(self) -> bool:
+        """
+        Writes spooled rows back to Supabase. False if they are still failing.
+        """
+        with self._spool_lock:
+            if not os.path.exists(self.spool_path):
+                return True
+
+            with open(self.spool_path) as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+
+            for start in range(0, len(rows), self.batch_size):
+                unwritten = self._write(rows[start:start + self.batch_size])
+
+                if unwritten:
+                    # Keep only what is still unwritten
+                    with open(self.spool_path + ".tmp", "w") as f:
+                        for row in unwritten + rows[start + self.batch_size:]:
+                            f.write(json.dumps(row, default=str) + "\n")
+
+                    os.replace(self.spool_path + ".tmp", self.spool_path)
+                    print(f"{self.table.upper()} SPOOL REPLAY INCOMPLETE")
+                    return False
+
+            os.remove(self.spool_path)
+            print(f"{self.table.upper()} SPOOL REPLAYED:", len(rows), "rows")
+            return True
+
+    def flush(self):
+        """
+        Writes everything queued right now. Runs on the flusher thread,
+        and once more from close() after the flusher has stopped.
+        """
+        spool_ok = self._replay_spool()
+
+        while True:
+            batch = self._take_batch()
+
+            if not batch:
+                return
+
+            self.in_flight = batch
+            rows = [row for _, row in batch]
+            started_at = time.perf_counter()
+
+            try:
+                # Behind an unreplayed spool, keep rows in order
+                unwritten = self._write(rows) if spool_ok else rows
+
+                if unwritten:
+                    self.failed_flushes += 1
+                    self._spool(unwritten)
+                    spool_ok = False
+            finally:
+                self.in_flight = []
+                self.last_flush_ms = (time.perf_counter() - started_at) * 1000
+
+            self._commit(batch[-1][0])
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"{self.table.upper()} FLUSHER ERROR:", e)
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        with self._start_lock:
+            if self._thread is not None:
+                return
+
+            # Before the first row gets a sequence number
+            if self.journal_path:
+                self._recover_journal()
+
+            self._thread = threading.Thread(
+                target=self._run,
+                name=f"write-behind-{self.table}",
+                daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.close)
+
+    def close(self):
+        """
+        Stops the flusher and writes (or spools) everything still queued.
+        """
+        if self._closed:
+            return
+
+        self._closed = True
+        self._wake.set()
+
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_seconds + 5)
+
+        self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "table": self.table,
+            "depth": self.queue.qsize(),
+            "max_depth": self.max_depth,
+            "capacity": self.queue.maxsize,
+            "appended": self.appended,
+            "written": self.written,
+            "spooled": self.spooled,
+            "queue_full": self.queue_full,
+            "failed_flushes": self.failed_flushes,
+            "dead_lettered": self.dead_lettered,
+            "last_flush_ms": self.last_flush_ms
+        }